@@ -1,16 +1,22 @@
 import logging
 import os
+import time
 
-from flask import Flask
+from flask import Flask, request
 from flask_cors import CORS
 from flask_restful import Api
+from flask_restful.representations.json import output_json
 
+import electric.evil_global as evil_global
+from electric import metrics, request_timing
 from rest_interface import StatusResource, \
     SystemStorageResource, \
     ChannelResource, \
     ControlRegisterResource, \
     PresetListResource, \
-    PresetResource, ChargeResource, DischargeResource, BalanceResource, MeasureIRResource, StopResource, PresetOrderResource, AddNewPresetResource
+    PresetResource, ChargeResource, DischargeResource, BalanceResource, MeasureIRResource, StopResource, PresetOrderResource, AddNewPresetResource, \
+    PresetRefreshResource, MetricsResource, TransactionsResource, \
+    ChannelStreamResource, StatusStreamResource, ChannelHistoryResource, SessionListResource, SessionResource
 
 application = Flask(__name__, instance_path='/etc')
 cors_app = CORS(application)
@@ -24,7 +30,44 @@ if not debug_mode:
     application.logger.setLevel(logging.INFO)
     application.logger.info("The charger LIVES!")
 
+
+@application.before_request
+def start_request_timer():
+    request_timing.start()
+
+
+@application.before_request
+def start_session_compactor():
+    # here rather than at import, because threads don't survive gunicorn's fork
+    if evil_global.compactor is not None:
+        evil_global.compactor.ensure_running()
+
+
+@application.before_request
+def start_metrics_reporter():
+    if evil_global.broker_metrics is not None:
+        evil_global.broker_metrics.ensure_running()
+
+
+@application.after_request
+def record_request_time(response):
+    timing = request_timing.finish()
+    if timing is not None:
+        now = time.time()
+        labels = (request.endpoint or "unknown", request.method, str(response.status_code))
+        metrics.request_seconds.observe(now - timing.started, labels)
+        response.headers["Server-Timing"] = timing.header(now)
+    return response
+
+
 api = Api(application)
+
+
+@api.representation('application/json')
+def output_timed_json(data, code, headers=None):
+    with request_timing.phase("encode"):
+        return output_json(data, code, headers)
+
 api.add_resource(StatusResource, "/status")
 api.add_resource(SystemStorageResource, "/system")
 api.add_resource(ControlRegisterResource, "/control")
@@ -34,7 +77,15 @@ api.add_resource(BalanceResource, "/balance/<channel_id>/<preset_memory_slot>")
 api.add_resource(MeasureIRResource, "/measureir/<channel_id>")
 api.add_resource(StopResource, "/stop/<channel_id>")
 api.add_resource(ChannelResource, "/channel/<channel_id>")
+api.add_resource(StatusStreamResource, "/stream/status")
+api.add_resource(ChannelStreamResource, "/stream/channel/<channel_id>")
+api.add_resource(ChannelHistoryResource, "/history/channel/<channel_id>")
+api.add_resource(SessionListResource, "/session")
+api.add_resource(SessionResource, "/session/<session_id>")
 api.add_resource(PresetResource, "/preset/<preset_memory_slot>")
 api.add_resource(PresetListResource, "/preset")
 api.add_resource(AddNewPresetResource, "/addpreset")
 api.add_resource(PresetOrderResource, "/presetorder")
+api.add_resource(PresetRefreshResource, "/presetrefresh")
+api.add_resource(MetricsResource, "/metrics")
+api.add_resource(TransactionsResource, "/transactions")
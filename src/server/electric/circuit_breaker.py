@@ -0,0 +1,178 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+
+from electric.icharger.broker import BrokerUnavailable
+from electric.priority_lock import Priority, _is_alive
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+# Consecutive "device absent" failures before the breaker opens
+FAILURE_THRESHOLD = 3
+
+# Seconds between attempts to find the charger again, once the breaker is open
+PROBE_INTERVAL = 2.0
+
+# The most of the last failure's message that's shared with the other processes
+MESSAGE_SIZE = 256
+
+
+def is_device_absent(ex):
+    """
+    True if the exception means the charger isn't there (unplugged, switched off, USB gone), as opposed to
+    a bad or garbled response from a charger that is - which is worth retrying.  Not being able to reach the
+    device broker says nothing about the charger, so doesn't count.
+    """
+    return isinstance(ex, (IOError, OSError)) and not isinstance(ex, BrokerUnavailable)
+
+
+class BreakerState(object):
+    """
+    The state of a breaker, in shared memory so that every process using the charger (gunicorn's workers and
+    the device broker) sees the charger go and come back at the same time.  Make it before forking them.
+    """
+
+    def __init__(self):
+        self.mutex = multiprocessing.Lock()
+        self.failures = multiprocessing.Value('i', 0, lock=False)
+        # 0 while the breaker is closed
+        self.opened_at = multiprocessing.Value('d', 0.0, lock=False)
+        # the process running the probe (0 if none is) ...
+        self.prober_pid = multiprocessing.Value('i', 0, lock=False)
+        # ... and the one that recorded the last failure, along with its message
+        self.failed_pid = multiprocessing.Value('i', 0, lock=False)
+        self.message = multiprocessing.Array('c', MESSAGE_SIZE, lock=False)
+
+
+class ChargerCircuitBreaker(object):
+    """
+    Stops requests from hammering (and queueing behind) a charger that isn't there.
+
+    After FAILURE_THRESHOLD consecutive device-absent failures the breaker opens: callers are expected to
+    check is_open and fail straight away.  A background probe resets the comms and reads the device info every
+    PROBE_INTERVAL seconds, closing the breaker again as soon as that works - as does any other call that's
+    let through anyway and succeeds.
+
+    Breakers made with the same BreakerState share it, and only one of their processes runs the probe at a
+    time: whichever opened the breaker, or - if that one has gone - the next to check is_open.
+    """
+
+    def __init__(self, comms, lock, threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL, state=None):
+        self.comms = comms
+        self.lock = lock
+        self.threshold = threshold
+        self.probe_interval = probe_interval
+        self.state = state if state is not None else BreakerState()
+
+        self._last_exception = None
+        self._probe_thread = None
+        self._probe_pid = None
+
+    @property
+    def opened_at(self):
+        return self.state.opened_at.value or None
+
+    @property
+    def failures(self):
+        return self.state.failures.value
+
+    @property
+    def last_exception(self):
+        """The last device-absent failure, as an IOError with its message if another process recorded it"""
+        if self.state.failed_pid.value == os.getpid() and self._last_exception is not None:
+            return self._last_exception
+        if not self.state.failed_pid.value:
+            return None
+        return IOError(self.state.message.value)
+
+    @property
+    def is_open(self):
+        if not self.state.opened_at.value:
+            return False
+
+        with self.state.mutex:
+            if self.state.opened_at.value:
+                self._start_probe()
+        return self.state.opened_at.value != 0
+
+    def record_success(self):
+        if self.is_open:
+            self.close()
+        self.state.failures.value = 0
+
+    def record_failure(self, ex):
+        """
+        Counts a failure, opening the breaker if that's one device-absent failure too many.
+        :return: True if the breaker is now open
+        """
+        if not is_device_absent(ex):
+            return self.is_open
+
+        with self.state.mutex:
+            self.state.failures.value += 1
+            self._remember(ex)
+            if self.state.failures.value >= self.threshold and not self.state.opened_at.value:
+                logger.warning("charger appears to be disconnected ({0}), failing fast until it returns".format(ex))
+                self.state.opened_at.value = time.time()
+                self._start_probe()
+
+        return self.is_open
+
+    def close(self):
+        with self.state.mutex:
+            if self.state.opened_at.value:
+                logger.info("charger is back, after {0:.1f}s".format(time.time() - self.state.opened_at.value))
+            self.state.failures.value = 0
+            self.state.opened_at.value = 0.0
+
+    def probe(self):
+        """
+        Tries to talk to the charger once, closing the breaker if that works.
+        :return: True if the charger answered
+        """
+        try:
+            with self.lock.holding(Priority.Background):
+                self.comms.reset()
+                self.comms.get_device_info()
+        except Exception, ex:
+            with self.state.mutex:
+                self._remember(ex)
+            return False
+
+        self.close()
+        return True
+
+    def _remember(self, ex):
+        # call holding the state's mutex
+        self._last_exception = ex
+        self.state.failed_pid.value = os.getpid()
+        self.state.message.value = str(ex)[:MESSAGE_SIZE - 1]
+
+    def _start_probe(self):
+        # call holding the state's mutex.  Threads don't survive a fork, so check it belongs to this process.
+        if self._probe_thread is not None and self._probe_pid == os.getpid() and self._probe_thread.is_alive():
+            return
+
+        # ... and leave it to another process that's already probing
+        prober = self.state.prober_pid.value
+        if prober and prober != os.getpid() and _is_alive(prober):
+            return
+
+        self.state.prober_pid.value = os.getpid()
+        self._probe_pid = os.getpid()
+        self._probe_thread = threading.Thread(target=self._run_probe, name="charger-probe")
+        self._probe_thread.daemon = True
+        self._probe_thread.start()
+
+    def _run_probe(self):
+        try:
+            while self.is_open and self.state.prober_pid.value == os.getpid():
+                time.sleep(self.probe_interval)
+                if self.is_open:
+                    self.probe()
+        finally:
+            with self.state.mutex:
+                if self.state.prober_pid.value == os.getpid():
+                    self.state.prober_pid.value = 0
@@ -0,0 +1,316 @@
+"""
+Keeps the charge session store (see sessions.py) from filling the SD card.
+
+Once a session is rollup_after seconds old its samples are rolled up into buckets (the min, mean and max of
+each column over bucket seconds) and a summary of the whole session is written.  Once it's raw_retention
+seconds old, and rolled up, the raw samples are deleted.
+
+The compactor runs in its own thread, a few chunks of one session at a time with a pause in between, and not
+at all while a session is being recorded - so it never competes with the poller for the CPU or the card.  It
+only runs in the process recording the sessions (see SessionStore.claim), and holds a lock on a session's raw
+file while it works on it.
+"""
+import fcntl
+import glob
+import json
+import logging
+import math
+import os
+import threading
+import time
+
+from electric.history import COLUMNS
+from electric.sessions import BLOCK_START, CELL_COUNT, NO_CELL, SESSION_EXTENSION, INDEX_EXTENSION, \
+    ROLLUP_EXTENSION, SUMMARY_EXTENSION, ROLLUP_MAGIC, ROLLUP_HEADER, ROLLUP_RECORD, SessionFile, column_values, \
+    try_flock
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+DAY = 24 * 3600
+
+DEFAULT_ROLLUP_AFTER = 2 * DAY
+DEFAULT_RAW_RETENTION = 14 * DAY
+DEFAULT_BUCKET = 60.0
+
+# Seconds between ticks, and the most chunks (of sessions.CHUNK_RECORDS samples) read in one
+TICK_INTERVAL = 2.0
+CHUNKS_PER_TICK = 8
+
+# Seconds between looking through the store for something to do, once there was nothing
+RESCAN_INTERVAL = 600.0
+
+# Longer than this between samples is a gap, rather than time for the energy totals
+MAX_SAMPLE_GAP = 30.0
+
+_COLUMN = dict((name, n) for (n, name) in enumerate(COLUMNS))
+
+
+class _Bucket(object):
+    def __init__(self, start):
+        self.start = start
+        self.count = 0
+        self.minimum = [float("inf")] * len(COLUMNS)
+        self.total = [0.0] * len(COLUMNS)
+        self.maximum = [float("-inf")] * len(COLUMNS)
+        self.cell_total = [0] * CELL_COUNT
+        self.cell_count = [0] * CELL_COUNT
+
+    def add(self, record, values):
+        self.count += 1
+        for (n, value) in enumerate(values):
+            self.minimum[n] = min(self.minimum[n], value)
+            self.total[n] += value
+            self.maximum[n] = max(self.maximum[n], value)
+
+        cell_volt = 1 + BLOCK_START["cell_volt"]
+        for cell in range(CELL_COUNT):
+            value = record[cell_volt + cell]
+            if value != NO_CELL:
+                self.cell_total[cell] += value
+                self.cell_count[cell] += 1
+
+    def pack(self):
+        values = []
+        for n in range(len(COLUMNS)):
+            values.extend((self.minimum[n], self.total[n] / self.count, self.maximum[n]))
+        cells = [self.cell_total[cell] // self.cell_count[cell] if self.cell_count[cell] else NO_CELL
+                 for cell in range(CELL_COUNT)]
+        return ROLLUP_RECORD.pack(self.start, min(self.count, 0xffff), *(values + cells))
+
+
+class SessionSummary(object):
+    """Totals for a whole session, accumulated a record at a time"""
+
+    def __init__(self, session):
+        self.session = session
+        self.energy_in = 0.0
+        self.energy_out = 0.0
+        self.peak_temp = None
+        self.samples = 0
+        self._last = None
+        self._last_values = None
+
+    def add(self, record, values):
+        if self._last is not None:
+            elapsed = record[0] - self._last[0]
+            if 0 < elapsed <= MAX_SAMPLE_GAP:
+                # watt seconds, going by the power at the start of the interval
+                energy = abs(self._last_values[_COLUMN["curr_out_power"]]) * elapsed
+                if self._last_values[_COLUMN["curr_out_amps"]] < 0:
+                    self.energy_out += energy
+                else:
+                    self.energy_in += energy
+
+        temp = max(values[_COLUMN["curr_int_temp"]], values[_COLUMN["curr_ext_temp"]])
+        self.peak_temp = temp if self.peak_temp is None else max(self.peak_temp, temp)
+
+        self.samples += 1
+        self._last = record
+        self._last_values = values
+
+    def to_dict(self):
+        result = {
+            "started": self.session.started,
+            "ended": self.session.started,
+            "samples": self.samples,
+            "energy_in_wh": round(self.energy_in / 3600.0, 3),
+            "energy_out_wh": round(self.energy_out / 3600.0, 3),
+            "peak_temp": self.peak_temp,
+            "final_capacity": None,
+            "final_cell_spread": None,
+            "final_cell_total_ir": None,
+            "final_line_ir": None,
+            "final_cell_ir": None,
+        }
+
+        last = self._last
+        if last is not None:
+            cell_volt = 1 + BLOCK_START["cell_volt"]
+            cell_ir = 1 + BLOCK_START["cell_ir"]
+            counters = 1 + BLOCK_START["counters"]
+            cells = [cell for cell in range(CELL_COUNT) if last[cell_volt + cell] != NO_CELL]
+            volts = [last[cell_volt + cell] for cell in cells if last[cell_volt + cell] > 0]
+
+            result.update({
+                "ended": last[0],
+                "final_capacity": self._last_values[_COLUMN["curr_out_capacity"]],
+                "final_cell_spread": (max(volts) - min(volts)) / 1000.0 if volts else None,
+                "final_cell_total_ir": last[counters] / 10.0,
+                "final_line_ir": last[counters + 1] / 10.0,
+                "final_cell_ir": [last[cell_ir + cell] / 10.0 for cell in cells],
+            })
+        return result
+
+
+class SessionCompactor(object):
+    def __init__(self, store, rollup_after=DEFAULT_ROLLUP_AFTER, raw_retention=DEFAULT_RAW_RETENTION,
+                 bucket=DEFAULT_BUCKET, interval=TICK_INTERVAL, chunks_per_tick=CHUNKS_PER_TICK):
+        """
+        :param rollup_after: seconds after a session ends that it's rolled up
+        :param raw_retention: seconds after a session ends that its raw samples are deleted, if rolled up
+        :param bucket: seconds of samples in each rolled up bucket
+        """
+        self.store = store
+        self.rollup_after = rollup_after
+        self.raw_retention = raw_retention
+        self.bucket = bucket
+        self.interval = interval
+        self.chunks_per_tick = chunks_per_tick
+
+        # the job in progress: a generator doing the work a chunk at a time
+        self._job = None
+        self._next_scan = 0.0
+
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def ensure_running(self):
+        """Starts the compaction thread, unless it's already running in this process"""
+        if self.running:
+            return
+
+        with self._start_lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="session-compactor")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.running:
+            self._thread.join(timeout)
+
+    def tick(self, now=None):
+        """
+        Does up to chunks_per_tick chunks worth of compaction.
+        :return: True if there is (or may be) more to do
+        """
+        if not self.store.claimed or self.store.recording:
+            return False
+
+        if now is None:
+            now = time.time()
+
+        budget = self.chunks_per_tick
+        while budget > 0:
+            if self._job is None:
+                if now < self._next_scan:
+                    return False
+                self._job = self._next_job(now)
+                if self._job is None:
+                    self._next_scan = now + RESCAN_INTERVAL
+                    return False
+
+            try:
+                budget -= next(self._job)
+            except StopIteration:
+                self._job = None
+            except Exception, e:
+                logger.error("session compaction failed: {0}".format(e))
+                self._job = None
+                self._next_scan = now + RESCAN_INTERVAL
+                return False
+        return True
+
+    def _next_job(self, now):
+        for session_id in self.store.session_ids():
+            raw = self.store.path(session_id, SESSION_EXTENSION)
+            if not os.path.exists(raw) or self.store.is_running(session_id):
+                continue
+
+            # the last sample was written when the file was last modified, so there's no need to read it
+            age = now - os.path.getmtime(raw)
+            rolled_up = os.path.exists(self.store.path(session_id, ROLLUP_EXTENSION))
+
+            if not rolled_up and age >= self.rollup_after:
+                job = self._roll_up
+            elif rolled_up and age >= self.raw_retention:
+                job = self._delete_raw
+            else:
+                continue
+
+            lock = self._lock(raw)
+            if lock is not None:
+                return job(session_id, lock)
+        return None
+
+    @staticmethod
+    def _lock(path):
+        """The raw file, locked - or None if it's being recorded, or compacted by another process"""
+        try:
+            f = open(path, "rb")
+        except IOError:
+            return None
+        if not try_flock(f, fcntl.LOCK_EX):
+            f.close()
+            return None
+        return f
+
+    def _roll_up(self, session_id, lock):
+        try:
+            session = SessionFile(self.store.path(session_id, SESSION_EXTENSION))
+            path = self.store.path(session_id, ROLLUP_EXTENSION)
+            summary = SessionSummary(session)
+
+            # left behind by a roll up that was cut short
+            for stale in glob.glob(path + ".*.tmp"):
+                os.remove(stale)
+
+            # written under another name until it's complete, so a restart starts the session again
+            temporary = "{0}.{1}.tmp".format(path, os.getpid())
+            with open(temporary, "wb") as f:
+                f.write(ROLLUP_HEADER.pack(ROLLUP_MAGIC, session.started, session.channel, self.bucket))
+
+                bucket = None
+                for chunk in range(session.chunk_count):
+                    for record in session.chunk(chunk):
+                        values = column_values(record)
+                        summary.add(record, values)
+
+                        start = math.floor(record[0] / self.bucket) * self.bucket
+                        if bucket is None or bucket.start != start:
+                            if bucket is not None:
+                                f.write(bucket.pack())
+                            bucket = _Bucket(start)
+                        bucket.add(record, values)
+                    yield 1
+
+                if bucket is not None:
+                    f.write(bucket.pack())
+
+            with open(self.store.path(session_id, SUMMARY_EXTENSION), "w") as f:
+                json.dump(summary.to_dict(), f)
+            os.rename(temporary, path)
+        finally:
+            lock.close()
+
+        logger.info("charge session {0} rolled up into {1}s buckets".format(session_id, self.bucket))
+
+    def _delete_raw(self, session_id, lock):
+        # a SessionFile already open can still read the samples, one opened from now on is the rollup
+        try:
+            for extension in (SESSION_EXTENSION, INDEX_EXTENSION):
+                path = self.store.path(session_id, extension)
+                if os.path.exists(path):
+                    os.remove(path)
+        finally:
+            lock.close()
+        logger.info("deleted the raw samples of charge session {0}".format(session_id))
+        yield 1
+
+    def _run(self):
+        logger.info("session compactor started")
+        while not self._stopping.is_set():
+            self.tick()
+            self._stopping.wait(self.interval)
+        logger.info("session compactor stopped")
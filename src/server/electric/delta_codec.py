@@ -0,0 +1,93 @@
+"""
+Compact encoding for a series of records of integers that change a little from one record to the next - the
+charger's registers between one poll and the next, say.
+
+Each value is stored as the difference from the same value in the previous record, zigzag encoded (so small
+negative differences are small too) and written as a varint.  Runs of unchanged values, which are most of them,
+are written as a single varint holding the length of the run: the lowest bit of each varint says which it is.
+
+The first record of a series is encoded against a record of zeros, so a decoder can start at any point a
+series starts.
+"""
+
+
+def zigzag(value):
+    return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+
+def unzigzag(value):
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def _write_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def encode_record(values, previous=None, out=None):
+    """
+    Appends the record, encoded against the previous one (None at the start of a series), to out.
+    :return: out, a new bytearray if none was given
+    """
+    if out is None:
+        out = bytearray()
+
+    unchanged = 0
+    for (n, value) in enumerate(values):
+        delta = value - previous[n] if previous is not None else value
+        if delta == 0:
+            unchanged += 1
+            continue
+
+        if unchanged:
+            _write_varint(out, ((unchanged - 1) << 1) | 1)
+            unchanged = 0
+        _write_varint(out, zigzag(delta) << 1)
+
+    if unchanged:
+        _write_varint(out, ((unchanged - 1) << 1) | 1)
+    return out
+
+
+def decode_records(data, width):
+    """
+    Decodes a series of records, each of width values, as they're needed.  A record cut short by the end of
+    the data (one still being written, say) is ignored.
+    :param data: a bytearray, or anything that can be made into one
+    :return: a generator of record lists
+    """
+    if not isinstance(data, bytearray):
+        data = bytearray(data)
+
+    end = len(data)
+    previous = [0] * width
+    position = 0
+    while position < end:
+        record = []
+        while len(record) < width:
+            # a varint
+            value = 0
+            shift = 0
+            while True:
+                if position >= end:
+                    return
+                byte = data[position]
+                position += 1
+                value |= (byte & 0x7f) << shift
+                shift += 7
+                if not byte & 0x80:
+                    break
+
+            n = len(record)
+            if value & 1:
+                run = (value >> 1) + 1
+                if n + run > width:
+                    raise ValueError("A record has more than {0} values".format(width))
+                record.extend(previous[n:n + run])
+            else:
+                record.append(previous[n] + unzigzag(value >> 1))
+
+        previous = record
+        yield record
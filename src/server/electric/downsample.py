@@ -0,0 +1,105 @@
+"""
+Largest-Triangle-Three-Buckets downsampling, for sending a history to a chart that only needs a few hundred
+points of it.
+
+The series is split into buckets, one for each point wanted, and from each bucket the point forming the largest
+triangle with the point chosen before it and the average of the next bucket is kept - which keeps the peaks and
+troughs a plain every-nth-sample would miss.  See Sveinn Steinarsson, "Downsampling Time Series for Visual
+Representation" (2013).
+
+NumPy is used for the triangle areas when it's installed, it's not a requirement.
+"""
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from electric.history import COLUMNS
+
+MIN_POINTS = 3
+
+
+def lttb_indexes(x, y, max_points, use_numpy=True):
+    """
+    The indexes of the points to keep, in order, so that there are at most max_points.
+    :param x: the times, in increasing order
+    :param y: the values, the same length as x
+    """
+    count = len(x)
+    if max_points >= count:
+        return range(count)
+    if max_points < MIN_POINTS:
+        raise ValueError("max_points must be at least {0}".format(MIN_POINTS))
+
+    if use_numpy and numpy is not None:
+        return _lttb_numpy(numpy.asarray(x, dtype=float), numpy.asarray(y, dtype=float), max_points)
+    return _lttb(x, y, max_points)
+
+
+def _buckets(count, max_points):
+    """(start, end, next end) of each bucket between the first and last points, which are always kept"""
+    every = (count - 2) / float(max_points - 2)
+    for bucket in range(max_points - 2):
+        start = int(bucket * every) + 1
+        end = int((bucket + 1) * every) + 1
+        next_end = min(int((bucket + 2) * every) + 1, count - 1)
+        yield start, end, max(next_end, end + 1)
+
+
+def _lttb(x, y, max_points):
+    selected = [0]
+    a = 0
+    for (start, end, next_end) in _buckets(len(x), max_points):
+        next_count = float(next_end - end)
+        average_x = sum(x[end:next_end]) / next_count
+        average_y = sum(y[end:next_end]) / next_count
+
+        best = start
+        best_area = -1.0
+        for index in range(start, end):
+            area = abs((x[a] - average_x) * (y[index] - y[a]) - (x[a] - x[index]) * (average_y - y[a]))
+            if area > best_area:
+                best = index
+                best_area = area
+
+        selected.append(best)
+        a = best
+
+    selected.append(len(x) - 1)
+    return selected
+
+
+def _lttb_numpy(x, y, max_points):
+    selected = [0]
+    a = 0
+    for (start, end, next_end) in _buckets(len(x), max_points):
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+
+        areas = numpy.abs((x[a] - average_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (average_y - y[a]))
+        a = start + int(areas.argmax())
+        selected.append(a)
+
+    selected.append(len(x) - 1)
+    return selected
+
+
+def downsample(samples, max_points, by):
+    """
+    Downsamples a history (a dict of column name -> list of values, see ChannelHistory.query) to at most
+    max_points samples, choosing them by the shape of the by column.  Every column keeps the same samples.
+    """
+    if by not in COLUMNS:
+        raise ValueError("Can't downsample by {0}".format(by))
+
+    indexes = lttb_indexes(samples["time"], samples[by], max_points)
+    if len(indexes) == len(samples["time"]):
+        return samples
+
+    result = {}
+    for (name, values) in samples.items():
+        if isinstance(values, list) and len(values) == len(samples["time"]):
+            result[name] = [values[index] for index in indexes]
+        else:
+            result[name] = values
+    return result
@@ -1,15 +1,167 @@
-import multiprocessing, logging
+import atexit, multiprocessing, logging, os
 
+from electric.circuit_breaker import BreakerState, ChargerCircuitBreaker
 from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.modbus_usb import iChargerMaster
+from electric.priority_lock import PriorityLock
+from electric.single_flight import SingleFlight
 
 logger = logging.getLogger('electric.app.{0}'.format(__name__))
 
-# A lock used for multiprocess sharing in gunicorn
-lock = multiprocessing.Lock()
+# A lock used for multiprocess sharing in gunicorn, granted in order of priority
+lock = PriorityLock()
+
+# The circuit breaker's state, shared by the workers and the broker: one of them probes for a missing charger
+breaker_state = BreakerState()
 
 # The last device_id value seen during a call to /status / get_device_info()
 last_seen_charger_device_id = None
 
-# The single instance used to talk to the iCharger
-comms = ChargerCommsManager()
 
+def make_master():
+    """
+    The master that owns the iCharger.  Set EMULATE_CHARGER to use the in-process emulator instead, or
+    CHARGER_REPLAY to the path of a capture to replay it (CHARGER_REPLAY_TIMING=fast to skip the charger's
+    response times).  Set CHARGER_CAPTURE to a path to record all the traffic with the charger there.
+    """
+    serial = None
+    if os.environ.get("CHARGER_REPLAY", None):
+        from electric.icharger.replay import ReplaySerialFacade, TIMING_ORIGINAL
+
+        timing = os.environ.get("CHARGER_REPLAY_TIMING", TIMING_ORIGINAL)
+        serial = ReplaySerialFacade(os.environ["CHARGER_REPLAY"], timing=timing)
+    elif os.environ.get("EMULATE_CHARGER", None):
+        from electric.icharger.emulator import EmulatorSerialFacade
+
+        latency = float(os.environ.get("EMULATE_CHARGER_LATENCY", 0))
+        serial = EmulatorSerialFacade(latency=latency)
+
+    if os.environ.get("CHARGER_CAPTURE", None):
+        from electric.icharger.modbus_usb import USBSerialFacade
+        from electric.icharger.replay import CaptureSerialFacade
+
+        serial = CaptureSerialFacade(serial if serial is not None else USBSerialFacade(),
+                                     os.environ["CHARGER_CAPTURE"])
+
+    return iChargerMaster(serial=serial)
+
+
+def make_sessions():
+    """Set SESSION_DIR to record every charge to disk there, for /session.  :return: the SessionStore, or None"""
+    if not os.environ.get("SESSION_DIR", None):
+        return None
+
+    from electric.sessions import SessionStore
+
+    return SessionStore(os.environ["SESSION_DIR"])
+
+
+def make_telemetry(comms, breaker, sessions=None):
+    """
+    Set TELEMETRY_POLL_INTERVAL (seconds) to serve /status and /channel from a background poller rather than
+    reading the charger for every request.
+    :param sessions: the SessionStore the poller records every charge into, if any
+    :return: the TelemetryPoller, or None
+    """
+    poll_interval = float(os.environ.get("TELEMETRY_POLL_INTERVAL", 0))
+    if poll_interval <= 0:
+        return None
+
+    from electric.history import TelemetryHistory, capacity_for, DEFAULT_HOURS
+    from electric.telemetry import TelemetryPoller, DEFAULT_IDLE_INTERVAL
+
+    # ... and TELEMETRY_IDLE_INTERVAL for how often to poll while neither channel is doing anything
+    idle_interval = max(poll_interval, float(os.environ.get("TELEMETRY_IDLE_INTERVAL", DEFAULT_IDLE_INTERVAL)))
+
+    # HISTORY_HOURS of samples are kept for /history, sized for polling at the full rate
+    history = TelemetryHistory(capacity_for(float(os.environ.get("HISTORY_HOURS", DEFAULT_HOURS)), poll_interval))
+
+    return TelemetryPoller(comms, lock, poll_interval, breaker=breaker, idle_interval=idle_interval,
+                           history=history, sessions=sessions)
+
+
+def make_compactor(sessions):
+    """:return: the SessionCompactor for the sessions, or None if there are none"""
+    if sessions is None:
+        return None
+
+    from electric.compaction import SessionCompactor, DAY, DEFAULT_ROLLUP_AFTER, DEFAULT_RAW_RETENTION, \
+        DEFAULT_BUCKET
+
+    # ... sessions are rolled up into SESSION_ROLLUP_SECONDS buckets once SESSION_ROLLUP_DAYS old, and their raw
+    # samples deleted once SESSION_RAW_DAYS old
+    return SessionCompactor(
+        sessions,
+        rollup_after=float(os.environ.get("SESSION_ROLLUP_DAYS", DEFAULT_ROLLUP_AFTER / DAY)) * DAY,
+        raw_retention=float(os.environ.get("SESSION_RAW_DAYS", DEFAULT_RAW_RETENTION / DAY)) * DAY,
+        bucket=float(os.environ.get("SESSION_ROLLUP_SECONDS", DEFAULT_BUCKET)))
+
+
+def make_broker_telemetry(master):
+    """
+    The broker's telemetry poller, reading the charger through master (a LocalMaster).  The broker records the
+    sessions, so it compacts them too.
+    """
+    comms = ChargerCommsManager(master=master)
+    sessions = make_sessions()
+    telemetry = make_telemetry(comms, ChargerCircuitBreaker(comms, lock, state=breaker_state), sessions)
+
+    compactor = make_compactor(sessions)
+    if telemetry is not None and compactor is not None:
+        compactor.ensure_running()
+    return telemetry
+
+
+telemetry_wanted = float(os.environ.get("TELEMETRY_POLL_INTERVAL", 0)) > 0
+
+# The single instance used to talk to the iCharger.  Set DEVICE_BROKER to the path of a Unix socket to have
+# a separate broker process own the device, which every (gunicorn) worker then talks to.  The broker is started
+# here, so gunicorn must --preload for there to be only one of them.  It runs the one telemetry poller too, if
+# there is one, so the charger is polled at the same rate however many workers there are - and records and
+# compacts the sessions.  The broker is restarted if it dies.
+broker_supervisor = None
+broker_metrics = None
+broker_address = os.environ.get("DEVICE_BROKER", None)
+if broker_address:
+    from electric.icharger.broker import BrokerMaster, BrokerMetrics, BrokerTelemetry, BrokerSupervisor
+
+    # DEVICE_BROKER_AUTHKEY connects to a broker started on its own with that key (python -m
+    # electric.icharger.broker), rather than starting one here
+    broker_authkey = os.environ.get("DEVICE_BROKER_AUTHKEY", None)
+    if not broker_authkey:
+        # made here, before gunicorn forks the workers, so that only the broker and the workers know it
+        broker_authkey = os.urandom(32)
+        broker_supervisor = BrokerSupervisor(broker_address, make_master, broker_authkey,
+                                             make_broker_telemetry if telemetry_wanted else None)
+        broker_supervisor.start()
+
+    # /metrics adds up the broker's and every worker's
+    broker_metrics = BrokerMetrics(broker_address, broker_authkey)
+
+    # each worker caches presets, this tells them when another worker has changed them
+    preset_generation = multiprocessing.Value('L', 0)
+    comms = ChargerCommsManager(master=BrokerMaster(broker_address, authkey=broker_authkey),
+                                preset_generation=preset_generation)
+else:
+    comms = ChargerCommsManager(master=make_master())
+
+# Fails requests fast while the charger is unplugged / switched off
+breaker = ChargerCircuitBreaker(comms, lock, state=breaker_state)
+
+# Identical reads made at the same time share a single trip to the charger.  COALESCE_WINDOW (seconds, e.g.
+# 0.05) also lets them share a result that has only just come back.
+single_flight = SingleFlight(float(os.environ.get("COALESCE_WINDOW", 0)))
+
+telemetry = None
+compactor = None
+if telemetry_wanted:
+    sessions = make_sessions()
+    if broker_address:
+        telemetry = BrokerTelemetry(broker_address, broker_authkey, sessions=sessions)
+    else:
+        telemetry = make_telemetry(comms, breaker, sessions)
+        # each worker has a compactor, but only the one recording (see SessionStore.claim) uses it
+        compactor = make_compactor(sessions)
+        if sessions is not None:
+            # ... and it closes the sessions as it exits
+            atexit.register(telemetry.close, 5.0)
@@ -0,0 +1,126 @@
+"""
+Keeps the last few thousand USB transactions with the charger - what was sent, what came back, how long it
+took and what went wrong - so that an intermittent failure can be looked at after the fact.
+
+All the storage is allocated up front: recording a transaction copies the frames into it rather than
+keeping them, so the recorder can stay on all the time.  Each process has its own recorder; with the device
+broker it's the broker's recorder that sees the transactions.
+"""
+import array
+import binascii
+import datetime
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+CAPACITY = 4096
+
+# a HID report is 64 bytes, the frame never longer
+FRAME_LEN = 64
+
+DUMP_DIRECTORY = os.environ.get("FLIGHT_RECORDER_DIR", tempfile.gettempdir())
+
+
+def _copy_frame(storage, offset, frame):
+    if frame is None:
+        return 0
+    length = len(frame)
+    if length > FRAME_LEN:
+        frame = memoryview(frame)[:FRAME_LEN]
+        length = FRAME_LEN
+    storage[offset:offset + length] = frame
+    return length
+
+
+class FlightRecorder(object):
+    def __init__(self, capacity=CAPACITY):
+        self.capacity = capacity
+
+        self._timestamps = array.array('d', [0.0] * capacity)
+        self._durations = array.array('d', [0.0] * capacity)
+        self._function_codes = array.array('B', [0] * capacity)
+        self._addresses = array.array('H', [0] * capacity)
+        self._quantities = array.array('H', [0] * capacity)
+        self._request_lengths = array.array('B', [0] * capacity)
+        self._response_lengths = array.array('B', [0] * capacity)
+        self._requests = bytearray(capacity * FRAME_LEN)
+        self._responses = bytearray(capacity * FRAME_LEN)
+        self._exceptions = [None] * capacity
+
+        # total number recorded, the next slot is _count % capacity
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def record(self, started, duration, function_code, addr, quant, request, response, exception):
+        """
+        Records one transaction.  The request and response are the frames sent and received (anything
+        supporting the buffer interface), response is None if nothing came back.
+        """
+        with self._lock:
+            slot = self._count % self.capacity
+            self._count += 1
+
+            self._timestamps[slot] = started
+            self._durations[slot] = duration
+            self._function_codes[slot] = function_code & 0xff
+            self._addresses[slot] = addr & 0xffff
+            self._quantities[slot] = quant & 0xffff
+            self._exceptions[slot] = exception
+
+            offset = slot * FRAME_LEN
+            self._request_lengths[slot] = _copy_frame(self._requests, offset, request)
+            self._response_lengths[slot] = _copy_frame(self._responses, offset, response)
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def entries(self):
+        """The recorded transactions as dicts (frames in hex), oldest first"""
+        with self._lock:
+            count = self._count
+            result = []
+            for index in range(max(0, count - self.capacity), count):
+                slot = index % self.capacity
+                offset = slot * FRAME_LEN
+                exception = self._exceptions[slot]
+                result.append({
+                    "sequence": index,
+                    "time": self._timestamps[slot],
+                    "duration": self._durations[slot],
+                    "function_code": self._function_codes[slot],
+                    "addr": self._addresses[slot],
+                    "quant": self._quantities[slot],
+                    "request": binascii.hexlify(self._requests[offset:offset + self._request_lengths[slot]]),
+                    "response": binascii.hexlify(self._responses[offset:offset + self._response_lengths[slot]]),
+                    "exception": None if exception is None else "{0}: {1}".format(type(exception).__name__,
+                                                                                  exception)
+                })
+            return result
+
+
+def dump_to_file(entries, reason, directory=None):
+    """
+    Writes the entries out as JSON, returning the name of the file written.
+    """
+    if directory is None:
+        directory = DUMP_DIRECTORY
+
+    stamp = datetime.datetime.fromtimestamp(time.time()).strftime("%Y%m%d-%H%M%S-%f")
+    path = os.path.join(directory, "electric-transactions-{0}.json".format(stamp))
+    with open(path, "w") as f:
+        json.dump({"reason": reason, "transactions": entries}, f)
+
+    logger.warning("dumped the last {0} charger transactions to {1}".format(len(entries), path))
+    return path
+
+
+RECORDER = FlightRecorder()
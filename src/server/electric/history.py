@@ -0,0 +1,141 @@
+"""
+The recent history of each channel, as recorded by the TelemetryPoller.
+
+Samples are kept in columns - one preallocated array per value, cell voltages in millivolts - rather than as
+ChannelStatus models, which would take tens of times the memory for the same number of hours.  Each column is
+a ring: once it's full the oldest sample is overwritten.  The history is kept by the process running the
+poller, the device broker if there is one.
+"""
+import array
+import bisect
+import threading
+
+# Hours of history kept, at the poller's (full rate) interval
+DEFAULT_HOURS = 2.0
+
+MAX_CELLS = 16
+
+# The ChannelStatus values kept for each sample, in the order they're returned
+COLUMNS = (
+    "curr_out_volts",
+    "curr_out_amps",
+    "curr_out_power",
+    "curr_out_capacity",
+    "curr_int_temp",
+    "curr_ext_temp",
+)
+
+
+def capacity_for(hours, interval):
+    """The number of samples needed to hold that many hours, polling at interval"""
+    return max(1, int(hours * 3600.0 / interval))
+
+
+class _TimeView(object):
+    """The timestamps, oldest first, as a sequence bisect can search"""
+
+    def __init__(self, history, first, count):
+        self.history = history
+        self.first = first
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.history._times[(self.first + index) % self.history.capacity]
+
+
+class ChannelHistory(object):
+    def __init__(self, capacity):
+        self.capacity = capacity
+
+        self._times = array.array('d', [0.0]) * capacity
+        self._columns = dict((name, array.array('f', [0.0]) * capacity) for name in COLUMNS)
+        self._cell_counts = array.array('B', [0]) * capacity
+        self._cells = array.array('H', [0]) * (capacity * MAX_CELLS)
+
+        # total number recorded, the next slot is _count % capacity
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def record(self, timestamp, status):
+        """Records the ChannelStatus as it was at timestamp, which mustn't be before the last one recorded"""
+        with self._lock:
+            slot = self._count % self.capacity
+            self._count += 1
+
+            self._times[slot] = timestamp
+            for name in COLUMNS:
+                self._columns[name][slot] = getattr(status, name) or 0.0
+
+            cells = (status.cells or ())[:MAX_CELLS]
+            self._cell_counts[slot] = len(cells)
+            offset = slot * MAX_CELLS
+            for (n, cell) in enumerate(cells):
+                self._cells[offset + n] = int(round(cell.voltage * 1000.0))
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def query(self, since=None, until=None, step=None):
+        """
+        The samples between since and until (inclusive, either can be None), at most one every step seconds.
+        :return: a dict of column name -> list of values, along with "time" and "cells" (a list of the cell
+        voltages for each sample)
+        """
+        with self._lock:
+            count = len(self)
+            first = self._count - count
+            times = _TimeView(self, first, count)
+
+            start = 0 if since is None else bisect.bisect_left(times, since)
+            end = count if until is None else bisect.bisect_right(times, until)
+
+            indexes = []
+            next_time = None
+            for index in range(start, end):
+                timestamp = times[index]
+                if step and next_time is not None and timestamp < next_time:
+                    continue
+                indexes.append((first + index) % self.capacity)
+                if step:
+                    next_time = timestamp + step
+
+            result = {"time": [self._times[slot] for slot in indexes]}
+            for name in COLUMNS:
+                column = self._columns[name]
+                result[name] = [round(column[slot], 3) for slot in indexes]
+
+            cells = []
+            for slot in indexes:
+                offset = slot * MAX_CELLS
+                cells.append([value / 1000.0 for value in self._cells[offset:offset + self._cell_counts[slot]]])
+            result["cells"] = cells
+
+            return result
+
+
+class TelemetryHistory(object):
+    """A ChannelHistory for each channel, fed with every good snapshot the poller takes"""
+
+    def __init__(self, capacity, channels=2):
+        self.channels = tuple(ChannelHistory(capacity) for channel in range(channels))
+
+    def channel(self, channel):
+        if 0 <= channel < len(self.channels):
+            return self.channels[channel]
+        return None
+
+    def record(self, snapshot):
+        if snapshot.exception is not None:
+            return
+
+        for (channel, status) in enumerate(snapshot.channels):
+            history = self.channel(channel)
+            if history is not None and status is not None:
+                history.record(snapshot.timestamp, status)
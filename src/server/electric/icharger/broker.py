@@ -0,0 +1,677 @@
+import atexit
+import cPickle
+import errno
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import stat
+import threading
+import time
+from multiprocessing.connection import Listener, Client
+
+import modbus_tk.defines as cst
+
+from electric import metrics, request_timing
+from electric.icharger.modbus_usb import iChargerMaster, register_block
+from electric.telemetry import TelemetrySnapshot
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+# The socket goes in a directory of its own, which only this user can get into
+DEFAULT_BROKER_ADDRESS = "/tmp/electric-charger/broker.sock"
+
+# The only master methods a client may call through the broker
+BROKERED_METHODS = ("open", "close", "reset", "modbus_read_registers", "modbus_read_blocks", "modbus_write_registers",
+                    "recent_transactions", "drain_input", "recover")
+
+# ... and the broker's own methods, for when it runs the telemetry poller
+TELEMETRY_METHODS = ("telemetry_snapshot", "telemetry_wake", "history_query")
+METRICS_METHODS = ("metrics_report",)
+
+CONNECT_ATTEMPTS = 20
+CONNECT_RETRY_DELAY = 0.1
+
+# Seconds a worker waits for the broker's next snapshot in one call, and waits after failing to get one
+FOLLOW_TIMEOUT = 15.0
+FOLLOW_RETRY_DELAY = 1.0
+
+# Seconds the broker waits for its telemetry poller to stop as it exits
+CLOSE_TIMEOUT = 5.0
+
+# Seconds between checks that the broker is still alive, and before starting a new one when it isn't
+SUPERVISE_INTERVAL = 1.0
+RESTART_DELAY = 1.0
+
+# Seconds between a worker sending its metrics to the broker
+METRICS_REPORT_INTERVAL = 10.0
+
+
+class DeviceBroker(object):
+    """
+    Owns the one and only iChargerMaster and serves its register reads/writes to any number of clients (the
+    gunicorn workers) over a Unix socket, one transaction at a time.  Only this process ever opens the
+    HID device.
+
+    Each request is a (method, args, kwargs) tuple, each reply either ("ok", result) or ("error", exception).
+    Clients must know the authkey, and the socket is only reachable by this user: requests are unpickled, so
+    anyone able to send one could run code as the broker.
+
+    The broker can also run the one telemetry poller, so that the charger is polled at the same rate however
+    many workers there are.  The workers follow its snapshots through a BrokerTelemetry.
+
+    The transactions happen here, so they're counted in this process's metrics.  The workers send theirs here
+    too, and get back the totals (see BrokerMetrics).
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, master=None, authkey=None, telemetry=None):
+        """
+        :param authkey: shared with the clients, by default the key multiprocessing gave this process (which
+        its children inherit)
+        :param telemetry: a TelemetryPoller, reading the charger through a LocalMaster for this broker
+        """
+        if master is None:
+            master = iChargerMaster()
+
+        self.address = address
+        self.master = master
+        self.authkey = authkey if authkey is not None else multiprocessing.current_process().authkey
+        self.telemetry = telemetry
+        self.listener = None
+
+        self._device_lock = threading.Lock()
+        self._stopping = False
+
+        # pid -> the last metrics snapshot from each worker, and the totals of the workers that have gone
+        self._metric_reports = {}
+        self._retired_metrics = {}
+        self._metrics_lock = threading.Lock()
+
+    def listen(self):
+        private_directory(os.path.dirname(os.path.abspath(self.address)))
+        if os.path.exists(self.address):
+            os.unlink(self.address)
+        self.listener = Listener(self.address, family="AF_UNIX", authkey=self.authkey)
+        os.chmod(self.address, 0600)
+        logger.info("device broker listening on {0}".format(self.address))
+
+    def serve_forever(self):
+        if self.listener is None and not self._stopping:
+            self.listen()
+
+        while not self._stopping:
+            try:
+                conn = self.listener.accept()
+            except Exception, e:
+                if self._stopping:
+                    break
+                logger.error("device broker failed to accept a client: {0}".format(e))
+                continue
+
+            client = threading.Thread(target=self._serve_client, args=(conn,), name="device-broker-client")
+            client.daemon = True
+            client.start()
+
+    def stop(self):
+        self._stopping = True
+        if self.listener is not None:
+            # wake up the accept() so serve_forever can notice - with a bare connection, as a Client would wait
+            # for the authentication forever if serve_forever had already stopped
+            try:
+                wake = socket.socket(socket.AF_UNIX)
+                wake.connect(self.address)
+                wake.close()
+            except Exception:
+                pass
+            self.listener.close()
+            self.listener = None
+
+    def handle(self, method, args, kwargs):
+        try:
+            if method in BROKERED_METHODS:
+                with self._device_lock:
+                    return "ok", getattr(self.master, method)(*args, **kwargs)
+            if method in TELEMETRY_METHODS and self.telemetry is not None:
+                return "ok", getattr(self, method)(*args, **kwargs)
+            if method in METRICS_METHODS:
+                return "ok", getattr(self, method)(*args, **kwargs)
+        except Exception, e:
+            return "error", e
+
+        return "error", ValueError("{0} is not available through the device broker".format(method))
+
+    def telemetry_snapshot(self, after_version, timeout=None):
+        """Waits for a snapshot newer than after_version, see TelemetryPoller.wait_for_snapshot"""
+        self.telemetry.ensure_running()
+        snapshot = self.telemetry.wait_for_snapshot(after_version, timeout)
+        if snapshot is not None and snapshot.exception is not None and not _can_pickle(snapshot.exception):
+            snapshot = TelemetrySnapshot(snapshot.version, snapshot.timestamp, snapshot.device_info,
+                                         snapshot.channels, IOError(str(snapshot.exception)))
+        return snapshot
+
+    def telemetry_wake(self):
+        self.telemetry.ensure_running()
+        self.telemetry.wake()
+
+    def history_query(self, channel, since=None, until=None, step=None):
+        history = self.telemetry.history.channel(channel) if self.telemetry.history is not None else None
+        if history is None:
+            raise ValueError("There's no history of channel {0}".format(channel))
+        return history.query(since, until, step)
+
+    def metrics_report(self, pid, snapshot):
+        """
+        Takes a worker's metrics (a Registry snapshot).
+        :return: the totals, of this process's metrics and every worker's
+        """
+        with self._metrics_lock:
+            self._metric_reports[pid] = snapshot
+            for (other, report) in self._metric_reports.items():
+                if other != pid and not _is_alive(other):
+                    # a worker that has gone keeps its share of the totals, counters only ever go up
+                    self._retired_metrics = metrics.merge((self._retired_metrics, report))
+                    del self._metric_reports[other]
+
+            return metrics.merge([metrics.REGISTRY.snapshot(), self._retired_metrics] + self._metric_reports.values())
+
+    def _serve_client(self, conn):
+        try:
+            while True:
+                (method, args, kwargs) = conn.recv()
+                reply = self.handle(method, args, kwargs)
+                try:
+                    conn.send(reply)
+                except Exception, e:
+                    # the exception itself couldn't be pickled, send something that can be
+                    conn.send(("error", IOError(str(reply[1]))))
+        except EOFError:
+            pass
+        except Exception, e:
+            logger.warning("device broker client failed: {0}".format(e))
+        finally:
+            conn.close()
+
+
+def private_directory(path):
+    """
+    Makes the directory the socket goes in, if it isn't there already.  One that isn't this user's, or that
+    anyone else can get into, is refused rather than fixed - it may be /tmp itself.
+    """
+    try:
+        os.mkdir(path, 0700)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid():
+        raise IOError("{0} is not a directory belonging to this user, the broker's socket can't go there".format(path))
+    if stat.S_IMODE(info.st_mode) & (stat.S_IRWXG | stat.S_IRWXO):
+        raise IOError("{0} can be reached by other users, the broker's socket needs a private directory".format(path))
+
+
+def _can_pickle(value):
+    try:
+        cPickle.dumps(value, cPickle.HIGHEST_PROTOCOL)
+    except Exception:
+        return False
+    return True
+
+
+def _exit_on_signal(signum, frame):
+    raise SystemExit(0)
+
+
+def _run_broker(address, master_factory, authkey, telemetry_factory=None):
+    # terminate() (as multiprocessing does to a daemon process when its parent exits) sends SIGTERM, which would
+    # otherwise end the broker without closing the sessions it's recording
+    signal.signal(signal.SIGTERM, _exit_on_signal)
+
+    broker = DeviceBroker(address, master_factory(), authkey)
+    try:
+        if telemetry_factory is not None:
+            # nothing forks the broker, so there's no need to wait for a client before polling
+            broker.telemetry = telemetry_factory(LocalMaster(broker))
+            if broker.telemetry is not None:
+                broker.telemetry.ensure_running()
+        broker.serve_forever()
+    finally:
+        if broker.telemetry is not None:
+            broker.telemetry.close(CLOSE_TIMEOUT)
+
+
+def start_broker_process(address=DEFAULT_BROKER_ADDRESS, master_factory=iChargerMaster, authkey=None,
+                         telemetry_factory=None):
+    """
+    Starts the broker in its own (daemon) process.  The master is created by calling master_factory in
+    that process, so the device is never opened by the caller.
+    :param telemetry_factory: if given, called in the broker process with a LocalMaster, returns the
+    TelemetryPoller for the broker to run
+    """
+    process = multiprocessing.Process(target=_run_broker, args=(address, master_factory, authkey, telemetry_factory),
+                                      name="device-broker")
+    process.daemon = True
+    process.start()
+    return process
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class BrokerSupervisor(object):
+    """
+    Keeps a broker process running, starting a new one (at the same address, with the same authkey) whenever
+    it dies.  The clients reconnect to it by themselves.
+
+    The process isn't left among multiprocessing's children: those are inherited by every gunicorn worker,
+    and a worker exiting would terminate the broker on its way out.  So the supervisor, in the process that
+    started it, is the one to stop it too.
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, master_factory=iChargerMaster, authkey=None,
+                 telemetry_factory=None):
+        """See start_broker_process"""
+        self.address = address
+        self.master_factory = master_factory
+        self.authkey = authkey
+        self.telemetry_factory = telemetry_factory
+
+        self.process = None
+        self.restarts = 0
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        self._pid = os.getpid()
+        self._start_process()
+
+        self._thread = threading.Thread(target=self._run, name="device-broker-supervisor")
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _start_process(self):
+        self.process = start_broker_process(self.address, self.master_factory, self.authkey, self.telemetry_factory)
+        multiprocessing.current_process()._children.discard(self.process)
+
+    def _alive(self):
+        # gunicorn's master reaps any child of its own that exits, in which case join() never sees an exit code
+        self.process.join(0)
+        return self.process.exitcode is None and _is_alive(self.process.pid)
+
+    def stop(self, timeout=CLOSE_TIMEOUT + 1):
+        """Stops the broker, for good.  Only in the process that started it: the workers inherit this too"""
+        if self._pid != os.getpid():
+            return
+
+        self._stopping.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+        if self.process is not None and self._alive():
+            self.process.terminate()
+            self.process.join(timeout)
+
+    def _run(self):
+        while not self._stopping.wait(SUPERVISE_INTERVAL):
+            if self._alive():
+                continue
+
+            logger.error("the device broker (pid {0}) has gone, starting another".format(self.process.pid))
+            if self._stopping.wait(RESTART_DELAY):
+                break
+            self.restarts += 1
+            self._start_process()
+
+
+class BrokerUnavailable(IOError):
+    """The broker couldn't be reached - which says nothing about whether the charger is there"""
+
+
+def _labels(function_code, addr):
+    return str(function_code), register_block(addr)
+
+
+class BrokerConnection(object):
+    """
+    A connection to the DeviceBroker, made when it's first needed (and again after a fork, or once it's been
+    lost).  One call at a time goes through it.  Failures to reach the broker are raised as BrokerUnavailable.
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, connect_attempts=CONNECT_ATTEMPTS, authkey=None):
+        self.address = address
+        self.connect_attempts = connect_attempts
+        self.authkey = authkey if authkey is not None else multiprocessing.current_process().authkey
+
+        self._conn = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _connection(self):
+        # a connection inherited across a fork belongs to the parent
+        if self._conn is not None and self._pid == os.getpid():
+            return self._conn
+
+        last_error = None
+        for attempt in range(self.connect_attempts):
+            try:
+                self._conn = Client(self.address, family="AF_UNIX", authkey=self.authkey)
+                self._pid = os.getpid()
+                return self._conn
+            except Exception, e:
+                last_error = e
+                if attempt + 1 < self.connect_attempts:
+                    time.sleep(CONNECT_RETRY_DELAY)
+
+        raise BrokerUnavailable("Cannot connect to the device broker at {0}: {1}".format(self.address, last_error))
+
+    def _disconnect(self):
+        if self._conn is not None and self._pid == os.getpid():
+            try:
+                self._conn.close()
+            except Exception:
+                pass
+        self._conn = None
+
+    def call(self, method, *args, **kwargs):
+        with self._lock:
+            try:
+                conn = self._connection()
+                conn.send((method, args, kwargs))
+                (status, value) = conn.recv()
+            except (EOFError, IOError, OSError), e:
+                self._disconnect()
+                raise BrokerUnavailable("Lost the connection to the device broker: {0}".format(e))
+
+        if status == "error":
+            raise value
+        return value
+
+
+class BrokerMaster(object):
+    """
+    Stands in for the iChargerMaster in the processes that don't own the device, forwarding each call to
+    the DeviceBroker.  Failures to reach the broker are raised as BrokerUnavailable, an IOError that the circuit
+    breaker doesn't take for a missing charger.
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, connect_attempts=CONNECT_ATTEMPTS, authkey=None):
+        self.connection = BrokerConnection(address, connect_attempts, authkey)
+
+    def _call(self, method, *args, **kwargs):
+        return self.connection.call(method, *args, **kwargs)
+
+    def _timed_call(self, labels, method, *args, **kwargs):
+        # the broker counts the transactions in its metrics, this only times them (and the trip there) for the
+        # request's Server-Timing
+        started = time.time()
+        try:
+            return self._call(method, *args, **kwargs)
+        finally:
+            request_timing.record("modbus", time.time() - started)
+
+    def open(self):
+        return self._call("open")
+
+    def close(self):
+        return self._call("close")
+
+    def reset(self):
+        return self._call("reset")
+
+    def drain_input(self):
+        return self._call("drain_input")
+
+    def recover(self, failures, reopen=False):
+        return self._call("recover", failures, reopen=reopen)
+
+    def recent_transactions(self):
+        return self._call("recent_transactions")
+
+    def modbus_read_registers(self, addr, data_format, function_code=cst.READ_INPUT_REGISTERS):
+        return self._timed_call(_labels(function_code, addr), "modbus_read_registers", addr, data_format,
+                                function_code=function_code)
+
+    def modbus_read_blocks(self, requests, function_code=cst.READ_INPUT_REGISTERS, **kwargs):
+        return self._timed_call(_labels(function_code, requests[0][0]), "modbus_read_blocks", requests,
+                                function_code=function_code, **kwargs)
+
+    def modbus_write_registers(self, addr, data):
+        return self._timed_call(_labels(cst.WRITE_MULTIPLE_REGISTERS, addr), "modbus_write_registers", addr, data)
+
+
+class LocalMaster(BrokerMaster):
+    """
+    The master for the broker's own telemetry poller: each call goes straight to the broker, which takes its
+    turn with the device along with the clients'.
+    """
+
+    def __init__(self, broker):
+        self.broker = broker
+
+    def _call(self, method, *args, **kwargs):
+        (status, value) = self.broker.handle(method, args, kwargs)
+        if status == "error":
+            raise value
+        return value
+
+    def _timed_call(self, labels, method, *args, **kwargs):
+        # the broker's master times the transactions already
+        return self._call(method, *args, **kwargs)
+
+
+class _BrokerChannelHistory(object):
+    def __init__(self, connection, channel):
+        self.connection = connection
+        self.channel = channel
+
+    def query(self, since=None, until=None, step=None):
+        return self.connection.call("history_query", self.channel, since, until, step)
+
+
+class BrokerHistory(object):
+    """Stands in for the TelemetryHistory kept by the broker's poller, see ChannelHistory.query"""
+
+    def __init__(self, connection, channels=2):
+        self.channels = tuple(_BrokerChannelHistory(connection, channel) for channel in range(channels))
+
+    def channel(self, channel):
+        if 0 <= channel < len(self.channels):
+            return self.channels[channel]
+        return None
+
+
+class BrokerMetrics(object):
+    """
+    Sends this worker's metrics to the broker every interval seconds (and as the worker exits), so the broker
+    can add them up.  /metrics is rendered from the totals the broker sends back, so it's the same whichever
+    worker answers, and it includes the transactions and transport resets that only happen in the broker.
+
+    Like the poller the thread is started lazily, by ensure_running().
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, authkey=None, interval=METRICS_REPORT_INTERVAL):
+        self.connection = BrokerConnection(address, CONNECT_ATTEMPTS, authkey)
+        self.interval = interval
+
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def report(self):
+        """:return: the totals, see DeviceBroker.metrics_report"""
+        return self.connection.call("metrics_report", os.getpid(), metrics.REGISTRY.snapshot())
+
+    def render(self):
+        """The Prometheus text for the whole app.  Raises IOError if the broker can't be reached"""
+        return metrics.REGISTRY.render(self.report())
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def ensure_running(self):
+        """Starts reporting, unless that's already happening in this process"""
+        if self.running:
+            return
+
+        with self._start_lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="metrics-reporter")
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self._report_quietly)
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.running:
+            self._thread.join(timeout)
+
+    def _report_quietly(self):
+        if self._pid != os.getpid():
+            return
+        try:
+            self.report()
+        except IOError, e:
+            logger.debug("could not send the metrics to the broker: {0}".format(e))
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self._report_quietly()
+
+
+class BrokerTelemetry(object):
+    """
+    Stands in for the TelemetryPoller in the workers when the poller runs in the broker.  A thread follows the
+    broker's snapshots, publishing each one here - so a worker hands out snapshots, and streams them, just as
+    it would with a poller of its own.  If the broker can't be reached a snapshot saying so is published,
+    with the last values seen.
+
+    Like the poller the thread is started lazily, by ensure_running().
+    """
+
+    def __init__(self, address=DEFAULT_BROKER_ADDRESS, authkey=None, sessions=None, follow_timeout=FOLLOW_TIMEOUT):
+        """
+        :param sessions: the SessionStore the broker's poller is recording into, for reading
+        :param follow_timeout: the longest a call waiting for the next snapshot takes, even with nothing new
+        """
+        # one connection waits for snapshots, the other is for everything else
+        self._follow = BrokerConnection(address, CONNECT_ATTEMPTS, authkey)
+        self.connection = BrokerConnection(address, CONNECT_ATTEMPTS, authkey)
+
+        self.history = BrokerHistory(self.connection)
+        self.sessions = sessions
+        self.follow_timeout = follow_timeout
+
+        # the control register as last seen by note_control()
+        self._control = None
+
+        self._snapshot = None
+        self._version = 0
+        self._broker_version = 0
+        self._published = threading.Condition()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def wait_for_snapshot(self, after_version, timeout=None):
+        """See TelemetryPoller.wait_for_snapshot"""
+        with self._published:
+            if self._snapshot is None or self._snapshot.version <= after_version:
+                self._published.wait(timeout)
+            return self._snapshot
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def ensure_running(self):
+        """Starts following the broker's snapshots, unless that's already happening in this process"""
+        if self.running:
+            return
+
+        with self._start_lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="telemetry-follower")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        if self.running:
+            self._thread.join(timeout)
+
+    def wake(self):
+        try:
+            self.connection.call("telemetry_wake")
+        except IOError, e:
+            logger.warning("could not wake the broker's telemetry poller: {0}".format(e))
+
+    def note_control(self, control):
+        """Wakes the poller if the control register has changed since it was last seen here"""
+        values = control.to_native() if control is not None else None
+        if values != self._control:
+            self._control = values
+            self.wake()
+
+    def _publish(self, device_info, channels, timestamp, exception=None):
+        with self._published:
+            self._version += 1
+            self._snapshot = TelemetrySnapshot(self._version, timestamp, device_info, channels, exception)
+            self._published.notify_all()
+
+    def _run(self):
+        logger.info("following the broker's telemetry snapshots")
+        lost = False
+        while not self._stopping.is_set():
+            try:
+                snapshot = self._follow.call("telemetry_snapshot", self._broker_version, self.follow_timeout)
+            except IOError, e:
+                if not lost:
+                    # keep the last known values, alongside the reason they aren't current
+                    logger.warning("lost the broker's telemetry snapshots: {0}".format(e))
+                    previous = self._snapshot
+                    if previous is not None:
+                        self._publish(previous.device_info, previous.channels, previous.timestamp, e)
+                    else:
+                        self._publish(None, None, time.time(), e)
+                    lost = True
+                self._stopping.wait(FOLLOW_RETRY_DELAY)
+                continue
+
+            lost = False
+            if snapshot is not None and snapshot.version != self._broker_version:
+                self._broker_version = snapshot.version
+                self._publish(snapshot.device_info, snapshot.channels, snapshot.timestamp, snapshot.exception)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    if not os.environ.get("DEVICE_BROKER_AUTHKEY", None):
+        raise SystemExit("Set DEVICE_BROKER_AUTHKEY to the key the app will connect with")
+
+    # the same charger (or emulator) and telemetry settings as the app
+    from electric.evil_global import make_master, make_broker_telemetry, telemetry_wanted
+
+    _run_broker(os.environ.get("DEVICE_BROKER", DEFAULT_BROKER_ADDRESS), make_master,
+                os.environ["DEVICE_BROKER_AUTHKEY"], make_broker_telemetry if telemetry_wanted else None)
@@ -1,7 +1,10 @@
 import logging
+import struct
+import time
 
 import modbus_tk.defines as cst
 
+from electric.circuit_breaker import is_device_absent
 from electric.icharger.models import SystemStorage, WriteDataSegment, OperationResponse, ObjectNotFoundException, BadRequestException
 from modbus_usb import iChargerMaster
 from models import DeviceInfo, ChannelStatus, Control, PresetIndex, Preset, ReadDataSegment
@@ -11,6 +14,95 @@ CHANNEL_INPUT_FOOTER_OFFSET = 51
 CHANNEL_INPUT_CELL_IR_FORMAT = 35
 CHANNEL_INPUT_CELL_BALANCE_OFFSET = 27
 CHANNEL_INPUT_CELL_VOLT_OFFSET = 11
+CHANNEL_INPUT_STATUS_OFFSET = 54
+
+# The parts of the channel input block: (name, offset, data format)
+CHANNEL_INPUT_BLOCKS = (
+    # timestamp -> ext temp
+    ("header", CHANNEL_INPUT_HEADER_OFFSET, "LlhHHlhh"),
+    # cell 0-15 voltage
+    ("cell_volt", CHANNEL_INPUT_CELL_VOLT_OFFSET, "16H"),
+    # cell 0-15 balance
+    ("cell_balance", CHANNEL_INPUT_CELL_BALANCE_OFFSET, "16B"),
+    # cell 0-15 IR
+    ("cell_ir", CHANNEL_INPUT_CELL_IR_FORMAT, "16H"),
+    # total IR -> cycle count
+    ("counters", CHANNEL_INPUT_FOOTER_OFFSET, "3H"),
+    # control status -> dialog box ID
+    ("status", CHANNEL_INPUT_STATUS_OFFSET, "4H"),
+)
+
+# Stands in for a part that wasn't read
+CHANNEL_INPUT_PLACEHOLDERS = dict(
+    (name, (0,) * len(struct.unpack("=" + data_format, "\0" * struct.calcsize("=" + data_format))))
+    for (name, offset, data_format) in CHANNEL_INPUT_BLOCKS)
+
+# The channel input parts grouped by how quickly they change: (tier, part names, max age).  A tiered read of
+# the channel status only reads the tiers older than their max age (in seconds).  The live tier - the header
+# and the cell voltages - is the first 27 registers, a single transaction where the whole block takes two.
+# The status isn't live: the poller only reads tiered while the device info's status bits for the channels
+# (run, error, dialog box...) are unchanged, and reads everything as soon as they change.
+CHANNEL_INPUT_TIERS = (
+    ("live", ("header", "cell_volt"), 0.0),
+    ("slow", ("cell_balance", "cell_ir", "counters", "status"), 2.0),
+)
+
+# The channel input parts each field of the ChannelStatus (by JSON name) is decoded from, so that a request
+# for some of the fields only reads what they need
+CHANNEL_FIELD_BLOCKS = {
+    "channel": (),
+    "timestamp": ("header",),
+    "curr_out_power": ("header",),
+    "curr_out_amps": ("header",),
+    "curr_inp_volts": ("header",),
+    "curr_out_volts": ("header",),
+    "curr_out_capacity": ("header",),
+    "curr_int_temp": ("header",),
+    "curr_ext_temp": ("header",),
+    "cells": ("cell_volt", "cell_balance", "cell_ir"),
+    "cell_total_voltage": ("cell_volt",),
+    "cell_count_with_voltage_values": ("cell_volt",),
+    "cell_total_ir": ("counters",),
+    "line_intern_resistance": ("counters",),
+    "cycle_count": ("counters",),
+    "control_status": ("status",),
+    "run_status": ("status",),
+    "run_error": ("status",),
+    "dlg_box_id": ("status",),
+    "battery_plugged_in": ("header", "cell_volt"),
+    "balance_leads_plugged_in": ("cell_volt",),
+}
+
+# ... and for the fields of each cell, which only exists if its voltage is read
+CELL_FIELD_BLOCKS = {
+    "cell": ("cell_volt",),
+    "v": ("cell_volt",),
+    "balance": ("cell_volt", "cell_balance"),
+    "ir": ("cell_volt", "cell_ir"),
+}
+
+
+def channel_blocks_for(fields):
+    """
+    The names of the channel input parts needed for the fields (as parsed by projection.parse_fields)
+    """
+    if fields is None:
+        return set(name for (name, offset, data_format) in CHANNEL_INPUT_BLOCKS)
+
+    blocks = set()
+    for (name, sub_fields) in fields.items():
+        if name not in CHANNEL_FIELD_BLOCKS:
+            raise ValueError("Unknown field {0}".format(name))
+
+        if name == "cells" and sub_fields is not None:
+            for cell_field in sub_fields:
+                if cell_field not in CELL_FIELD_BLOCKS:
+                    raise ValueError("Unknown field cells.{0}".format(cell_field))
+                blocks.update(CELL_FIELD_BLOCKS[cell_field])
+        else:
+            blocks.update(CHANNEL_FIELD_BLOCKS[name])
+    return blocks
+
 
 # see the helper/main.cpp module I created that tells me these
 # offset values more reliably than Mr Blind Man.
@@ -54,14 +146,65 @@ class ChargerCommsManager(object):
     """
     locking = False
 
-    def __init__(self, master=None):
+    def __init__(self, master=None, preset_generation=None):
         if master is None:
             master = iChargerMaster()
         self.charger = master
 
+        # Presets only change when we write them (or someone uses the charger's own UI, see
+        # invalidate_preset_cache), so the index and the raw segments of each preset are cached.
+        self._preset_index_data = None
+        self._preset_segments = {}
+
+        # A multiprocessing.Value shared by every process with its own manager (and cache) for the same
+        # charger.  It's bumped whenever one of them changes the presets, telling the others to drop theirs.
+        self.preset_generation = preset_generation
+        self._seen_preset_generation = preset_generation.value if preset_generation is not None else None
+
+        # (channel, part) -> (time read, data), see get_channel_status
+        self._channel_blocks = {}
+
     def reset(self):
+        self._drop_preset_cache()
+        self.invalidate_channel_cache()
         self.charger.reset()
 
+    def recover(self, failures, ex=None):
+        """
+        Called after a failed request, see iChargerMaster.recover().  A charger that has gone away is always
+        closed and opened again.  Only this manager's own preset cache is dropped, recovering the transport
+        doesn't change the presets - so the other processes' caches are left alone.
+        """
+        self._drop_preset_cache()
+        self.invalidate_channel_cache()
+        self.charger.recover(failures, reopen=ex is not None and is_device_absent(ex))
+
+    def recent_transactions(self):
+        return self.charger.recent_transactions()
+
+    def invalidate_channel_cache(self):
+        self._channel_blocks = {}
+
+    def invalidate_preset_cache(self):
+        """Drops the cached presets, in every process sharing the preset_generation"""
+        self._drop_preset_cache()
+        self._presets_changed()
+
+    def _drop_preset_cache(self):
+        self._preset_index_data = None
+        self._preset_segments = {}
+
+    def _presets_changed(self):
+        if self.preset_generation is not None:
+            with self.preset_generation.get_lock():
+                self.preset_generation.value += 1
+                self._seen_preset_generation = self.preset_generation.value
+
+    def _check_preset_cache(self):
+        if self.preset_generation is not None and self.preset_generation.value != self._seen_preset_generation:
+            self._drop_preset_cache()
+            self._seen_preset_generation = self.preset_generation.value
+
     def get_device_info(self):
         """
         Returns the following information from the iCharger, known as the 'device only reads message'
@@ -70,38 +213,46 @@ class ChargerCommsManager(object):
         vars = ReadDataSegment(self.charger, "vars", "h12sHHHHHH", base=0x0000)
         return DeviceInfo(vars.data)
 
-    def get_channel_status(self, channel, device_id=None):
+    def get_channel_status(self, channel, device_id=None, tiered=False, blocks=None):
         """"
         Returns the following information from the iCharger, known as the 'channel input read only' message:
+        :param tiered: only read the parts of the channel input that are older than allowed by
+        CHANNEL_INPUT_TIERS, reusing the rest from earlier reads
+        :param blocks: the names of the parts of the channel input to read (see channel_blocks_for), the fields
+        decoded from the others are zero
         :return: ChannelStatus instance
         """
         addr = 0x100 if channel == 0 else 0x200
-
-        # timestamp -> ext temp
-        header_fmt = "LlhHHlhh"
-        header_data = self.charger.modbus_read_registers(addr, header_fmt)
-
-        # cell 0-15 voltage
-        cell_volt_fmt = "16H"
-        cell_volt_addr = addr + CHANNEL_INPUT_CELL_VOLT_OFFSET
-        cell_volt = self.charger.modbus_read_registers(cell_volt_addr, cell_volt_fmt)
-
-        # cell 0-15 balance
-        cell_balance_fmt = "16B"
-        cell_balance_addr = addr + CHANNEL_INPUT_CELL_BALANCE_OFFSET
-        cell_balance = self.charger.modbus_read_registers(cell_balance_addr, cell_balance_fmt)
-
-        # cell 0-15 IR
-        cell_ir_fmt = "16H"
-        cell_ir_addr = addr + CHANNEL_INPUT_CELL_IR_FORMAT
-        cell_ir = self.charger.modbus_read_registers(cell_ir_addr, cell_ir_fmt)
-
-        # total IR -> dialog box ID
-        footer_fmt = "7H"
-        footer_addr = addr + CHANNEL_INPUT_FOOTER_OFFSET
-        footer = self.charger.modbus_read_registers(footer_addr, footer_fmt)
-
-        return ChannelStatus.modbus(device_id, channel, header_data, cell_volt, cell_balance, cell_ir, footer)
+        now = time.time()
+
+        data = {}
+        if tiered:
+            fresh_tiers = 0
+            for (tier, names, max_age) in CHANNEL_INPUT_TIERS:
+                cached = [self._channel_blocks.get((channel, name)) for name in names]
+                if all(entry is not None and now - entry[0] < max_age for entry in cached):
+                    fresh_tiers += 1
+                    data.update((name, entry[1]) for (name, entry) in zip(names, cached))
+
+            # the rest of the block is spread over both transactions, reading any more than the live tier costs
+            # the same as reading it all
+            if fresh_tiers < len(CHANNEL_INPUT_TIERS) - 1:
+                data = {}
+
+        due = [(name, offset, data_format) for (name, offset, data_format) in CHANNEL_INPUT_BLOCKS
+               if name not in data and (blocks is None or name in blocks)]
+        if due:
+            results = self.charger.modbus_read_blocks(
+                [(addr + offset, data_format) for (name, offset, data_format) in due])
+            for ((name, offset, data_format), result) in zip(due, results):
+                data[name] = result
+                self._channel_blocks[(channel, name)] = (now, result)
+
+        for (name, placeholder) in CHANNEL_INPUT_PLACEHOLDERS.items():
+            data.setdefault(name, placeholder)
+
+        return ChannelStatus.modbus(device_id, channel, data["header"], data["cell_volt"], data["cell_balance"],
+                                    data["cell_ir"], data["counters"] + data["status"])
 
     def get_control_register(self):
         "Returns the current run state of a particular channel"
@@ -136,11 +287,12 @@ class ChargerCommsManager(object):
     def get_system_storage(self):
         """Returns the system storage area of the iCharger"""
         # temp-unit -> beep-vol
-        ds1 = ReadDataSegment(self.charger, "vars1", "21H", base=0x8400)
+        ds1 = ReadDataSegment(self.charger, "vars1", "21H", base=0x8400, deferred=True)
         # dump3 -> reg current limit
-        ds2 = ReadDataSegment(self.charger, "vars2", "13H", prev_format=ds1)
+        ds2 = ReadDataSegment(self.charger, "vars2", "13H", prev_format=ds1, deferred=True)
         # charge/discharge power -> modbus_serial_parity
-        ds3 = ReadDataSegment(self.charger, "vars3", "17H", prev_format=ds2)
+        ds3 = ReadDataSegment(self.charger, "vars3", "17H", prev_format=ds2, deferred=True)
+        ReadDataSegment.read_all(self.charger, (ds1, ds2, ds3))
 
         return SystemStorage.modbus(ds1, ds2, ds3)
 
@@ -171,6 +323,8 @@ class ChargerCommsManager(object):
 
     def save_full_preset_list(self, preset_list):
         (v1, v2) = preset_list.to_modbus_data()
+        self._preset_index_data = None
+        self._presets_changed()
 
         # Write the thing to RAM. Moo.
         part1 = WriteDataSegment(self.charger, "part1", v1, "H32B", base=0x8800)
@@ -184,35 +338,54 @@ class ChargerCommsManager(object):
         return True
 
     def get_full_preset_list(self):
-        (count,) = self.charger.modbus_read_registers(0x8800, "H", function_code=cst.READ_HOLDING_REGISTERS)
-
-        # There are apparently 64 indexes. Apparently.
-        read_a_bit_format = "32B"
-        data_1 = self.charger.modbus_read_registers(0x8800 + 1, read_a_bit_format, function_code=cst.READ_HOLDING_REGISTERS)
-        data_2 = self.charger.modbus_read_registers(0x8800 + 16, read_a_bit_format, function_code=cst.READ_HOLDING_REGISTERS)
-        list_of_all_indexes = list(data_1)
-        list_of_all_indexes.extend(list(data_2))
+        """
+        Returns the preset index, a new PresetIndex each time so the caller is free to modify it.
+        """
+        self._check_preset_cache()
+        if self._preset_index_data is None:
+            # There are apparently 64 indexes. Apparently.
+            read_a_bit_format = "32B"
+            ((count,), data_1, data_2) = self.charger.modbus_read_blocks([
+                (0x8800, "H"),
+                (0x8800 + 1, read_a_bit_format),
+                (0x8800 + 16, read_a_bit_format),
+            ], function_code=cst.READ_HOLDING_REGISTERS)
+            list_of_all_indexes = list(data_1)
+            list_of_all_indexes.extend(list(data_2))
+            self._preset_index_data = (count, list_of_all_indexes)
+
+        (count, list_of_all_indexes) = self._preset_index_data
         return PresetIndex.modbus(count, list_of_all_indexes)
 
-    def get_preset(self, memory_slot_number):
+    def get_preset(self, memory_slot_number, use_cache=True):
+        """
+        Returns the preset in a memory slot.  When it is read from the charger (use_cache=False, or it isn't
+        cached yet) the preset is left selected, i.e. loaded into the RAM window at 0x8c00.
+        """
         # First, load the indicies and see if in fact this is mapped. If not, don't bother even trying
         preset_index = self.get_full_preset_list()
         if preset_index.index_of_preset_with_memory_slot_number(memory_slot_number) is None:
             message = "No preset is mapped with slot number {0}".format(memory_slot_number)
             raise ObjectNotFoundException(message)
 
+        segments = self._preset_segments.get(memory_slot_number)
+        if use_cache and segments is not None:
+            return Preset.modbus(memory_slot_number, *segments)
+
         result = self.select_memory_program(memory_slot_number)
 
         # use-flag -> channel mode
-        vars1 = ReadDataSegment(self.charger, "vars1", "H38sLBB7cHB", base=0x8c00)
+        vars1 = ReadDataSegment(self.charger, "vars1", "H38sLBB7cHB", base=0x8c00, deferred=True)
         # save to sd -> bal-set-point
-        vars2 = ReadDataSegment(self.charger, "vars2", "BHH12BHBBB", prev_format=vars1)
+        vars2 = ReadDataSegment(self.charger, "vars2", "BHH12BHBBB", prev_format=vars1, deferred=True)
         # bal-delay, keep-charge-enable -> reg discharge mode
-        vars3 = ReadDataSegment(self.charger, "vars3", "BB14H", prev_format=vars2)
+        vars3 = ReadDataSegment(self.charger, "vars3", "BB14H", prev_format=vars2, deferred=True)
         # ni-peak -> cycle-delay
-        vars4 = ReadDataSegment(self.charger, "vars4", "16H", prev_format=vars3)
+        vars4 = ReadDataSegment(self.charger, "vars4", "16H", prev_format=vars3, deferred=True)
         # cycle-mode -> ni-zn-cell
-        vars5 = ReadDataSegment(self.charger, "vars5", "B6HB2HB3HB", prev_format=vars4)
+        vars5 = ReadDataSegment(self.charger, "vars5", "B6HB2HB3HB", prev_format=vars4, deferred=True)
+        ReadDataSegment.read_all(self.charger, (vars1, vars2, vars3, vars4, vars5))
+        self._preset_segments[memory_slot_number] = (vars1, vars2, vars3, vars4, vars5)
 
         preset = Preset.modbus(memory_slot_number, vars1, vars2, vars3, vars4, vars5)
 
@@ -245,6 +418,8 @@ class ChargerCommsManager(object):
 
         # Set this preset (slot) used flag to "EMPTY (useflag = 0xffff") in RAM
         logger.info("Setting slot {0} unused flag".format(preset_memory_slot_number))
+        self._preset_segments.pop(preset_memory_slot_number, None)
+        self._presets_changed()
         self.select_memory_program(preset_memory_slot_number)
         store = self.charger.modbus_write_registers(0x8c00, (0xffff,))
 
@@ -291,11 +466,12 @@ class ChargerCommsManager(object):
         # and we want to ignore any older data that may be in that slot.
         if verify_write:
             # Get the preset and verify we can write
-            # This has a side effect of self.select_memory_program(memory_slot)
             existing_preset = self.get_preset(memory_slot)
             existing_preset.verify_can_be_written_or_deleted()
-        else:
-            self.select_memory_program(memory_slot)
+
+        self._preset_segments.pop(memory_slot, None)
+        self._presets_changed()
+        self.select_memory_program(memory_slot)
 
         # ask the preset for its data segments
         (v1, v2, v3, v4, v5) = preset.to_modbus_data()
@@ -317,6 +493,8 @@ class ChargerCommsManager(object):
 
     def take_out_order_lock(self, message="<unknown reason>"):
         logger.info("Taking out order lock: {0}".format(message))
+        # whatever the order is, it can change any part of the channel status
+        self.invalidate_channel_cache()
         self.charger.modbus_write_registers(0x8000 + 3, (VALUE_ORDER_LOCK,))
 
     def release_order_lock(self):
@@ -356,7 +534,7 @@ class ChargerCommsManager(object):
         # is not available.
         # It'll also be loaded into RAM.
         logger.info("Begin operation {0} on channel {1} using slot {2}".format(operation, channel_number, preset_memory_slot_index))
-        self.get_preset(preset_memory_slot_index)
+        self.get_preset(preset_memory_slot_index, use_cache=False)
 
         self.take_out_order_lock("charging")
 
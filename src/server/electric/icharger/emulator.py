@@ -0,0 +1,498 @@
+import collections
+import logging
+import struct
+import threading
+import time
+
+import modbus_tk.defines as cst
+
+from electric import metrics
+from electric.icharger.comms_layer import VALUE_ORDER_LOCK, Order, Operation, CHANNEL_INPUT_CELL_VOLT_OFFSET, \
+    CHANNEL_INPUT_CELL_BALANCE_OFFSET, CHANNEL_INPUT_CELL_IR_FORMAT, CHANNEL_INPUT_FOOTER_OFFSET
+from electric.icharger.models import DEVICEID_4010_DUO, STATUS_RUN, STATUS_CONTROL_STATUS, STATUS_RUN_STATUS, \
+    Preset
+from electric.icharger.modbus_usb import MODBUS_HID_FRAME_TYPE, MAX_READWRITE_LEN, READ_REG_COUNT_MAX, \
+    WRITE_REG_COUNT_MAX, testing_control
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+MB_EX_ILLEGAL_FUNCTION = 0x01
+MB_EX_ILLEGAL_DATA_ADDRESS = 0x02
+MB_EX_ILLEGAL_DATA_VALUE = 0x03
+
+# Register map, word addresses
+DEVICE_INFO_BASE = 0x0000
+CHANNEL_INPUT_BASE = (0x100, 0x200)
+CONTROL_BASE = 0x8000
+SYSTEM_STORAGE_BASE = 0x8400
+PRESET_INDEX_BASE = 0x8800
+PRESET_RAM_BASE = 0x8c00
+
+# Offsets (in words) of the control registers
+CONTROL_OP = 0
+CONTROL_MEMORY = 1
+CONTROL_CHANNEL = 2
+CONTROL_ORDER_LOCK = 3
+CONTROL_ORDER = 4
+
+DEVICE_INFO_FORMAT = "=h12sHHHHHH"
+DEVICE_INFO_STATUS_OFFSET = 11
+CHANNEL_HEADER_FORMAT = "=LlhHHlhh"
+CHANNEL_FOOTER_FORMAT = "=7H"
+CHANNEL_CELL_MAX = 16
+
+SYSTEM_STORAGE_FORMAT = "=21H13H17H"
+PRESET_FORMATS = ("=H38sLBB7cHB", "=BHH12BHBBB", "=BB14H", "=16H", "=B6HB2HB3HB")
+PRESET_SIZE = sum(struct.calcsize(fmt) for fmt in PRESET_FORMATS)
+PRESET_SLOT_COUNT = 64
+PRESET_CHARGE_CURRENT_OFFSET = struct.calcsize(PRESET_FORMATS[0]) + struct.calcsize(PRESET_FORMATS[1]) + \
+                               struct.calcsize("=BB9H")
+PRESET_UNUSED = 0xffff
+
+# Channel footer values while an operation is in progress
+RUN_STATUS_RUNNING = 1
+CONTROL_STATUS_RUNNING = 1
+
+DEFAULT_SYSTEM_STORAGE = (
+    # temp-unit -> beep-vol
+    0, 750, 400, 10, 0, 2, 16, 17, 0, 0, 0, 0, 0, 1, 1, 1, 1, 5, 5, 5, 5,
+    # dump3 -> reg current limit
+    0, 0, 0, 0, 100, 305, 600, 100, 305, 600, 1, 145, 100,
+    # charge/discharge power -> modbus_serial_parity
+    800, 800, 80, 80, 0, 10, 10, 1, 1, 0, 15000, 50, 5000, 0, 1, 0, 0,
+)
+
+DEFAULT_PRESET = {
+    "index": 0, "use_flag": 0x55aa, "name": "LiPo", "capacity": 2200, "auto_save": 1,
+    "li_balance_end_mode": 0, "op_enable_mask": 0xff, "channel_mode": 0, "save_to_sd": 1,
+    "log_interval_sec": 1.0, "run_counter": 0, "type": 0, "li_cell": 0, "ni_cell": 0, "pb_cell": 6,
+    "li_mode_c": 0, "li_mode_d": 1, "ni_mode_c": 0, "ni_mode_d": 0, "pb_mode_c": 0, "pb_mode_d": 0,
+    "bal_speed": 1, "bal_start_mode": 2, "bal_start_voltage": 3.5, "bal_diff": 5, "bal_over_point": 0,
+    "bal_set_point": 5, "bal_delay": 1, "keep_charge_enable": 0,
+    "lipo_charge_cell_voltage": 4.2, "lilo_charge_cell_voltage": 4.1, "life_charge_cell_voltage": 3.6,
+    "lipo_storage_cell_voltage": 3.85, "lilo_storage_cell_voltage": 3.75, "life_storage_cell_voltage": 3.3,
+    "lipo_discharge_cell_voltage": 3.5, "lilo_discharge_cell_voltage": 3.5, "life_discharge_cell_voltage": 2.5,
+    "charge_current": 2.0, "discharge_current": 2.0, "end_charge": 10, "end_discharge": 50,
+    "regen_discharge_mode": 0, "ni_peak": 3, "ni_peak_delay": 3, "ni_trickle_enable": 0,
+    "ni_trickle_current": 0.05, "ni_trickle_time": 5, "ni_zero_enable": 0, "ni_discharge_voltage": 0.8,
+    "pb_charge_voltage": 2.4, "pb_discharge_voltage": 1.8, "pb_cell_float_enable": 0,
+    "pb_cell_float_voltage": 2.3, "restore_voltage": 1.0, "restore_time": 3, "restore_current": 0.1,
+    "cycle_count": 3, "cycle_delay": 3, "cycle_mode": 0, "safety_time_c": 0, "safety_cap_c": 120,
+    "safety_temp_c": 45.0, "safety_time_d": 0, "safety_cap_d": 90, "safety_temp_d": 45.0, "reg_ch_mode": 0,
+    "reg_ch_volt": 12.0, "reg_ch_current": 1, "fast_store": 1, "store_compensation": 0.1,
+    "ni_zn_charge_cell_volt": 1.9, "ni_zn_discharge_cell_volt": 1.1, "ni_zn_cell": 0,
+}
+
+
+def pack_preset(preset):
+    """Packs a Preset into the byte layout the charger keeps in its preset RAM window"""
+    return "".join(struct.pack(fmt, *values) for (fmt, values) in zip(PRESET_FORMATS, preset.to_modbus_data()))
+
+
+class RegisterBlock(object):
+    """
+    A contiguous range of 16 bit registers.  The data is kept in the same little-endian C struct layout
+    the charger uses internally, the conversion to big-endian modbus words only happens on the wire.
+    """
+
+    def __init__(self, base, word_count):
+        self.base = base
+        self.word_count = word_count
+        self.data = bytearray(word_count * 2)
+
+    def contains(self, addr, quantity):
+        return self.base <= addr and addr + quantity <= self.base + self.word_count
+
+    def read_wire(self, addr, quantity):
+        start = (addr - self.base) * 2
+        wire = bytearray(quantity * 2)
+        wire[0::2] = self.data[start + 1:start + quantity * 2:2]
+        wire[1::2] = self.data[start:start + quantity * 2:2]
+        return wire
+
+    def write_wire(self, addr, wire):
+        start = (addr - self.base) * 2
+        self.data[start:start + len(wire):2] = wire[1::2]
+        self.data[start + 1:start + len(wire):2] = wire[0::2]
+
+    def pack(self, offset, fmt, *values):
+        struct.pack_into(fmt, self.data, offset * 2, *values)
+
+    def unpack(self, offset, fmt):
+        return struct.unpack_from(fmt, buffer(self.data), offset * 2)
+
+
+class ChannelSimulation(object):
+    """Very rough model of a pack on a channel, just enough to make the telemetry move while an operation runs"""
+
+    def __init__(self, cell_count):
+        self.cell_count = cell_count
+        self.cells = [3800] * cell_count
+        self.running = False
+        self.operation = 0
+        self.amps = 0
+        self.capacity = 0
+
+    def start(self, operation, preset_current):
+        self.running = True
+        self.operation = operation
+        self.amps = int(preset_current)
+        self.capacity = 0
+
+    def stop(self):
+        self.running = False
+        self.amps = 0
+
+    def target_mv(self):
+        if self.operation == Operation.Storage:
+            return 3850
+        if self.operation == Operation.Discharge:
+            return 3500
+        if self.operation == Operation.Balance:
+            return sum(self.cells) // max(1, len(self.cells))
+        return 4200
+
+    def step(self):
+        if not self.running:
+            return
+
+        target = self.target_mv()
+        done = True
+        for (i, mv) in enumerate(self.cells):
+            if mv < target:
+                self.cells[i] = mv + 1
+                done = False
+            elif mv > target:
+                self.cells[i] = mv - 1
+                done = False
+
+        self.capacity += max(1, self.amps // 100)
+        if done:
+            self.stop()
+
+
+class iChargerEmulator(object):
+    """
+    In-process software charger that serves the iCharger register map over the same HID framing as the
+    real device: requests are <ADU len> 0x30 <PDU>, read responses carry big-endian register words which
+    iChargerQuery byte swaps back to the native struct layout.
+
+    Each instance holds its own register map, so any number of independent chargers can be created.
+    """
+
+    def __init__(self, device_id=DEVICEID_4010_DUO, serial_number="EMU00000001", cell_count=6):
+        self.device_id = device_id
+        self.serial_number = serial_number
+        self.started = time.time()
+        self.transactions = 0
+
+        self._lock = threading.Lock()
+
+        self.input_blocks = [
+            RegisterBlock(DEVICE_INFO_BASE, 16),
+            RegisterBlock(CHANNEL_INPUT_BASE[0], 64),
+            RegisterBlock(CHANNEL_INPUT_BASE[1], 64),
+        ]
+        self.holding_blocks = [
+            RegisterBlock(CONTROL_BASE, 16),
+            RegisterBlock(SYSTEM_STORAGE_BASE, 64),
+            RegisterBlock(PRESET_INDEX_BASE, 64),
+            RegisterBlock(PRESET_RAM_BASE, 128),
+        ]
+
+        self.channels = [ChannelSimulation(cell_count), ChannelSimulation(cell_count)]
+
+        self.preset_slots = [None] * PRESET_SLOT_COUNT
+        self.selected_slot = 0
+
+        self._load_defaults()
+
+    @property
+    def device_info(self):
+        return self.input_blocks[0]
+
+    @property
+    def control(self):
+        return self.holding_blocks[0]
+
+    @property
+    def system_storage(self):
+        return self.holding_blocks[1]
+
+    @property
+    def preset_index(self):
+        return self.holding_blocks[2]
+
+    @property
+    def preset_ram(self):
+        return self.holding_blocks[3]
+
+    def _load_defaults(self):
+        system_len = struct.calcsize(SYSTEM_STORAGE_FORMAT)
+        self.device_info.pack(0, DEVICE_INFO_FORMAT, self.device_id, self.serial_number, 0x0122, 0x0101,
+                              system_len, PRESET_SIZE, 0, 0)
+        self.system_storage.pack(0, SYSTEM_STORAGE_FORMAT, *DEFAULT_SYSTEM_STORAGE)
+
+        unused = bytearray(PRESET_SIZE)
+        struct.pack_into("=H", unused, 0, PRESET_UNUSED)
+        for slot in range(0, PRESET_SLOT_COUNT):
+            self.preset_slots[slot] = bytearray(unused)
+        self.preset_slots[0] = bytearray(pack_preset(Preset(DEFAULT_PRESET)))
+
+        indexes = [0] + [255] * (PRESET_SLOT_COUNT - 1)
+        self.preset_index.pack(0, "=H64B", 1, *indexes)
+
+        self._select_memory_slot(0)
+        for channel in (0, 1):
+            self._refresh_channel(channel)
+
+    def transact(self, request):
+        """
+        Handles a single request frame (without the HID report id) and returns the 64 byte response frame.
+        """
+        with self._lock:
+            self.transactions += 1
+            frame = bytearray(request)
+            if len(frame) < 7 or frame[1] != MODBUS_HID_FRAME_TYPE:
+                return self._error_frame(frame[2] if len(frame) > 2 else 0, MB_EX_ILLEGAL_FUNCTION)
+
+            (func_code, addr, quantity) = struct.unpack_from(">BHH", buffer(frame), 2)
+
+            if func_code in (cst.READ_INPUT_REGISTERS, cst.READ_HOLDING_REGISTERS):
+                return self._read_registers(func_code, addr, quantity)
+
+            if func_code == cst.WRITE_MULTIPLE_REGISTERS:
+                return self._write_registers(addr, quantity, frame[8:8 + quantity * 2])
+
+            return self._error_frame(func_code, MB_EX_ILLEGAL_FUNCTION)
+
+    @staticmethod
+    def _frame(payload):
+        response = bytearray(MAX_READWRITE_LEN)
+        response[0] = len(payload) + 2
+        response[1] = MODBUS_HID_FRAME_TYPE
+        response[2:2 + len(payload)] = payload
+        return bytes(response)
+
+    def _error_frame(self, func_code, error):
+        logger.debug("Emulator {0} error response {1} for func {2}".format(self.serial_number, error, func_code))
+        return self._frame(bytearray((func_code | 0x80, error)))
+
+    @staticmethod
+    def _find_block(blocks, addr, quantity):
+        for block in blocks:
+            if block.contains(addr, quantity):
+                return block
+        return None
+
+    def _read_registers(self, func_code, addr, quantity):
+        if quantity < 1 or quantity > READ_REG_COUNT_MAX:
+            return self._error_frame(func_code, MB_EX_ILLEGAL_DATA_VALUE)
+
+        blocks = self.input_blocks if func_code == cst.READ_INPUT_REGISTERS else self.holding_blocks
+        block = self._find_block(blocks, addr, quantity)
+        if block is None:
+            return self._error_frame(func_code, MB_EX_ILLEGAL_DATA_ADDRESS)
+
+        for channel in (0, 1):
+            if block.base == CHANNEL_INPUT_BASE[channel]:
+                self._refresh_channel(channel)
+
+        return self._frame(bytearray((func_code, quantity * 2)) + block.read_wire(addr, quantity))
+
+    def _write_registers(self, addr, quantity, wire):
+        if quantity < 1 or quantity > WRITE_REG_COUNT_MAX or len(wire) != quantity * 2:
+            return self._error_frame(cst.WRITE_MULTIPLE_REGISTERS, MB_EX_ILLEGAL_DATA_VALUE)
+
+        block = self._find_block(self.holding_blocks, addr, quantity)
+        if block is None:
+            return self._error_frame(cst.WRITE_MULTIPLE_REGISTERS, MB_EX_ILLEGAL_DATA_ADDRESS)
+
+        block.write_wire(addr, wire)
+
+        if block is self.control:
+            self._control_written(addr - CONTROL_BASE, quantity)
+
+        return self._frame(bytearray(struct.pack(">BHH", cst.WRITE_MULTIPLE_REGISTERS, addr, quantity)))
+
+    def _control_register(self, offset):
+        return self.control.unpack(offset, "=H")[0]
+
+    def _control_written(self, offset, quantity):
+        end = offset + quantity
+        if offset <= CONTROL_MEMORY < end:
+            self._select_memory_slot(self._control_register(CONTROL_MEMORY))
+
+        if offset <= CONTROL_ORDER < end and self._control_register(CONTROL_ORDER_LOCK) == VALUE_ORDER_LOCK:
+            self._execute_order(self._control_register(CONTROL_ORDER))
+
+    def _select_memory_slot(self, slot):
+        if 0 <= slot < PRESET_SLOT_COUNT:
+            self.selected_slot = slot
+            self.preset_ram.data[0:PRESET_SIZE] = self.preset_slots[slot]
+
+    def _execute_order(self, order):
+        channel = min(1, self._control_register(CONTROL_CHANNEL))
+        if order == Order.Run:
+            preset = self.preset_slots[self._control_register(CONTROL_MEMORY) % PRESET_SLOT_COUNT]
+            charge_current = struct.unpack_from("=H", buffer(preset), PRESET_CHARGE_CURRENT_OFFSET)[0]
+            self.channels[channel].start(self._control_register(CONTROL_OP), charge_current)
+        elif order == Order.Stop:
+            self.channels[channel].stop()
+        elif order == Order.WriteMem:
+            self.preset_slots[self.selected_slot] = bytearray(self.preset_ram.data[0:PRESET_SIZE])
+
+        # WriteSys, WriteMemHead and the message box orders have nothing further to do, the RAM is the flash
+        self._refresh_channel(channel)
+
+    def _refresh_channel(self, channel):
+        sim = self.channels[channel]
+        sim.step()
+
+        block = self.input_blocks[1 + channel]
+        timestamp = int((time.time() - self.started) * 1000) & 0xffffffff
+        pack_mv = sum(sim.cells)
+        power = (pack_mv * sim.amps) // 100
+        block.pack(0, CHANNEL_HEADER_FORMAT, timestamp, power, sim.amps, 12000, pack_mv, sim.capacity, 250, 0)
+
+        cells = sim.cells + [0] * (CHANNEL_CELL_MAX - sim.cell_count)
+        block.pack(CHANNEL_INPUT_CELL_VOLT_OFFSET, "=16H", *cells)
+        block.pack(CHANNEL_INPUT_CELL_BALANCE_OFFSET, "=16B", *([0] * CHANNEL_CELL_MAX))
+        cell_ir = [25] * sim.cell_count + [0] * (CHANNEL_CELL_MAX - sim.cell_count)
+        block.pack(CHANNEL_INPUT_CELL_IR_FORMAT, "=16H", *cell_ir)
+
+        running = 1 if sim.running else 0
+        block.pack(CHANNEL_INPUT_FOOTER_OFFSET, CHANNEL_FOOTER_FORMAT, 25 * sim.cell_count, 10, 0,
+                   CONTROL_STATUS_RUNNING * running, RUN_STATUS_RUNNING * running, 0, 0)
+
+        status = (STATUS_RUN | STATUS_CONTROL_STATUS | STATUS_RUN_STATUS) if sim.running else 0
+        self.device_info.pack(DEVICE_INFO_STATUS_OFFSET + channel, "=H", status)
+
+
+class EmulatorSerialFacade(object):
+    """
+    Drop-in replacement for USBSerialFacade that talks to an iChargerEmulator instead of a USB-HID device, e.g.
+
+        master = iChargerMaster(serial=EmulatorSerialFacade(latency=0.004))
+
+    The latency (in seconds) is applied to every transaction to mimic the USB round trip.
+    """
+
+    def __init__(self, charger=None, latency=0.0):
+        if charger is None:
+            charger = iChargerEmulator()
+
+        self.charger = charger
+        self.latency = latency
+
+        self._opened = False
+
+        # responses not yet read - as in the HID input queue, a failed request can leave one behind
+        self._responses = collections.deque()
+
+    def reset(self):
+        metrics.transport_resets.inc()
+        self.close()
+        self.open()
+        return True
+
+    @property
+    def serial_number(self):
+        if self._opened:
+            return self.charger.serial_number
+        return "<not yet opened - no serial number>"
+
+    @property
+    def is_open(self):
+        return self._opened
+
+    @property
+    def name(self):
+        if self._opened:
+            return "iCharger Emulator SN:" + self.serial_number
+        return "! iCharger Not Connected !"
+
+    def open(self):
+        self._opened = True
+        return True
+
+    def close(self):
+        self._opened = False
+        self._responses.clear()
+        return True
+
+    @property
+    def timeout(self):
+        return 5000
+
+    @timeout.setter
+    def timeout(self, new_timeout):
+        pass
+
+    @property
+    def baudrate(self):
+        """As this is a serial facade, we return a totally fake baudrate here"""
+        return 19200
+
+    @property
+    def valid(self):
+        return True
+
+    def reset_input_buffer(self):
+        self._responses.clear()
+
+    def drain_input(self):
+        drained = len(self._responses)
+        self._responses.clear()
+        return drained
+
+    def reset_output_buffer(self):
+        """There are no internal buffers so this method is a no-op"""
+        pass
+
+    def write(self, payload):
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON WRITE, CHARGER NOT PRESENT")
+
+        if not self._opened:
+            raise IOError("Device write failure - emulator not opened")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        self._responses.append(self.charger.transact(payload))
+        return MAX_READWRITE_LEN + 1
+
+    def read(self, expected_length):
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON READ, CHARGER NOT PRESENT")
+
+        if not self._responses:
+            raise IOError("Device read failure - no response pending")
+
+        response = self._responses.popleft()
+        return response[:expected_length]
+
+    def write_report(self, report):
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON WRITE, CHARGER NOT PRESENT")
+
+        if not self._opened:
+            raise IOError("Device write failure - emulator not opened")
+
+        if self.latency:
+            time.sleep(self.latency)
+
+        # skip the report id, the emulator deals in frames
+        self._responses.append(self.charger.transact(buffer(report, 1)))
+        return len(report)
+
+    def read_report(self):
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON READ, CHARGER NOT PRESENT")
+
+        if not self._responses:
+            raise IOError("Device read failure - no response pending")
+
+        response = self._responses.popleft()
+        return bytearray(response)
@@ -1,13 +1,17 @@
 import array
+import bisect
 import hid
 import logging
 import struct
+import time
 
 import modbus_tk.defines as cst
 from modbus_tk.exceptions import ModbusInvalidRequestError, ModbusInvalidResponseError
 from modbus_tk.modbus import Query
 from modbus_tk.modbus_rtu import RtuMaster
 
+from electric import flight_recorder, metrics, request_timing
+
 logger = logging.getLogger('electric.app.{0}'.format(__name__))
 
 MEMORY_MAX = 64
@@ -23,11 +27,46 @@ MAX_READWRITE_LEN = 64
 READ_REG_COUNT_MAX = 30
 WRITE_REG_COUNT_MAX = 28
 
+# The largest run of unwanted registers the read planner will read through to join two blocks
+READ_REG_GAP_MAX = 4
+
+# Recovering from a failed transaction: how often a garbled response is retried, how many stale reports are
+# skipped looking for the real response, and how many failures in a row before the device is closed and opened
+TRANSACTION_ATTEMPTS = 2
+STALE_REPORTS_MAX = 2
+REOPEN_AFTER_FAILURES = 3
+
+# Only reads are retried, a write may well have been carried out even though its response was garbled - and
+# writing an order again is not the same as writing it once
+RETRIED_FUNCTION_CODES = (cst.READ_INPUT_REGISTERS, cst.READ_HOLDING_REGISTERS)
+
+# Most input reports thrown away by a single drain
+DRAIN_REPORTS_MAX = 16
+
+# Names for the areas of the register map, used to label the transaction metrics
+REGISTER_BLOCKS = (
+    (0x0000, "device_info"),
+    (0x0100, "channel_1"),
+    (0x0200, "channel_2"),
+    (0x0300, "other"),
+    (0x8000, "control"),
+    (0x8400, "system_storage"),
+    (0x8800, "preset_index"),
+    (0x8c00, "preset"),
+    (0x9000, "other"),
+)
+_register_block_bases = [base for (base, name) in REGISTER_BLOCKS]
+
 
 class TestingControlException(Exception):
     pass
 
 
+class ModbusErrorResponse(ModbusInvalidResponseError):
+    """The charger answered with a modbus exception code - asking again won't help"""
+    pass
+
+
 class TestingControl:
     def __init__(self):
         self.reset()
@@ -83,6 +122,46 @@ def connection_state_dict(exc=None):
     return value
 
 
+def register_block(addr):
+    """Returns the name of the area of the register map that addr is in"""
+    return REGISTER_BLOCKS[max(0, bisect.bisect_right(_register_block_bases, addr) - 1)][1]
+
+
+def _transaction_count(quantity, max_count=READ_REG_COUNT_MAX):
+    return (quantity + max_count - 1) // max_count
+
+
+def plan_register_reads(requests, max_gap=READ_REG_GAP_MAX, max_count=READ_REG_COUNT_MAX):
+    """
+    Works out the fewest register reads that cover a list of (address, data_format) requests.  Blocks that
+    are contiguous or overlap are merged into a single run, blocks separated by no more than max_gap words are
+    merged too as long as reading through the gap doesn't cost an extra transaction.  Each run is then read
+    in chunks of at most max_count registers.
+
+    :param requests: list of (addr, data_format) tuples, formats as per modbus_read_registers
+    :return: list of (start_addr, quantity, [request indexes]) runs
+    """
+    ranges = []
+    for (index, (addr, data_format)) in enumerate(requests):
+        quant = struct.calcsize("=" + data_format) // 2
+        ranges.append((addr, addr + quant, index))
+
+    plan = []
+    for (start, end, index) in sorted(ranges):
+        if plan:
+            (run_start, run_end, members) = plan[-1]
+            gap = start - run_end
+            merged_end = max(end, run_end)
+            if gap <= 0 or (gap <= max_gap and _transaction_count(merged_end - run_start, max_count) <=
+                            _transaction_count(run_end - run_start, max_count) +
+                            _transaction_count(end - start, max_count)):
+                plan[-1] = (run_start, merged_end, members + [index])
+                continue
+        plan.append((start, end, [index]))
+
+    return [(start, end - start, members) for (start, end, members) in plan]
+
+
 #
 # NOTE: This isnt' relevant for Docker based installs - things run as root there anyway.
 #
@@ -98,6 +177,18 @@ def connection_state_dict(exc=None):
 # But you NEED to unplug/plug-in the device for this to work - or REBOOT the pi.
 #
 
+def swap_register_bytes(frame, offset, byte_count):
+    """
+    Returns the register words found in frame[offset:offset + byte_count] as an array('H'), with the byte
+    order of every word swapped.  The frame can be a string, bytearray or anything else that supports the
+    buffer protocol, it isn't copied other than into the array.
+    """
+    words = array.array('H')
+    words.fromstring(buffer(frame, offset, byte_count))
+    words.byteswap()
+    return words
+
+
 class iChargerQuery(Query):
     """
     Subclass of a Query. Adds the Modbus specific part of the protocol for iCharger over USB, which uses
@@ -157,15 +248,11 @@ class iChargerQuery(Query):
         else:
             self.modbus_error = 0
 
-        # primitive byte swap the entire thing... but only if this is the READ INPUT/HOLDING type
+        # byte swap the register words... but only if this is the READ INPUT/HOLDING type
         if self.func_code == cst.READ_HOLDING_REGISTERS or self.func_code == cst.READ_INPUT_REGISTERS:
-            header = response[2:4]
-            data = response[4:]
-            response = header + ''.join([c for t in zip(data[1::2], data[::2]) for c in t])
-        else:
-            response = response[2:]
+            return response[2:4] + swap_register_bytes(response, 4, (len(response) - 4) & ~1).tostring()
 
-        return response
+        return response[2:]
 
     @staticmethod
     def _modbus_error_string(code):
@@ -206,6 +293,7 @@ class USBSerialFacade:
             raise
 
     def reset(self):
+        metrics.transport_resets.inc()
         if self._dev is not None:
             self.close()
             self.open()
@@ -269,11 +357,11 @@ class USBSerialFacade:
             raise IOError("FAKE TEST ON WRITE, CHARGER NOT PRESENT")
 
         if self._dev is not None:
-            pad_len = MAX_READWRITE_LEN - len(payload)
-            data = struct.pack("B", 0)
-            content = list(data + payload + ("\0" * pad_len))
+            # report id 0, the payload, then zero padding out to the full report size
+            report = bytearray(MAX_READWRITE_LEN + 1)
+            report[1:1 + len(payload)] = payload
             try:
-                return self._dev.write([ord(i) for i in content])
+                return self._dev.write(report)
             except Exception, e:
                 logging.info("bad bad bad, %s", e)
 
@@ -284,23 +372,330 @@ class USBSerialFacade:
             raise IOError("FAKE TEST ON READ, CHARGER NOT PRESENT")
 
         if self._dev is not None:
-            data = self._dev.read(MAX_READWRITE_LEN + 1, 5000)
-            return array.array('B', data[:expected_length]).tostring()
+            data = self._dev.read(MAX_READWRITE_LEN + 1, self.timeout)
+            return str(bytearray(data[:expected_length]))
+
+        raise IOError("Device read failure - either not present or not claimed")
+
+    def drain_input(self):
+        """
+        Throws away any input reports already waiting (a late response to an earlier request, say) without
+        blocking.
+        :return: the number of reports thrown away
+        """
+        if self._dev is None or not self._opened:
+            return 0
+
+        drained = 0
+        self._dev.set_nonblocking(1)
+        try:
+            while drained < DRAIN_REPORTS_MAX and self._dev.read(MAX_READWRITE_LEN + 1):
+                drained += 1
+        finally:
+            self._dev.set_nonblocking(0)
+        return drained
+
+    def write_report(self, report):
+        """Writes a complete HID output report (report id followed by the 64 byte frame)"""
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON WRITE, CHARGER NOT PRESENT")
+
+        if self._dev is not None:
+            try:
+                return self._dev.write(report)
+            except Exception, e:
+                logging.info("bad bad bad, %s", e)
+
+        raise IOError("Device write failure - either not present or not claimed")
+
+    def read_report(self):
+        """Reads a complete HID input report, returned as a bytearray starting with the ADU length"""
+        if not testing_control.usb_device_present:
+            raise IOError("FAKE TEST ON READ, CHARGER NOT PRESENT")
+
+        if self._dev is not None:
+            return bytearray(self._dev.read(MAX_READWRITE_LEN + 1, self.timeout))
 
         raise IOError("Device read failure - either not present or not claimed")
 
 
-class iChargerMaster(RtuMaster):
+def read_register_blocks(master, requests, function_code=cst.READ_INPUT_REGISTERS, max_gap=READ_REG_GAP_MAX):
+    """
+    Reads several blocks of registers using as few transactions as possible, see plan_register_reads().
+    Note that a run longer than READ_REG_COUNT_MAX is split on a register boundary, not a block boundary.
+
+    :param master: the master to read with, must provide modbus_read_registers()
+    :param requests: list of (addr, data_format) tuples, each as you would pass to modbus_read_registers
+    :return: list of unpacked tuples, in the same order as the requests
+    """
+    results = [None] * len(requests)
+    for (start, quant, members) in plan_register_reads(requests, max_gap):
+        chunks = []
+        for offset in range(0, quant, READ_REG_COUNT_MAX):
+            count = min(READ_REG_COUNT_MAX, quant - offset)
+            (raw,) = master.modbus_read_registers(start + offset, "{0}s".format(count * 2),
+                                                  function_code=function_code)
+            chunks.append(raw)
+
+        raw = "".join(chunks)
+        for index in members:
+            (addr, data_format) = requests[index]
+            results[index] = struct.unpack_from("=" + data_format, raw, (addr - start) * 2)
+    return results
+
+
+# Precompiled structures, keyed by the (native) data format used by the callers
+_register_structs = {}
+
+_request_header = struct.Struct(">BBBHH")
+_word = struct.Struct(">H")
+_write_header = struct.Struct(">BBBHHB")
+
+
+def register_struct(data_format):
+    """
+    Returns a precompiled struct.Struct for a register data format.  The charger keeps its registers as
+    little-endian C structures, so the format is always little-endian once the words have been swapped.
+    """
+    compiled = _register_structs.get(data_format)
+    if compiled is None:
+        compiled = struct.Struct("<" + data_format)
+        if compiled.size % 2:
+            raise ModbusInvalidRequestError("Data format {0} is not a whole number of registers".format(data_format))
+        _register_structs[data_format] = compiled
+    return compiled
+
+
+class iChargerMaster(object):
     """
     Modbus master interface to the iCharger, implements higher level routines to get the
     status / channel information from the device.
+
+    This talks the iCharger USB-HID framing directly rather than going through modbus_tk: the request
+    is built in place in a reused output report, and the response is decoded straight into a tuple
+    using precompiled structs.  The facade must provide write_report() and read_report().
     """
 
     def __init__(self, serial=None):
         if serial is None:
             serial = USBSerialFacade()
 
-        super(iChargerMaster, self).__init__(serial)
+        self._serial = serial
+
+        # report id (always 0) followed by the 64 byte frame
+        self._report = bytearray(MAX_READWRITE_LEN + 1)
+        self._report_len = 0
+
+    def open(self):
+        if not self._serial.is_open:
+            self._serial.open()
+
+    def close(self):
+        if self._serial.is_open:
+            self._serial.close()
+
+    def reset(self):
+        self._serial.reset()
+
+    def _prepare_report(self, length):
+        # zero anything left over from a longer, earlier request
+        if self._report_len > length:
+            self._report[length:self._report_len] = bytearray(self._report_len - length)
+        self._report_len = length
+
+    def _transact(self, function_code, addr, quant):
+        """
+        Sends the request in the output report and returns the validated response frame.  A garbled response
+        to a read is retried once, after throwing away anything else waiting in the input queue.  A garbled
+        response to a write is raised, as it may have been written anyway.
+        """
+        attempt = 1
+        while True:
+            try:
+                return self._exchange(function_code, addr, quant)
+            except ModbusErrorResponse:
+                raise
+            except ModbusInvalidResponseError:
+                if attempt >= TRANSACTION_ATTEMPTS or function_code not in RETRIED_FUNCTION_CODES:
+                    raise
+                attempt += 1
+                metrics.transport_recovery.inc(("retry",))
+                self.drain_input()
+
+    def _exchange(self, function_code, addr, quant):
+        labels = (str(function_code), register_block(addr))
+        response = None
+        exception = None
+        started = time.time()
+        try:
+            self.open()
+            self._serial.write_report(self._report)
+            response = self._read_response(function_code, addr, quant)
+            return response
+        except Exception, e:
+            exception = e
+            metrics.modbus_errors.inc(labels)
+            raise
+        finally:
+            elapsed = time.time() - started
+            metrics.modbus_transaction_seconds.observe(elapsed, labels)
+            request_timing.record("modbus", elapsed)
+            flight_recorder.RECORDER.record(started, elapsed, function_code, addr, quant,
+                                            memoryview(self._report)[1:self._report_len], response, exception)
+
+    def _read_response(self, function_code, addr, quant):
+        """
+        Reads the response to the request just sent.  A well formed response to some other request is a stale
+        one (its request timed out earlier), it's skipped and the next report read instead.
+        """
+        response = self._serial.read_report()
+        skipped = 0
+        while skipped < STALE_REPORTS_MAX and self._is_stale(response, function_code, addr, quant):
+            metrics.transport_recovery.inc(("stale",))
+            skipped += 1
+            response = self._serial.read_report()
+
+        self._validate_response(response, function_code)
+        return response
+
+    @staticmethod
+    def _is_stale(response, function_code, addr, quant):
+        if len(response) < 7 or response[1] != MODBUS_HID_FRAME_TYPE:
+            return False
+
+        if response[2] == function_code | 0x80:
+            return False
+
+        if response[2] != function_code:
+            return True
+
+        if function_code == cst.WRITE_MULTIPLE_REGISTERS:
+            # the write response echoes the address and quantity
+            return (response[3] << 8 | response[4], response[5] << 8 | response[6]) != (addr, quant)
+
+        return response[3] != quant * 2
+
+    @staticmethod
+    def _validate_response(response, function_code):
+        if len(response) < 4:
+            raise ModbusInvalidResponseError("Response length is invalid {0}".format(len(response)))
+
+        if response[1] != MODBUS_HID_FRAME_TYPE:
+            raise ModbusInvalidResponseError(
+                "Response does not contain the expected frame type constant (0x30) in ADU portion of the result, constant value found is {0}".format(
+                    response[1]))
+
+        if response[2] != function_code:
+            if response[2] == function_code | 0x80:
+                raise ModbusErrorResponse(
+                    "Response contains error code {0}: {1}".format(response[3],
+                                                                   iChargerQuery._modbus_error_string(response[3]))
+                )
+
+            raise ModbusInvalidResponseError(
+                "Response func_code {0} isn't the same as the request func_code {1}".format(
+                    response[2], function_code
+                ))
+
+    def drain_input(self):
+        """Throws away anything waiting in the input queue, see recover()"""
+        if not self._serial.is_open:
+            return 0
+
+        metrics.transport_recovery.inc(("drain",))
+        drained = self._serial.drain_input()
+        if drained:
+            logger.info("dropped {0} stale input report(s)".format(drained))
+        return drained
+
+    def recover(self, failures, reopen=False):
+        """
+        Gets the transport back into shape after a request failed, trying harder the more failures there have
+        been in a row: draining the input queue is nearly free, closing and opening the device is not.
+        :param failures: consecutive failures so far, including this one
+        :param reopen: go straight to closing and opening the device
+        """
+        if reopen or failures >= REOPEN_AFTER_FAILURES:
+            metrics.transport_recovery.inc(("reopen",))
+            self.reset()
+        else:
+            self.drain_input()
+
+    def recent_transactions(self):
+        """The transactions kept by the flight recorder, oldest first"""
+        return flight_recorder.RECORDER.entries()
+
+    def modbus_read_registers(self, addr, data_format, function_code=cst.READ_INPUT_REGISTERS):
+        """
+        Reads registers from the device and decodes them into a tuple.
+
+        The data_format specifies the layout of the data being returned and is always
+        specified in native format - DO NOT include '>' or '<' as then the byte
+        swapping will not work.
+
+        The number of words (2 bytes) of data being returned is calculated as the byte size of
+        the return packet / 2.  The response carries big-endian words, these are byte swapped
+        back into the charger's own (little-endian) structure layout before being unpacked.
+
+        :param addr: the base address (offsets are in words not bytes)
+        :param data_format: the structure of the data being received, assumes struct.unpack()
+        :return: the tuples of unpacked and byte swapped data
+        """
+        compiled = register_struct(data_format)
+        quant = compiled.size // 2
+
+        if testing_control.modbus_read_should_fail:
+            raise TestingControlException("modbus_read_registers")
+
+        self._prepare_report(8)
+        _request_header.pack_into(self._report, 1, 7, MODBUS_HID_FRAME_TYPE, function_code, addr, quant)
+        response = self._transact(function_code, addr, quant)
+
+        byte_count = response[3]
+        if byte_count != quant * 2 or len(response) < 4 + byte_count:
+            raise ModbusInvalidResponseError(
+                "Byte count is {0} while the expected number of bytes is {1}. ".format(byte_count, quant * 2)
+            )
+
+        return compiled.unpack_from(swap_register_bytes(response, 4, byte_count))
+
+    def modbus_read_blocks(self, requests, function_code=cst.READ_INPUT_REGISTERS, max_gap=READ_REG_GAP_MAX):
+        return read_register_blocks(self, requests, function_code, max_gap)
+
+    def modbus_write_registers(self, addr, data):
+        """
+        Writes data to the modbus slave given an address to write to.
+        :param addr: the address to begin writing values at
+        :param data: tuple of data to be written - these are int words
+        :return: a tuple containing the first byte of the response (the high byte of the address)
+        """
+        quant = len(data)
+        if quant > WRITE_REG_COUNT_MAX:
+            raise ModbusInvalidRequestError("Cannot write {0} registers in a single request".format(quant))
+
+        self._prepare_report(10 + quant * 2)
+        _write_header.pack_into(self._report, 1, 7 + (quant * 2), MODBUS_HID_FRAME_TYPE,
+                                cst.WRITE_MULTIPLE_REGISTERS, addr, quant, quant * 2)
+        offset = 9
+        for value in data:
+            _word.pack_into(self._report, offset, int(value) & 0xffff)
+            offset += 2
+
+        response = self._transact(cst.WRITE_MULTIPLE_REGISTERS, addr, quant)
+        return response[3],
+
+
+class iChargerRtuMaster(RtuMaster):
+    """
+    The original modbus_tk based master, which drives the USBSerialFacade through the generic RtuMaster
+    execute() path.  Kept so that the iChargerMaster can be compared against it.
+    """
+
+    def __init__(self, serial=None):
+        if serial is None:
+            serial = USBSerialFacade()
+
+        super(iChargerRtuMaster, self).__init__(serial)
 
     def _make_query(self):
         return iChargerQuery()
@@ -343,6 +738,9 @@ class iChargerMaster(RtuMaster):
                             quantity_of_x=quant,
                             expected_length=(quant * 2) + 4)
 
+    def modbus_read_blocks(self, requests, function_code=cst.READ_INPUT_REGISTERS, max_gap=READ_REG_GAP_MAX):
+        return read_register_blocks(self, requests, function_code, max_gap)
+
     def modbus_write_registers(self, addr, data):
         """
         Writes data using modbus_tk to the modbus slave given an address to write to.
@@ -9,6 +9,8 @@ from schematics.types import StringType, IntType, LongType, FloatType, BooleanTy
 from schematics.types.compound import ModelType, ListType
 from schematics.types.serializable import serializable
 
+from electric.request_timing import timed_phase
+
 logger = logging.getLogger('electric.app.{0}'.format(__name__))
 
 STATUS_RUN = 0x01
@@ -65,7 +67,7 @@ class ReadDataSegment:
     auto calculates the correct offset based off a prior read if required.
     """
 
-    def __init__(self, charger, name, fmt, base=None, prev_format=None):
+    def __init__(self, charger, name, fmt, base=None, prev_format=None, deferred=False):
         self.func_code = cst.READ_INPUT_REGISTERS
 
         self.name = name
@@ -76,7 +78,21 @@ class ReadDataSegment:
         if self.addr >= 0x8000:
             self.func_code = cst.READ_HOLDING_REGISTERS
 
-        self.data = charger.modbus_read_registers(self.addr, self.format, function_code=self.func_code)
+        self.data = None
+        if not deferred:
+            self.data = charger.modbus_read_registers(self.addr, self.format, function_code=self.func_code)
+
+    @staticmethod
+    def read_all(charger, segments):
+        """
+        Fills in the data of a set of deferred segments, coalescing them into as few reads as possible.  All
+        segments must live in the same register space (input or holding).
+        """
+        requests = [(segment.addr, segment.format) for segment in segments]
+        results = charger.modbus_read_blocks(requests, function_code=segments[0].func_code)
+        for (segment, data) in zip(segments, results):
+            segment.data = data
+        return segments
 
 
 class WriteDataSegment(object):
@@ -179,6 +195,7 @@ class DeviceInfo(Model):
     def get_status(self, channel):
         return self.ch1_status if channel == 0 else self.ch2_status
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, data):
         self.device_id = data[0]
         self.device_sn = data[1].split('\0')[0]
@@ -212,6 +229,7 @@ class OperationResponse(Model):
     def error(self):
         return not self.success
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, data):
         self.first_number = data[0]
         if len(data) > 1:
@@ -265,6 +283,7 @@ class ChannelStatus(Model):
             status.set_from_modbus_data(device_id, channel, header, cell_v, cell_b, cell_i, footer)
         return status
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, device_id, channel, data, cell_v, cell_b, cell_i, footer):
         self.channel = channel
 
@@ -346,6 +365,7 @@ class Control(Model):
                 return name
         return None
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, data):
         self.op = data[0]
         self.memory = data[1]
@@ -421,6 +441,7 @@ class SystemStorage(Model):
             return storage
         return None
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, ds1, ds2, ds3):
         dummy1 = None
         (self.temp_unit, self.temp_stop, self.temp_fans_on, self.temp_reduce, dummy1, self.fans_off_delay,
@@ -621,6 +642,7 @@ class PresetIndex(Model):
         self.indexes = copy.deepcopy(new_value)
         self._validate_and_fix_index_list()
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, count, indexes):
         self.set_indexes(indexes)
 
@@ -935,6 +957,7 @@ class Preset(Model):
 
         return v1, v2, v3, v4, v5
 
+    @timed_phase("decode")
     def set_from_modbus_data(self, ds1, ds2, ds3, ds4, ds5):
         (self.use_flag,
          self.name,
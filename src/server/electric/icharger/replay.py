@@ -0,0 +1,201 @@
+"""
+Capture and replay of the USB traffic with the charger.
+
+CaptureSerialFacade sits in front of a real facade and writes every request/response frame pair to a file,
+ReplaySerialFacade serves those frames back to an iChargerMaster with no charger attached - either with the
+charger's original response times or as fast as possible.  Replaying a real charging session against a new
+build of the server gives repeatable throughput / CPU numbers.
+
+The file is a header (magic, capture start time) followed by one record per transaction: the RECORD struct
+(time since the start, duration, status, request length, response length) then the request and response
+frames, with their trailing zero padding removed.
+"""
+import bisect
+import logging
+import struct
+import time
+
+from electric import metrics
+from electric.icharger.modbus_usb import MAX_READWRITE_LEN
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+MAGIC = "ICHGCAP\x01"
+HEADER = struct.Struct("<8sd")
+RECORD = struct.Struct("<ddBBB")
+
+STATUS_OK = 0
+STATUS_NO_RESPONSE = 1
+
+TIMING_ORIGINAL = "original"
+TIMING_FAST = "fast"
+
+
+def _frame(data):
+    return str(data).rstrip("\0")
+
+
+class CaptureSerialFacade(object):
+    """Passes everything through to the real facade, writing each transaction to the capture file"""
+
+    def __init__(self, facade, path):
+        self.facade = facade
+        self.path = path
+        self.started = time.time()
+
+        self._file = open(path, "wb")
+        self._file.write(HEADER.pack(MAGIC, self.started))
+        self._request = None
+        self._request_time = None
+
+        logger.info("capturing charger traffic to {0}".format(path))
+
+    @property
+    def is_open(self):
+        return self.facade.is_open
+
+    def open(self):
+        return self.facade.open()
+
+    def close(self):
+        self._file.flush()
+        return self.facade.close()
+
+    def reset(self):
+        return self.facade.reset()
+
+    def drain_input(self):
+        return self.facade.drain_input()
+
+    def write_report(self, report):
+        self._request = _frame(report[1:])
+        self._request_time = time.time()
+        return self.facade.write_report(report)
+
+    def read_report(self):
+        try:
+            response = self.facade.read_report()
+        except Exception:
+            self._write_record(STATUS_NO_RESPONSE, "")
+            raise
+
+        self._write_record(STATUS_OK, _frame(response))
+        return response
+
+    def _write_record(self, status, response):
+        now = time.time()
+        self._file.write(RECORD.pack(self._request_time - self.started, now - self._request_time, status,
+                                     len(self._request), len(response)))
+        self._file.write(self._request)
+        self._file.write(response)
+        # flushed as we go, it's most interesting when the server dies
+        self._file.flush()
+
+
+def read_capture(path):
+    """
+    Reads a capture file.
+    :return: (start time, list of (offset, duration, status, request, response) tuples)
+    """
+    with open(path, "rb") as f:
+        data = f.read()
+
+    (magic, started) = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise ValueError("{0} is not a charger capture file".format(path))
+
+    records = []
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        (at, duration, status, request_len, response_len) = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        request = data[offset:offset + request_len]
+        offset += request_len
+        response = data[offset:offset + response_len]
+        offset += response_len
+        records.append((at, duration, status, request, response))
+
+    return started, records
+
+
+class ReplaySerialFacade(object):
+    """
+    Answers each request with the response captured for it.  Requests are matched against the capture in
+    order: the next recorded transaction with the same request is used, going back to the start of the
+    capture when there isn't one, so a server that reads a little differently still gets sensible answers.
+    """
+
+    def __init__(self, path, timing=TIMING_ORIGINAL):
+        if timing not in (TIMING_ORIGINAL, TIMING_FAST):
+            raise ValueError("Unknown replay timing {0}".format(timing))
+
+        (self.started, self.records) = read_capture(path)
+        self.timing = timing
+
+        # request -> indexes of the records that have it, in order
+        self._index = {}
+        for (n, record) in enumerate(self.records):
+            self._index.setdefault(record[3], []).append(n)
+
+        self._opened = False
+        self._cursor = 0
+        self._pending = None
+
+        self.served = 0
+        self.skipped = 0
+
+    @property
+    def is_open(self):
+        return self._opened
+
+    def open(self):
+        self._opened = True
+        return True
+
+    def close(self):
+        self._opened = False
+        return True
+
+    def reset(self):
+        metrics.transport_resets.inc()
+        self.close()
+        self.open()
+        return True
+
+    def drain_input(self):
+        self._pending = None
+        return 0
+
+    def write_report(self, report):
+        request = _frame(report[1:])
+        indexes = self._index.get(request)
+        if not indexes:
+            raise IOError("The capture has no response for request {0}".format(request.encode("hex")))
+
+        position = bisect.bisect_left(indexes, self._cursor)
+        if position < len(indexes):
+            self.skipped += indexes[position] - self._cursor
+            self._pending = indexes[position]
+        else:
+            self._pending = indexes[0]
+
+        self._cursor = self._pending + 1
+        return len(report)
+
+    def read_report(self):
+        if self._pending is None:
+            raise IOError("Read without a request")
+
+        (at, duration, status, request, response) = self.records[self._pending]
+        self._pending = None
+
+        if self.timing == TIMING_ORIGINAL:
+            time.sleep(duration)
+
+        if status != STATUS_OK:
+            raise IOError("No response (as captured)")
+
+        self.served += 1
+        report = bytearray(MAX_READWRITE_LEN)
+        report[:len(response)] = response
+        return report
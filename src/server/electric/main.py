@@ -2,7 +2,7 @@ import platform
 from electric.app import application
 
 def run_server():
-    application.run(debug=True, host='0.0.0.0', port=5000)
+    application.run(debug=True, host='0.0.0.0', port=5000, threaded=True)
 
 
 if __name__ == "__main__":
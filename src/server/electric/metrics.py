@@ -0,0 +1,195 @@
+"""
+Minimal counters and histograms, exposed in the Prometheus text format at /metrics.
+
+Recording is a dict lookup and an increment under a lock, cheap enough to leave on all the time.  Each process
+keeps its own values.  With a device broker, the workers send a snapshot of theirs to the broker now and then,
+and /metrics is rendered from the totals it sends back - its own (the transactions and the transport) added
+to every worker's - so it's the same whichever worker answers (see BrokerMetrics).  Without one, every
+process reports only its own share.
+"""
+import bisect
+import threading
+
+# Seconds - a USB transaction is a few ms, a request holding the lock for a preset dump can be seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = ['{0}="{1}"'.format(name, _escape(value)) for (name, value) in zip(names, values)]
+    if extra is not None:
+        pairs.append('{0}="{1}"'.format(extra[0], extra[1]))
+    if not pairs:
+        return ""
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter(object):
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, labels=()):
+        return self._values.get(labels, 0)
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        """labels -> value, which can be pickled and merged with others (see merge)"""
+        with self._lock:
+            return dict(self._values)
+
+    def render(self, snapshot=None):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} counter".format(self.name)]
+        values = sorted((snapshot if snapshot is not None else self.snapshot()).items())
+        for (labels, value) in values:
+            lines.append("{0}{1} {2}".format(self.name, _format_labels(self.labelnames, labels), _format_value(value)))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+
+        # labels -> [count per bucket (the last is +Inf), sum]
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(labels)
+            if entry is None:
+                entry = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def count(self, labels=()):
+        entry = self._values.get(labels)
+        return sum(entry[0]) if entry is not None else 0
+
+    def clear(self):
+        with self._lock:
+            self._values = {}
+
+    def snapshot(self):
+        """labels -> (count per bucket, sum), see Counter.snapshot"""
+        with self._lock:
+            return dict((labels, (list(counts), total)) for (labels, (counts, total)) in self._values.items())
+
+    def render(self, snapshot=None):
+        lines = ["# HELP {0} {1}".format(self.name, self.documentation),
+                 "# TYPE {0} histogram".format(self.name)]
+        values = sorted((snapshot if snapshot is not None else self.snapshot()).items())
+
+        for (labels, (counts, total)) in values:
+            cumulative = 0
+            for (bound, count) in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                lines.append("{0}_bucket{1} {2}".format(
+                    self.name, _format_labels(self.labelnames, labels, ("le", _format_value(bound))), cumulative))
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append("{0}_sum{1} {2}".format(self.name, label_text, repr(total)))
+            lines.append("{0}_count{1} {2}".format(self.name, label_text, cumulative))
+        return lines
+
+
+class Registry(object):
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def clear(self):
+        for metric in self._metrics:
+            metric.clear()
+
+    def snapshot(self):
+        """metric name -> the metric's snapshot"""
+        return dict((metric.name, metric.snapshot()) for metric in self._metrics)
+
+    def render(self, snapshot=None):
+        """:param snapshot: the values to render (see merge), rather than this registry's own"""
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render(snapshot.get(metric.name, {}) if snapshot is not None else None))
+        return "\n".join(lines) + "\n"
+
+
+def _add(total, value):
+    if total is None:
+        return value
+    if isinstance(value, tuple):
+        return [a + b for (a, b) in zip(total[0], value[0])], total[1] + value[1]
+    return total + value
+
+
+def merge(snapshots):
+    """Adds up registry snapshots (see Registry.snapshot), from several processes say"""
+    result = {}
+    for snapshot in snapshots:
+        for (name, values) in snapshot.items():
+            merged = result.setdefault(name, {})
+            for (labels, value) in values.items():
+                merged[labels] = _add(merged.get(labels), value)
+    return result
+
+
+REGISTRY = Registry()
+
+modbus_transaction_seconds = REGISTRY.histogram(
+    "electric_modbus_transaction_seconds", "Time taken by each modbus transaction with the charger",
+    ("function_code", "block"))
+modbus_errors = REGISTRY.counter(
+    "electric_modbus_errors_total", "Modbus transactions that failed", ("function_code", "block"))
+transport_resets = REGISTRY.counter(
+    "electric_transport_resets_total", "Number of times the USB transport was reset (closed and opened)")
+transport_recovery = REGISTRY.counter(
+    "electric_transport_recovery_total", "Steps taken to recover the USB transport after a failed transaction",
+    ("step",))
+request_retries = REGISTRY.counter(
+    "electric_request_retries_total", "Requests retried after a failure talking to the charger", ("resource",))
+gateway_timeouts = REGISTRY.counter(
+    "electric_gateway_timeouts_total", "Requests answered with a 504", ("resource", "reason"))
+coalesced_reads = REGISTRY.counter(
+    "electric_coalesced_reads_total", "Reads answered with the result of an identical read", ("resource",))
+lock_wait_seconds = REGISTRY.histogram(
+    "electric_lock_wait_seconds", "Time spent waiting for the charger lock", ("priority",))
+lock_hold_seconds = REGISTRY.histogram(
+    "electric_lock_hold_seconds", "Time the charger lock was held for", ("priority",))
+resource_lock_hold_seconds = REGISTRY.histogram(
+    "electric_resource_lock_hold_seconds", "Time each resource held the charger lock for, per attempt",
+    ("resource",))
+request_seconds = REGISTRY.histogram(
+    "electric_request_seconds", "Time taken to handle each HTTP request", ("resource", "method", "status"))
@@ -0,0 +1,198 @@
+import errno
+import logging
+import multiprocessing
+import os
+import time
+
+from electric import metrics, request_timing
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+# The most waiting for the lock at once: gunicorn's workers x threads, plus the poller and the probe, is well
+# under this.  Any more check for a free slot every FULL_WAIT seconds.
+MAX_WAITERS = 64
+FULL_WAIT = 0.01
+
+# Seconds between waiters checking whether the holder, or a waiter ahead of them, has died
+REAP_INTERVAL = 1.0
+
+
+class Priority:
+    """Who gets the charger next, lowest value first"""
+    Emergency = 0  # stop, close the message box
+    Write = 1  # operations, saving presets / system storage
+    Interactive = 2  # a client waiting on a read
+    Background = 3  # the telemetry poller, bulk preset reads
+
+    count = 4
+    names = ("emergency", "write", "interactive", "background")
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        # it's there, it just isn't ours
+        return e.errno == errno.EPERM
+    return True
+
+
+class PriorityLock(object):
+    """
+    A lock (shared between processes like the multiprocessing.Lock it replaces) that is granted to the waiter
+    with the highest priority rather than whoever happens to get there first.  The holder isn't interrupted,
+    so long jobs should call yield_to_higher() at points where it's safe to let someone else in.
+
+    Every waiter, and the holder, is recorded in shared memory along with its pid.  A process that dies while
+    waiting (a gunicorn worker being killed, say) would otherwise keep everyone of a lower priority waiting
+    forever, and one that dies holding the lock would keep everyone out - so the waiters check every
+    REAP_INTERVAL seconds, and forget about the processes that are no longer there.
+
+    Using the lock directly in a with statement acquires it at Priority.Interactive.
+    """
+
+    def __init__(self):
+        self._mutex = multiprocessing.Lock()
+
+        # a slot for each waiter: the pid (0 if the slot is free) and the priority it's waiting at.  Each waiter
+        # sleeps on its slot's own semaphore rather than a shared multiprocessing.Condition, whose notify_all()
+        # waits for every sleeper to wake - forever, if one of them has died.
+        self._waiter_pids = multiprocessing.Array('i', MAX_WAITERS, lock=False)
+        self._waiter_priorities = multiprocessing.Array('b', MAX_WAITERS, lock=False)
+        self._wakeups = [multiprocessing.Semaphore(0) for slot in range(MAX_WAITERS)]
+
+        self._held = multiprocessing.Value('b', 0, lock=False)
+        self._holder_pid = multiprocessing.Value('i', 0, lock=False)
+        self._holder_priority = multiprocessing.Value('b', 0, lock=False)
+        self._acquired_at = multiprocessing.Value('d', 0.0, lock=False)
+
+    def waiting(self, priority):
+        """The number waiting at the priority"""
+        with self._mutex:
+            return sum(1 for slot in range(MAX_WAITERS)
+                       if self._waiter_pids[slot] and self._waiter_priorities[slot] == priority)
+
+    def _is_held(self):
+        if self._held.value and not _is_alive(self._holder_pid.value):
+            logger.warning("process {0} died holding the charger lock, releasing it".format(self._holder_pid.value))
+            self._held.value = 0
+            self._holder_pid.value = 0
+        return self._held.value
+
+    def _is_waiting(self, slot):
+        """True if the slot's waiter is still there, forgetting about it if it has died"""
+        pid = self._waiter_pids[slot]
+        if not pid:
+            return False
+        if _is_alive(pid):
+            return True
+
+        logger.warning("process {0} died waiting for the charger lock, forgetting it".format(pid))
+        self._waiter_pids[slot] = 0
+        return False
+
+    def _higher_priority_waiting(self, priority):
+        for slot in range(MAX_WAITERS):
+            if self._waiter_pids[slot] and self._waiter_priorities[slot] < priority and self._is_waiting(slot):
+                return True
+        return False
+
+    def _add_waiter(self, priority):
+        """:return: the slot taken, or None if they're all in use"""
+        for slot in range(MAX_WAITERS):
+            if not self._is_waiting(slot):
+                # throw away any wakeups left over from the last waiter
+                while self._wakeups[slot].acquire(False):
+                    pass
+                self._waiter_pids[slot] = os.getpid()
+                self._waiter_priorities[slot] = priority
+                return slot
+        return None
+
+    def _wake_waiters(self):
+        for slot in range(MAX_WAITERS):
+            if self._is_waiting(slot):
+                self._wakeups[slot].release()
+
+    def acquire(self, priority=Priority.Interactive):
+        started = time.time()
+        slot = None
+        try:
+            while True:
+                with self._mutex:
+                    if slot is None:
+                        slot = self._add_waiter(priority)
+                    if slot is not None and not self._is_held() and not self._higher_priority_waiting(priority):
+                        self._waiter_pids[slot] = 0
+                        slot = None
+
+                        acquired_at = time.time()
+                        self._held.value = 1
+                        self._holder_pid.value = os.getpid()
+                        self._holder_priority.value = priority
+                        self._acquired_at.value = acquired_at
+                        break
+
+                # woken by a release, or every REAP_INTERVAL in case whoever is in the way has died
+                if slot is not None:
+                    self._wakeups[slot].acquire(True, REAP_INTERVAL)
+                else:
+                    time.sleep(FULL_WAIT)
+        finally:
+            if slot is not None:
+                with self._mutex:
+                    self._waiter_pids[slot] = 0
+
+        metrics.lock_wait_seconds.observe(acquired_at - started, (Priority.names[priority],))
+        request_timing.record("lock", acquired_at - started)
+
+    def release(self):
+        with self._mutex:
+            was_held = self._held.value
+            held = time.time() - self._acquired_at.value
+            priority = self._holder_priority.value
+
+            self._held.value = 0
+            self._holder_pid.value = 0
+            self._wake_waiters()
+
+        if was_held:
+            metrics.lock_hold_seconds.observe(held, (Priority.names[priority],))
+
+    def yield_to_higher(self, priority):
+        """
+        Called by the holder: if anyone with a higher priority is waiting, lets them go first and then takes the
+        lock back again.
+        :return: True if the lock was given up
+        """
+        with self._mutex:
+            if not self._higher_priority_waiting(priority):
+                return False
+
+        self.release()
+        self.acquire(priority)
+        return True
+
+    def holding(self, priority):
+        """For use in a with statement, holds the lock at the given priority"""
+        return _Holding(self, priority)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class _Holding(object):
+    def __init__(self, lock, priority):
+        self.lock = lock
+        self.priority = priority
+
+    def __enter__(self):
+        self.lock.acquire(self.priority)
+        return self.lock
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
@@ -0,0 +1,89 @@
+"""
+Field projection for the JSON resources: ?fields=curr_out_volts,cells.v asks for just those fields, which
+saves encoding (and, for a channel, reading) everything else.
+
+Fields are given by their JSON names, a dotted name picks fields out of a nested model or out of every
+model in a list.
+"""
+from schematics.types.compound import ModelType, ListType
+
+
+def parse_fields(text):
+    """
+    Parses the fields parameter into a dict of field name -> the sub-fields wanted from it (None for all of
+    it).  Returns None if no fields were given, meaning everything.
+    """
+    if text is None or not text.strip():
+        return None
+
+    fields = {}
+    for name in text.split(","):
+        name = name.strip()
+        if not name:
+            continue
+
+        (head, _, rest) = name.partition(".")
+        if not rest:
+            fields[head] = None
+        elif head not in fields or fields[head] is not None:
+            fields.setdefault(head, {}).update(parse_fields(rest))
+    return fields
+
+
+def _json_names(model_class):
+    """JSON name -> (attribute name, field type) for every field and serializable of the model class"""
+    names = {}
+    for (attribute, field) in model_class._fields.items():
+        names[field.serialized_name or attribute] = (attribute, field)
+    for (attribute, serializable) in model_class._serializables.items():
+        names[serializable.serialized_name or attribute] = (attribute, None)
+    return names
+
+
+def _nested_model(field):
+    if isinstance(field, ListType):
+        field = field.field
+    if isinstance(field, ModelType):
+        return field.model_class
+    return None
+
+
+def validate_fields(model_class, fields):
+    """Raises ValueError if any of the fields isn't one of the model's"""
+    if fields is None:
+        return
+
+    names = _json_names(model_class)
+    for (name, sub_fields) in fields.items():
+        if name not in names:
+            raise ValueError("Unknown field {0}".format(name))
+
+        if sub_fields is not None:
+            nested = _nested_model(names[name][1])
+            if nested is None:
+                raise ValueError("Field {0} has no fields of its own".format(name))
+            validate_fields(nested, sub_fields)
+
+
+def project(model, fields):
+    """
+    Encodes just the requested fields of the model - the equivalent of to_primitive() when fields is None.
+    """
+    if fields is None:
+        return model.to_primitive()
+
+    names = _json_names(type(model))
+    result = {}
+    for (name, sub_fields) in fields.items():
+        (attribute, field) = names[name]
+        value = getattr(model, attribute)
+
+        if value is None or field is None:
+            result[name] = value
+        elif _nested_model(field) is None:
+            result[name] = field.to_primitive(value)
+        elif isinstance(field, ListType):
+            result[name] = [project(item, sub_fields) for item in value]
+        else:
+            result[name] = project(value, sub_fields)
+    return result
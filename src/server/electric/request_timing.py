@@ -0,0 +1,110 @@
+"""
+Collects where the time goes while handling a single request - waiting for and holding the charger lock,
+modbus transactions, decoding the registers into models and encoding the response - and formats it as a
+Server-Timing header.
+
+The timing is kept per thread, so code outside of a request (the telemetry poller, the breaker probe) records
+nothing and pays next to nothing for it.
+"""
+import functools
+import threading
+import time
+
+_local = threading.local()
+
+# Phases in the order they appear in the header, with the descriptions shown by browser dev tools
+PHASES = (
+    ("lock", "waiting for the charger"),
+    ("hold", "holding the charger"),
+    ("modbus", "register transactions"),
+    ("decode", "decoding registers"),
+    ("encode", "encoding the response"),
+)
+
+
+class RequestTiming(object):
+    def __init__(self):
+        self.started = time.time()
+        self.durations = {}
+        self.counts = {}
+        self._active = {}
+
+    def record(self, phase, seconds, count=1):
+        self.durations[phase] = self.durations.get(phase, 0.0) + seconds
+        self.counts[phase] = self.counts.get(phase, 0) + count
+
+    def header(self, now=None):
+        if now is None:
+            now = time.time()
+
+        entries = []
+        for (phase, description) in PHASES:
+            if phase in self.durations:
+                if phase == "modbus":
+                    description = "{0} {1}".format(self.counts[phase], description)
+                entries.append('{0};dur={1:.2f};desc="{2}"'.format(phase, self.durations[phase] * 1000.0, description))
+        entries.append("total;dur={0:.2f}".format((now - self.started) * 1000.0))
+        return ", ".join(entries)
+
+
+def start():
+    _local.timing = RequestTiming()
+    return _local.timing
+
+
+def finish():
+    timing = getattr(_local, "timing", None)
+    _local.timing = None
+    return timing
+
+
+def current():
+    return getattr(_local, "timing", None)
+
+
+def record(phase, seconds, count=1):
+    timing = getattr(_local, "timing", None)
+    if timing is not None:
+        timing.record(phase, seconds, count)
+
+
+def phase(name):
+    """
+    For use in a with statement, times the enclosed block as part of the phase.  Nested blocks of the same
+    phase (a model decoding its sub-models, say) are only counted once.
+    """
+    return _Phase(name)
+
+
+class _Phase(object):
+    def __init__(self, name):
+        self.name = name
+        self.timing = None
+        self.started = None
+
+    def __enter__(self):
+        timing = getattr(_local, "timing", None)
+        if timing is not None and not timing._active.get(self.name):
+            timing._active[self.name] = True
+            self.timing = timing
+            self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.timing is not None:
+            self.timing.record(self.name, time.time() - self.started)
+            self.timing._active[self.name] = False
+
+
+def timed_phase(name):
+    """Decorator version of phase"""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with phase(name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -1,141 +1,507 @@
+import contextlib
+import functools
 import logging
+import math
+import time
 
-from flask import request
+from flask import request, Response
 from flask_restful import Resource, abort
 from werkzeug.exceptions import BadRequest
 
 import electric.evil_global as evil_global
+from electric import flight_recorder, metrics, request_timing
 from electric.icharger.modbus_usb import connection_state_dict
-from electric.icharger.comms_layer import Operation
-from electric.icharger.models import Preset, SystemStorage, ObjectNotFoundException, PresetIndex
+from electric.icharger.comms_layer import Operation, channel_blocks_for
+from electric.icharger.models import Preset, SystemStorage, ObjectNotFoundException, PresetIndex, DeviceInfo, \
+    ChannelStatus
+from electric.downsample import downsample
+from electric.priority_lock import Priority
+from electric.projection import parse_fields, validate_fields, project
+from electric.single_flight import freeze
+from electric.telemetry import event_stream
 
 logger = logging.getLogger('electric.app.{0}'.format(__name__))
 
 RETRY_LIMIT = 30
 
+# The column ?max_points= downsamples by, unless ?by= says otherwise
+DOWNSAMPLE_BY = "curr_out_volts"
 
-def exclusive(func):
+
+def primitive(model, fields=None):
+    """The model encoded for the response, optionally just the fields given (see projection.parse_fields)"""
+    with request_timing.phase("encode"):
+        return project(model, fields)
+
+
+def native(model):
+    with request_timing.phase("encode"):
+        return model.to_native()
+
+
+def native_list(models):
+    with request_timing.phase("encode"):
+        return [model.to_native() for model in models]
+
+
+class AfterRelease(object):
+    """
+    Returned by an @exclusive method to have the response built once the charger lock has been released: the
+    registers have been read by then, and encoding them needn't keep anyone else from the charger.
+    """
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __call__(self):
+        return self.func(*self.args)
+
+
+def with_state(model, fields=None):
+    """The model encoded for the response, along with the connection state"""
+    obj = primitive(model, fields)
+    obj.update(connection_state_dict())
+    return obj
+
+
+def exclusive(func=None, priority=Priority.Interactive):
+    """
+    Runs the resource method with the charger to itself, retrying on failure.  Use as @exclusive, or as
+    @exclusive(priority=...) to jump ahead of (or fall behind) the interactive reads.
+
+    The lock is held for each attempt (and the recovery after a failed one) rather than for the whole call,
+    methods that return an AfterRelease have it called once the lock has been let go.
+
+    While the circuit breaker is open the call fails straight away, unless it's an emergency: a stop is always
+    tried, and closes the breaker if the charger answers it.
+    """
+    if func is None:
+        return lambda f: exclusive(f, priority)
+
+    @functools.wraps(func)
     def wrapper(self, *args, **kwargs):
-        with evil_global.lock:
-            retry = 0
-            while retry < RETRY_LIMIT:
+        resource = type(self).__name__
+
+        # Don't queue up behind the lock for a charger that isn't there
+        if evil_global.breaker.is_open and priority != Priority.Emergency:
+            metrics.gateway_timeouts.inc((resource, "disconnected"))
+            return connection_state_dict(evil_global.breaker.last_exception), 504
+
+        retry = 0
+        while retry < RETRY_LIMIT:
+            try:
+                with holding_charger(resource, priority):
+                    result = func(self, *args, **kwargs)
+                evil_global.breaker.record_success()
+
+                if isinstance(result, AfterRelease):
+                    result = result()
+                return result
+
+            except ObjectNotFoundException as e:
+                abort(404, message=e.message)
+
+            except BadRequest as badRequest:
+                # Just return it, it's a validation failure
+                raise badRequest
+
+            except ValueError as ve:
+                raise ve
+
+            except Exception, ex:
+                retry += 1
+
+                if evil_global.breaker.record_failure(ex):
+                    logger.warning("{0}/{1}, charger is disconnected - not trying again".format(ex, type(ex)))
+                    metrics.gateway_timeouts.inc((resource, "disconnected"))
+                    return connection_state_dict(ex), 504
+
+                metrics.request_retries.inc((resource,))
+
+                logger.warning("{0}/{3}, will try again (count is at {1}/{2})".format(ex, retry, RETRY_LIMIT, type(ex)))
+
+                # If the charger isn't plugged in. This could fail.
                 try:
-                    return func(self, *args, **kwargs)
+                    with holding_charger(resource, priority):
+                        evil_global.comms.recover(retry, ex)
+                except Exception, recover_ex:
+                    logger.error("Error resetting comms! Charger not plugged in? {0}".format(recover_ex))
+
+                if retry >= RETRY_LIMIT:
+                    logger.warning("retry limit exceeded, aborting the call completely")
+                    metrics.gateway_timeouts.inc((resource, "retries"))
+                    dump_recent_transactions("{0} gave up after {1} retries, last error: {2}".format(
+                        resource, retry, ex))
+                    return connection_state_dict(ex), 504
+
+    return wrapper
+
 
-                except ObjectNotFoundException as e:
-                    abort(404, message=e.message)
+@contextlib.contextmanager
+def holding_charger(resource, priority):
+    """Holds the charger lock at the given priority, timing how long the resource kept it"""
+    with evil_global.lock.holding(priority):
+        acquired_at = time.time()
+        try:
+            yield
+        finally:
+            held = time.time() - acquired_at
+            metrics.resource_lock_hold_seconds.observe(held, (resource,))
+            request_timing.record("hold", held)
 
-                except BadRequest as badRequest:
-                    # Just return it, it's a validation failure
-                    raise badRequest
 
-                except ValueError as ve:
-                    raise ve
+class _FailedResponse(Exception):
+    """Carries an error response through the SingleFlight, which only keeps results that aren't exceptions"""
 
-                except Exception, ex:
-                    retry += 1
+    def __init__(self, response):
+        super(_FailedResponse, self).__init__(response[1])
+        self.response = response
 
-                    logger.warning("{0}/{3}, will try again (count is at {1}/{2})".format(ex, retry, RETRY_LIMIT, type(ex)))
 
-                    # If the charger isn't plugged in. This could fail.
-                    try:
-                        evil_global.comms.reset()
-                    except Exception, ex:
-                        logger.error("Error resetting comms! Charger not plugged in? {0}".format(ex))
+def coalesced(func):
+    """
+    For read-only resource methods: concurrent calls with the same arguments share the result of the first
+    rather than each reading the charger, see SingleFlight.  Only a successful result is reused once the call
+    has finished, an error response (a 504 from @exclusive, say) goes to the callers already waiting for it.
+    """
 
-                    if retry >= RETRY_LIMIT:
-                        logger.warning("retry limit exceeded, aborting the call completely")
-                        return connection_state_dict(ex), 504
+    def call(self, *args, **kwargs):
+        result = func(self, *args, **kwargs)
+        if isinstance(result, tuple) and len(result) > 1 and result[1] != 200:
+            raise _FailedResponse(result)
+        return result
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        key = (type(self).__name__, func.__name__, freeze(args), freeze(kwargs))
+        try:
+            return evil_global.single_flight.do(key, call, self, *args, **kwargs)
+        except _FailedResponse, e:
+            return e.response
 
     return wrapper
 
 
+def dump_recent_transactions(reason):
+    """Saves the flight recorder to disk, so there's more to go on than a log line"""
+    try:
+        return flight_recorder.dump_to_file(evil_global.comms.recent_transactions(), reason)
+    except Exception, e:
+        logger.error("Could not dump the recent charger transactions: {0}".format(e))
+        return None
+
+
+def telemetry_snapshot():
+    """
+    Returns the latest TelemetrySnapshot, or None if /status and /channel should read the charger directly -
+    either because there's no poller configured or because it hasn't completed a poll yet.
+    """
+    if evil_global.telemetry is None:
+        return None
+
+    evil_global.telemetry.ensure_running()
+    return evil_global.telemetry.snapshot
+
+
+def wake_telemetry(control=None):
+    """
+    Tells the poller that the charger may be changing state, so that it polls now and at the full rate.  With
+    a control register it's only woken if that differs from the last one it saw.
+    """
+    if evil_global.telemetry is None:
+        return
+
+    if control is None:
+        evil_global.telemetry.wake()
+    else:
+        evil_global.telemetry.note_control(control)
+
+
+def requested_fields(model_class):
+    """
+    The fields asked for with ?fields=, None for all of them.
+    :raises ValueError: if a field isn't one of the model's
+    """
+    fields = parse_fields(request.args.get("fields"))
+    validate_fields(model_class, fields)
+    return fields
+
+
 class StatusResource(Resource):
-    @exclusive
     def get(self):
-        info = evil_global.comms.get_device_info()
+        try:
+            fields = requested_fields(DeviceInfo)
+        except ValueError, e:
+            return connection_state_dict(str(e)), 400
 
-        evil_global.last_seen_charger_device_id = info.device_id
+        snapshot = telemetry_snapshot()
+        if snapshot is None:
+            return self.get_live(fields)
 
-        obj = info.to_primitive()
-        obj.update(connection_state_dict())
+        if snapshot.exception is not None:
+            return snapshot.state_dict(), 504
+
+        evil_global.last_seen_charger_device_id = snapshot.device_info.device_id
+
+        obj = primitive(snapshot.device_info, fields)
+        obj.update(snapshot.state_dict())
 
         return obj
 
+    @coalesced
+    @exclusive
+    def get_live(self, fields=None):
+        info = evil_global.comms.get_device_info()
+
+        evil_global.last_seen_charger_device_id = info.device_id
+
+        return AfterRelease(with_state, info, fields)
+
 
 class ChannelResource(Resource):
-    @exclusive
     def get(self, channel_id):
         channel = int(channel_id)
         if not (channel == 0 or channel == 1):
             return connection_state_dict("Channel number must be 0 or 1"), 403
 
-        # yeh, more groan
-        status = evil_global.comms.get_channel_status(int(channel), evil_global.last_seen_charger_device_id)
+        try:
+            fields = requested_fields(ChannelStatus)
+            blocks = channel_blocks_for(fields)
+        except ValueError, e:
+            return connection_state_dict(str(e)), 400
+
+        snapshot = telemetry_snapshot()
+        if snapshot is None:
+            return self.get_live(channel, fields, blocks)
 
-        obj = status.to_primitive()
-        obj.update(connection_state_dict())
+        if snapshot.exception is not None:
+            return snapshot.state_dict(), 504
+
+        if snapshot.channel(channel) is None:
+            return self.get_live(channel, fields, blocks)
+
+        obj = primitive(snapshot.channel(channel), fields)
+        obj.update(snapshot.state_dict())
 
         return obj
 
+    @coalesced
+    @exclusive
+    def get_live(self, channel, fields=None, blocks=None):
+        # yeh, more groan
+        status = evil_global.comms.get_channel_status(channel, evil_global.last_seen_charger_device_id,
+                                                      blocks=blocks)
+
+        return AfterRelease(with_state, status, fields)
+
+
+def stream_response(render):
+    """
+    A text/event-stream response pushing every snapshot published by the telemetry poller, which has
+    to be configured for streaming to be available.
+    """
+    if evil_global.telemetry is None:
+        return connection_state_dict("Streaming requires the telemetry poller, set TELEMETRY_POLL_INTERVAL"), 503
+
+    evil_global.telemetry.ensure_running()
+
+    response = Response(event_stream(evil_global.telemetry, render), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"
+    return response
+
+
+class ChannelStreamResource(Resource):
+    def get(self, channel_id):
+        channel = int(channel_id)
+        if not (channel == 0 or channel == 1):
+            return connection_state_dict("Channel number must be 0 or 1"), 403
+
+        return stream_response(lambda snapshot: snapshot.channel_event(channel))
+
+
+class StatusStreamResource(Resource):
+    def get(self):
+        return stream_response(lambda snapshot: snapshot.status_event())
+
+
+def optional_float(name):
+    """
+    The query parameter as a float, None if it wasn't given.
+    :raises ValueError: if it isn't a (finite) number
+    """
+    value = request.args.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        number = float(value)
+    except ValueError:
+        raise ValueError("{0} must be a number".format(name))
+
+    if math.isinf(number) or math.isnan(number):
+        raise ValueError("{0} must be a number".format(name))
+    return number
+
+
+def history_response(query):
+    """
+    Answers a history request: calls query with the since, until and step parameters, then downsamples the
+    result to max_points (chosen by the shape of the ?by= column, curr_out_volts unless given).
+    """
+    try:
+        since = optional_float("since")
+        until = optional_float("until")
+        step = optional_float("step")
+        max_points = optional_float("max_points")
+    except ValueError, e:
+        return connection_state_dict(str(e)), 400
+
+    try:
+        samples = query(since, until, step)
+    except IOError, e:
+        # the history is kept by the device broker, which isn't answering
+        return connection_state_dict(e), 504
+
+    if max_points is not None:
+        try:
+            samples = downsample(samples, int(max_points), request.args.get("by", DOWNSAMPLE_BY))
+        except ValueError, e:
+            return connection_state_dict(str(e)), 400
+
+    return samples
+
+
+class ChannelHistoryResource(Resource):
+    def get(self, channel_id):
+        channel = int(channel_id)
+        if not (channel == 0 or channel == 1):
+            return connection_state_dict("Channel number must be 0 or 1"), 403
+
+        if evil_global.telemetry is None or evil_global.telemetry.history is None:
+            return connection_state_dict("History requires the telemetry poller, set TELEMETRY_POLL_INTERVAL"), 503
+
+        evil_global.telemetry.ensure_running()
+
+        response = history_response(evil_global.telemetry.history.channel(channel).query)
+        if isinstance(response, dict):
+            response["channel"] = channel
+        return response
+
+
+def session_store():
+    """The SessionStore, or None if sessions aren't being recorded"""
+    if evil_global.telemetry is None:
+        return None
+    return evil_global.telemetry.sessions
+
+
+class SessionListResource(Resource):
+    def get(self):
+        store = session_store()
+        if store is None:
+            return connection_state_dict("Sessions require the telemetry poller and SESSION_DIR"), 503
+
+        evil_global.telemetry.ensure_running()
+
+        sessions = []
+        for session in store.sessions():
+            info = session.info()
+            info["running"] = store.is_running(session.session_id)
+            sessions.append(info)
+        return {"sessions": sessions}
+
+
+class SessionResource(Resource):
+    def get(self, session_id):
+        store = session_store()
+        if store is None:
+            return connection_state_dict("Sessions require the telemetry poller and SESSION_DIR"), 503
+
+        session = store.session(session_id)
+        if session is None:
+            abort(404, message="No session {0}".format(session_id))
+
+        response = history_response(session.query)
+        if isinstance(response, dict):
+            response["session"] = session.info()
+        return response
+
+
+class MetricsResource(Resource):
+    def get(self):
+        if evil_global.broker_metrics is None:
+            text = metrics.REGISTRY.render()
+        else:
+            try:
+                text = evil_global.broker_metrics.render()
+            except IOError, e:
+                return connection_state_dict(e), 504
+        return Response(text, mimetype="text/plain; version=0.0.4")
+
+
+class TransactionsResource(Resource):
+    def get(self):
+        try:
+            transactions = evil_global.comms.recent_transactions()
+        except Exception, e:
+            return connection_state_dict(e), 504
+        return {"transactions": transactions}
+
 
 class ControlRegisterResource(Resource):
     @exclusive
     def get(self):
         control = evil_global.comms.get_control_register()
+        wake_telemetry(control)
 
         # note: intentionally no connection state
-        return control.to_primitive()
+        return AfterRelease(primitive, control)
 
 
 class ChargeResource(ControlRegisterResource):
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self, channel_id, preset_memory_slot):
         device_status = evil_global.comms.run_operation(Operation.Charge, int(channel_id), int(preset_memory_slot))
-        annotated_device_status = device_status.to_primitive()
-        annotated_device_status.update(connection_state_dict())
-        return annotated_device_status
+        wake_telemetry()
+        return AfterRelease(with_state, device_status)
 
 
 class DischargeResource(ControlRegisterResource):
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self, channel_id, preset_memory_slot):
         pass
 
 
 class BalanceResource(ControlRegisterResource):
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self, channel_id, preset_memory_slot):
         pass
 
 
 class MeasureIRResource(ControlRegisterResource):
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self, channel_id):
         pass
 
 
 class StopResource(ControlRegisterResource):
-    @exclusive
+    @exclusive(priority=Priority.Emergency)
     def put(self, channel_id):
         channel_number = int(channel_id)
         logger.info("Stop, channel {0}".format(channel_number))
-        operation_response = evil_global.comms.stop_operation(channel_number).to_primitive()
-        operation_response.update(connection_state_dict())
-        return operation_response
+        operation_response = evil_global.comms.stop_operation(channel_number)
+        wake_telemetry()
+        return AfterRelease(with_state, operation_response)
 
 
 class SystemStorageResource(Resource):
     @exclusive
     def get(self):
         syst = evil_global.comms.get_system_storage()
+        return AfterRelease(with_state, syst)
 
-        obj = syst.to_primitive()
-        obj.update(connection_state_dict())
-
-        return obj
-
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self):
         json_dict = request.json
         del json_dict['charger_presence']
@@ -148,16 +514,16 @@ class PresetResource(Resource):
     def get(self, preset_memory_slot):
         preset_memory_slot = int(preset_memory_slot)
         preset = evil_global.comms.get_preset(preset_memory_slot)
-        return preset.to_primitive()
+        return AfterRelease(primitive, preset)
 
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def delete(self, preset_memory_slot):
         # This will only, I think ... work for "at the end"
         preset_memory_slot = int(preset_memory_slot)
         logger.info("Try to delete preset at memory slot {0}".format(preset_memory_slot))
         return evil_global.comms.delete_preset_at_index(preset_memory_slot)
 
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self, preset_memory_slot):
         preset_memory_slot = int(preset_memory_slot)
         json_dict = request.json
@@ -170,7 +536,7 @@ class PresetResource(Resource):
 
 
 class AddNewPresetResource(Resource):
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def put(self):
         json_dict = request.json
 
@@ -178,17 +544,20 @@ class AddNewPresetResource(Resource):
         preset = Preset(json_dict)
 
         logger.info("Asked to add a new preset: {0}".format(json_dict))
-        return evil_global.comms.add_new_preset(preset).to_native()
+        return AfterRelease(native, evil_global.comms.add_new_preset(preset))
 
 
 class PresetListResource(Resource):
-    @exclusive
+    @exclusive(priority=Priority.Background)
     def get(self):
         preset_list = evil_global.comms.get_full_preset_list()
         # TODO: Error handling
 
         all_presets = []
         for index in preset_list.range_of_presets():
+            # Between presets is a safe point to let a stop (or anything else more important) go first
+            evil_global.lock.yield_to_higher(Priority.Background)
+
             # Preset.index is the memory slot it's in, not the position within the index
             memory_slot_number = preset_list.indexes[index]
             preset = evil_global.comms.get_preset(memory_slot_number)
@@ -196,22 +565,31 @@ class PresetListResource(Resource):
             # TODO: Error handling
 
             if preset:
-                all_presets.append(preset.to_native())
+                all_presets.append(preset)
 
-        return all_presets
+        return AfterRelease(native_list, all_presets)
 
     @exclusive
     def post(self):
         pass
 
 
+class PresetRefreshResource(Resource):
+    @exclusive(priority=Priority.Write)
+    def put(self):
+        # For when the presets have been changed using the charger itself
+        logger.info("Discarding the cached presets")
+        evil_global.comms.invalidate_preset_cache()
+        return AfterRelease(native, evil_global.comms.get_full_preset_list())
+
+
 class PresetOrderResource(Resource):
     @exclusive
     def get(self):
         preset_list = evil_global.comms.get_full_preset_list()
-        return preset_list.to_native()
+        return AfterRelease(native, preset_list)
 
-    @exclusive
+    @exclusive(priority=Priority.Write)
     def post(self):
         json_dict = request.json
         preset_list = PresetIndex(json_dict)
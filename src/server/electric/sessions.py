@@ -0,0 +1,549 @@
+"""
+Charge sessions on disk: every sample the TelemetryPoller takes while a channel is running is appended to that
+session's file, so there's a record of the whole charge long after the in-memory history has moved on.
+
+A session starts when the channel's run_status or control_status goes non-zero and ends (after recording the
+sample that shows it) when they are both back to zero.  Each session is two files in the directory:
+
+    <channel>-<start ms>.session    a header, then a record per sample: the time (in ms) followed by the
+                                    channel input registers, laid out as in CHANNEL_INPUT_BLOCKS
+    <channel>-<start ms>.index      the time, file offset and number of the first record of each chunk
+
+The records are delta encoded (see delta_codec) in chunks of CHUNK_RECORDS, each chunk starting afresh so it
+can be decoded on its own.  Most registers don't change from one poll to the next, so a sample takes an eighth
+or so of the space of the raw registers - which matters on an SD card.
+
+Both files are only ever appended to.  A time range query bisects the (small) index and decodes the chunks
+it needs from the session file through mmap, rather than reading the whole file.
+
+Only one process records into a directory: the first whose poller gets to it takes a lock on its .recorder
+file and keeps it until it exits.  A session's file is locked while it's being recorded, which is how the
+other processes (the gunicorn workers, say) can tell it's still running.
+
+Older sessions are compacted (see compaction.py) into two more files, after which the raw samples can go:
+
+    <channel>-<start ms>.rollup     the min, mean and max of the samples in each bucket of a few seconds
+    <channel>-<start ms>.summary    JSON, totals for the whole session (energy, peak temperature, final IR...)
+"""
+import bisect
+import errno
+import fcntl
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import threading
+
+from electric.delta_codec import encode_record, decode_records
+from electric.history import COLUMNS
+from electric.icharger.comms_layer import CHANNEL_INPUT_BLOCKS
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+MAGIC = "ICHGSES\x02"
+HEADER = struct.Struct("<8sdB")
+
+# chunk start time, file offset, record number
+INDEX_ENTRY = struct.Struct("<dQI")
+CHUNK_RECORDS = 64
+
+SESSION_EXTENSION = ".session"
+INDEX_EXTENSION = ".index"
+ROLLUP_EXTENSION = ".rollup"
+SUMMARY_EXTENSION = ".summary"
+
+_SESSION_ID = re.compile(r"^\d+-\d+$")
+
+RECORDER_LOCK = ".recorder"
+
+# directory -> (pid, lock file) for the directories this process is recording into
+_recorders = {}
+_recorders_lock = threading.Lock()
+
+
+def try_flock(f, operation):
+    """:return: False if another open file holds a conflicting lock"""
+    try:
+        fcntl.flock(f, operation | fcntl.LOCK_NB)
+    except IOError, e:
+        if e.errno not in (errno.EAGAIN, errno.EACCES):
+            raise
+        return False
+    return True
+
+
+def _block_starts():
+    starts = {}
+    count = 0
+    for (name, offset, data_format) in CHANNEL_INPUT_BLOCKS:
+        starts[name] = count
+        count += len(struct.unpack("<" + data_format, "\0" * struct.calcsize("<" + data_format)))
+    return starts, count
+
+
+# Where each part of the channel input starts within the registers of a record, and how many there are
+(BLOCK_START, REGISTER_COUNT) = _block_starts()
+
+# the time and the registers
+RECORD_WIDTH = 1 + REGISTER_COUNT
+
+CELL_COUNT = 16
+
+# A cell voltage of this means there's no cell, see ChannelStatus.set_from_modbus_data
+NO_CELL = 1024
+
+# column -> (index into the header registers, scale), as in ChannelStatus.set_from_modbus_data
+_HEADER_SCALES = {
+    "curr_out_power": (1, 1000.0),
+    "curr_out_amps": (2, 100.0),
+    "curr_out_volts": (4, 1000.0),
+    "curr_out_capacity": (5, 1.0),
+    "curr_int_temp": (6, 10.0),
+    "curr_ext_temp": (7, 10.0),
+}
+
+
+# magic, session start, channel, bucket seconds
+ROLLUP_MAGIC = "ICHGROL\x01"
+ROLLUP_HEADER = struct.Struct("<8sdBd")
+
+# bucket start, number of samples, then the min, mean and max of each of the COLUMNS and the mean of each cell
+ROLLUP_RECORD = struct.Struct("<dH" + "3f" * len(COLUMNS) + "{0}H".format(CELL_COUNT))
+
+
+def _scaled(value, scale):
+    return int(round((value or 0) * scale))
+
+
+def registers_from(status):
+    """The channel input registers for a ChannelStatus, the reverse of ChannelStatus.set_from_modbus_data"""
+    header = (int((status.timestamp or 0) * 1000) & 0xffffffff,
+              _scaled(status.curr_out_power, 1000),
+              _scaled(status.curr_out_amps, 100),
+              _scaled(status.curr_inp_volts, 1000),
+              _scaled(status.curr_out_volts, 1000),
+              _scaled(status.curr_out_capacity, 1),
+              _scaled(status.curr_int_temp, 10),
+              _scaled(status.curr_ext_temp, 10))
+
+    cell_volt = [NO_CELL] * CELL_COUNT
+    cell_balance = [0] * CELL_COUNT
+    cell_ir = [0] * CELL_COUNT
+    for cell in status.cells or ():
+        cell_volt[cell.cell] = _scaled(cell.voltage, 1000)
+        cell_balance[cell.cell] = cell.balance or 0
+        cell_ir[cell.cell] = _scaled(cell.ir, 10)
+
+    counters = (_scaled(status.cell_total_ir, 10), _scaled(status.line_intern_resistance, 10),
+                status.cycle_count or 0)
+    control = (status.control_status or 0, status.run_status or 0, status.run_error or 0, status.dlg_box_id or 0)
+
+    return header + tuple(cell_volt) + tuple(cell_balance) + tuple(cell_ir) + counters + control
+
+
+def is_running(status):
+    return bool(status.run_status or status.control_status)
+
+
+def column_values(record):
+    """The values of the COLUMNS in a (time, registers...) record"""
+    header = 1 + BLOCK_START["header"]
+    return [record[header + _HEADER_SCALES[name][0]] / _HEADER_SCALES[name][1] for name in COLUMNS]
+
+
+def read_summary(path):
+    """The summary written by the compaction, None if there isn't one (yet)"""
+    if not os.path.exists(path):
+        return None
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class SessionWriter(object):
+    """A session that's still running, appended to a sample at a time"""
+
+    def __init__(self, directory, channel, started):
+        self.channel = channel
+        self.started = started
+        self.session_id = "{0}-{1}".format(channel, int(started * 1000))
+        self.count = 0
+
+        base = os.path.join(directory, self.session_id)
+        self._file = open(base + SESSION_EXTENSION, "ab")
+        # held until the session ends, so the other processes know it's running
+        if not try_flock(self._file, fcntl.LOCK_EX):
+            self._file.close()
+            raise IOError("charge session {0} is already being recorded".format(self.session_id))
+        self._index = open(base + INDEX_EXTENSION, "ab")
+        self._file.write(HEADER.pack(MAGIC, started, channel))
+        self._file.flush()
+
+        self._offset = HEADER.size
+        self._previous = None
+
+    def append(self, timestamp, registers):
+        record = (int(round(timestamp * 1000)),) + tuple(registers)
+
+        if self.count % CHUNK_RECORDS == 0:
+            self._index.write(INDEX_ENTRY.pack(timestamp, self._offset, self.count))
+            self._index.flush()
+            self._previous = None
+
+        encoded = encode_record(record, self._previous)
+        self._file.write(encoded)
+        # flushed as we go, so that readers (and a crash) see everything up to the last sample
+        self._file.flush()
+
+        self._offset += len(encoded)
+        self._previous = record
+        self.count += 1
+
+    def close(self):
+        self._file.close()
+        self._index.close()
+
+
+class SessionFile(object):
+    """A session on disk, running or not"""
+
+    def __init__(self, path):
+        self.path = path
+        self.session_id = os.path.basename(path)[:-len(SESSION_EXTENSION)]
+
+        # kept open, so the samples can still be read if the compactor deletes the file in the meantime
+        self._file = open(path, "rb")
+        (magic, self.started, self.channel) = HEADER.unpack(self._file.read(HEADER.size))
+        if magic != MAGIC:
+            self._file.close()
+            raise ValueError("{0} is not a charge session".format(path))
+
+        (self._times, self._offsets, self._numbers) = self._read_index()
+
+        # only the last chunk needs decoding to find out how long the session is
+        self.count = 0
+        self.ended = self.started
+        if self._offsets:
+            last = None
+            decoded = 0
+            for last in self.chunk(self.chunk_count - 1):
+                decoded += 1
+            self.count = self._numbers[-1] + decoded
+            if last is not None:
+                self.ended = last[0]
+
+    @property
+    def size(self):
+        """Bytes on disk"""
+        return os.fstat(self._file.fileno()).st_size
+
+    @property
+    def chunk_count(self):
+        return len(self._offsets)
+
+    def info(self):
+        return {
+            "id": self.session_id,
+            "channel": self.channel,
+            "started": self.started,
+            "ended": self.ended,
+            "samples": self.count,
+            "resolution": None,
+            "summary": read_summary(self.path[:-len(SESSION_EXTENSION)] + SUMMARY_EXTENSION),
+        }
+
+    def _read_index(self):
+        times = []
+        offsets = []
+        numbers = []
+        path = self.path[:-len(SESSION_EXTENSION)] + INDEX_EXTENSION
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            data = ""
+
+        for position in range(0, len(data) - INDEX_ENTRY.size + 1, INDEX_ENTRY.size):
+            (timestamp, offset, number) = INDEX_ENTRY.unpack_from(data, position)
+            times.append(timestamp)
+            offsets.append(offset)
+            numbers.append(number)
+        return times, offsets, numbers
+
+    def _map(self):
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _decode_chunk(self, mapped, chunk):
+        end = self._offsets[chunk + 1] if chunk + 1 < len(self._offsets) else len(mapped)
+        for record in decode_records(mapped[self._offsets[chunk]:end], RECORD_WIDTH):
+            # the record is the base for the next one's deltas, so it can't be changed in place
+            yield [record[0] / 1000.0] + record[1:]
+
+    def chunk(self, chunk):
+        """The records of a single chunk, as (time, registers...) lists"""
+        mapped = self._map()
+        try:
+            return list(self._decode_chunk(mapped, chunk))
+        finally:
+            mapped.close()
+
+    def _chunk_records(self, first_chunk):
+        """Decodes the records from the chunk onwards, as (time, registers...) lists"""
+        mapped = self._map()
+        try:
+            for chunk in range(first_chunk, len(self._offsets)):
+                for record in self._decode_chunk(mapped, chunk):
+                    yield record
+        finally:
+            mapped.close()
+
+    def records(self, since=None, until=None):
+        """
+        The records between since and until (inclusive, either can be None), decoded as they're needed.
+        :return: a generator of (time, registers...) lists
+        """
+        chunk = 0
+        if since is not None:
+            chunk = max(0, bisect.bisect_right(self._times, since) - 1)
+
+        for record in self._chunk_records(chunk):
+            if since is not None and record[0] < since:
+                continue
+            if until is not None and record[0] > until:
+                break
+            yield record
+
+    def query(self, since=None, until=None, step=None):
+        """
+        The samples between since and until, at most one every step seconds, in the same form as
+        ChannelHistory.query
+        """
+        records = []
+        next_time = None
+        for record in self.records(since, until):
+            if step and next_time is not None and record[0] < next_time:
+                continue
+            records.append(record)
+            if step:
+                next_time = record[0] + step
+
+        return columns_from(records)
+
+
+def columns_from(records):
+    """Records as a dict of column name -> list of values, as returned by ChannelHistory.query"""
+    header = 1 + BLOCK_START["header"]
+    cell_volt = 1 + BLOCK_START["cell_volt"]
+
+    result = {"time": [record[0] for record in records]}
+    for name in COLUMNS:
+        (index, scale) = _HEADER_SCALES[name]
+        result[name] = [record[header + index] / scale for record in records]
+    result["cells"] = [[value / 1000.0 for value in record[cell_volt:cell_volt + CELL_COUNT] if value != NO_CELL]
+                       for record in records]
+    return result
+
+
+class RollupFile(object):
+    """A session that has been compacted, see compaction.py"""
+
+    def __init__(self, path):
+        self.path = path
+        self.session_id = os.path.basename(path)[:-len(ROLLUP_EXTENSION)]
+
+        with open(path, "rb") as f:
+            data = f.read()
+
+        (magic, self.started, self.channel, self.resolution) = ROLLUP_HEADER.unpack_from(data, 0)
+        if magic != ROLLUP_MAGIC:
+            raise ValueError("{0} is not a compacted charge session".format(path))
+
+        self._records = [ROLLUP_RECORD.unpack_from(data, offset)
+                         for offset in range(ROLLUP_HEADER.size, len(data) - ROLLUP_RECORD.size + 1,
+                                             ROLLUP_RECORD.size)]
+        self.count = sum(record[1] for record in self._records)
+        self.summary = read_summary(path[:-len(ROLLUP_EXTENSION)] + SUMMARY_EXTENSION)
+
+        self.ended = self.started
+        if self.summary is not None:
+            self.ended = self.summary["ended"]
+        elif self._records:
+            self.ended = self._records[-1][0] + self.resolution
+
+    def info(self):
+        return {
+            "id": self.session_id,
+            "channel": self.channel,
+            "started": self.started,
+            "ended": self.ended,
+            "samples": self.count,
+            "resolution": self.resolution,
+            "summary": self.summary,
+        }
+
+    def query(self, since=None, until=None, step=None):
+        """
+        The buckets between since and until, in the same form as SessionFile.query: the mean in place of each
+        column, with the min and max as <column>_min and <column>_max.
+        """
+        records = []
+        next_time = None
+        for record in self._records:
+            if (since is not None and record[0] < since) or (until is not None and record[0] > until):
+                continue
+            if step and next_time is not None and record[0] < next_time:
+                continue
+            records.append(record)
+            if step:
+                next_time = record[0] + step
+
+        result = {"time": [record[0] for record in records]}
+        for (n, name) in enumerate(COLUMNS):
+            base = 2 + n * 3
+            result[name + "_min"] = [round(record[base], 3) for record in records]
+            result[name] = [round(record[base + 1], 3) for record in records]
+            result[name + "_max"] = [round(record[base + 2], 3) for record in records]
+
+        cells = 2 + len(COLUMNS) * 3
+        result["cells"] = [[value / 1000.0 for value in record[cells:cells + CELL_COUNT] if value != NO_CELL]
+                           for record in records]
+        return result
+
+
+class SessionStore(object):
+    """
+    Records charge sessions from the poller's snapshots into a directory, and finds them again.  Only the
+    poller writes to the store, and only in the one process that has claimed the directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        # channel -> SessionWriter for the sessions in progress
+        self._writers = {}
+        self._claim_refused = False
+
+    def claim(self):
+        """
+        Makes this the process recording into the directory, unless another process already is.  The claim
+        lasts until the process exits.
+        :return: True if this process is the one recording
+        """
+        key = os.path.realpath(self.directory)
+        with _recorders_lock:
+            held = _recorders.get(key)
+            if held is not None:
+                (pid, f) = held
+                if pid == os.getpid():
+                    return True
+
+                # inherited through a fork, the claim is the parent's
+                f.close()
+                del _recorders[key]
+
+            f = open(os.path.join(self.directory, RECORDER_LOCK), "a")
+            if not try_flock(f, fcntl.LOCK_EX):
+                f.close()
+                if not self._claim_refused:
+                    logger.info("another process is recording the charge sessions in {0}".format(self.directory))
+                    self._claim_refused = True
+                return False
+
+            _recorders[key] = (os.getpid(), f)
+            logger.info("recording charge sessions in {0}".format(self.directory))
+            return True
+
+    def record(self, snapshot):
+        if snapshot.exception is not None or not self.claim():
+            return
+
+        for (channel, status) in enumerate(snapshot.channels):
+            running = is_running(status)
+            writer = self._writers.get(channel)
+            if writer is None:
+                if not running:
+                    continue
+                writer = self._writers[channel] = SessionWriter(self.directory, channel, snapshot.timestamp)
+                logger.info("charge session {0} started".format(writer.session_id))
+
+            writer.append(snapshot.timestamp, registers_from(status))
+
+            if not running:
+                writer.close()
+                del self._writers[channel]
+                logger.info("charge session {0} ended, {1} samples".format(writer.session_id, writer.count))
+
+    def is_running(self, session_id):
+        """True while the session is being recorded, by this process or another"""
+        if any(writer.session_id == session_id for writer in self._writers.values()):
+            return True
+
+        try:
+            with open(self.path(session_id, SESSION_EXTENSION), "rb") as f:
+                return not try_flock(f, fcntl.LOCK_SH)
+        except IOError, e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+
+    @property
+    def claimed(self):
+        """True if this process is the one recording into the directory, see claim()"""
+        held = _recorders.get(os.path.realpath(self.directory))
+        return held is not None and held[0] == os.getpid()
+
+    @property
+    def recording(self):
+        """True while this process is recording any session"""
+        return bool(self._writers)
+
+    def path(self, session_id, extension):
+        return os.path.join(self.directory, session_id + extension)
+
+    def session_ids(self):
+        """The ids of every session in the store, raw or compacted, oldest first"""
+        ids = set()
+        for name in os.listdir(self.directory):
+            (session_id, extension) = os.path.splitext(name)
+            if extension in (SESSION_EXTENSION, ROLLUP_EXTENSION) and _SESSION_ID.match(session_id):
+                ids.add(session_id)
+        return sorted(ids, key=lambda session_id: int(session_id.split("-")[1]))
+
+    def sessions(self, channel=None):
+        """Every session in the store (optionally only those for the channel), oldest first"""
+        sessions = []
+        for session_id in self.session_ids():
+            session = self.session(session_id)
+            if session is not None and (channel is None or session.channel == channel):
+                sessions.append(session)
+        return sessions
+
+    def session(self, session_id):
+        """
+        The SessionFile for the id - or the RollupFile, once the raw samples have been deleted.  None if there
+        isn't one.
+        """
+        if not _SESSION_ID.match(session_id):
+            return None
+
+        try:
+            if os.path.exists(self.path(session_id, SESSION_EXTENSION)):
+                return SessionFile(self.path(session_id, SESSION_EXTENSION))
+            if os.path.exists(self.path(session_id, ROLLUP_EXTENSION)):
+                return RollupFile(self.path(session_id, ROLLUP_EXTENSION))
+            return None
+        except (IOError, ValueError, struct.error), e:
+            logger.warning("Can't read charge session {0}: {1}".format(session_id, e))
+            return None
+
+    def close(self):
+        """Closes the sessions being recorded, as the process exits"""
+        for writer in self._writers.values():
+            writer.close()
+            logger.info("charge session {0} closed, {1} samples".format(writer.session_id, writer.count))
+        self._writers = {}
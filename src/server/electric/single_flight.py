@@ -0,0 +1,95 @@
+"""
+Coalesces identical reads: while a call is in flight, anyone else making the same call waits for its result
+rather than queueing up to make the call again.  The number of reads of the charger then depends on how
+many different things are being asked for, not how many clients are asking.
+
+Results can also be reused for a short freshness window after the call completes, and are forgotten once
+it's over.  Like the metrics this is per process, each gunicorn worker coalesces its own requests.
+"""
+import sys
+import threading
+import time
+
+from electric import metrics
+
+
+class _Call(object):
+    def __init__(self):
+        self.done = threading.Event()
+        self.finished = None
+        self.value = None
+        self.exc_info = None
+
+    def fresh(self, freshness, now):
+        return not self.done.is_set() or now - self.finished < freshness
+
+    def result(self):
+        if self.exc_info is not None:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+
+class SingleFlight(object):
+    def __init__(self, freshness=0.0):
+        """
+        :param freshness: seconds for which a finished call's result is handed out to identical calls
+        """
+        self.freshness = freshness
+
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._evicted_at = 0.0
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        Calls func, unless a call with the same key is in flight (or finished within the freshness window), in
+        which case its result is returned - or its exception raised - instead.
+        :param key: hashable, identifies the call, the first element is used to label the metrics
+        """
+        with self._lock:
+            now = time.time()
+            if now - self._evicted_at >= self.freshness:
+                self._evict(now)
+
+            call = self._calls.get(key)
+            leader = call is None or not call.fresh(self.freshness, now)
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            metrics.coalesced_reads.inc((key[0],))
+            call.done.wait()
+            return call.result()
+
+        try:
+            call.value = func(*args, **kwargs)
+        except Exception:
+            call.exc_info = sys.exc_info()
+        finally:
+            call.finished = time.time()
+            call.done.set()
+            # only the callers already waiting get a failure
+            if self.freshness <= 0 or call.exc_info is not None:
+                with self._lock:
+                    if self._calls.get(key) is call:
+                        del self._calls[key]
+
+        return call.result()
+
+    def _evict(self, now):
+        # call holding the lock.  Done at most once a freshness window, there's no need to look any more often.
+        for (key, call) in self._calls.items():
+            if not call.fresh(self.freshness, now):
+                del self._calls[key]
+        self._evicted_at = now
+
+
+def freeze(value):
+    """A hashable equivalent of the value (dicts, lists and sets of hashable things), for use in a key"""
+    if isinstance(value, dict):
+        return tuple(sorted((key, freeze(item)) for (key, item) in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
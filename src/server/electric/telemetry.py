@@ -0,0 +1,313 @@
+import json
+import logging
+import os
+import threading
+import time
+
+from electric.icharger.modbus_usb import connection_state_dict
+from electric.priority_lock import Priority
+
+logger = logging.getLogger('electric.app.{0}'.format(__name__))
+
+DEFAULT_POLL_INTERVAL = 0.5
+
+# Seconds between polls while neither channel is doing anything
+DEFAULT_IDLE_INTERVAL = 5.0
+
+# Seconds between comment lines sent to an idle event stream, so proxies and clients don't time it out
+STREAM_KEEPALIVE = 15
+
+
+class TelemetrySnapshot(object):
+    """
+    The state of the charger as last seen by the TelemetryPoller.  A snapshot is never modified once it has
+    been published, the poller replaces it instead - so it can be handed out without taking the comms lock.
+
+    The timestamp is when its values were read from the charger.  A snapshot of a failure carries the last
+    good values over, and their timestamp with them, so its age says how out of date they are.
+    """
+
+    def __init__(self, version, timestamp, device_info=None, channels=None, exception=None):
+        self.version = version
+        self.timestamp = timestamp
+        self.device_info = device_info
+        self.channels = tuple(channels or ())
+        self.exception = exception
+
+        # encoded server-sent events, shared by every client streaming this snapshot
+        self._events = {}
+
+    def age(self, now=None):
+        if now is None:
+            now = time.time()
+        return max(0.0, now - self.timestamp)
+
+    @property
+    def active(self):
+        """True if either channel is running an operation (charging, discharging, balancing...)"""
+        if self.device_info is None:
+            return False
+
+        for channel in range(len(self.channels)):
+            status = self.device_info.get_status(channel)
+            if status.run or status.run_status or self.channels[channel].run_status:
+                return True
+        return False
+
+    @property
+    def status_bits(self):
+        """The device info status of each channel, a change means something has started or stopped"""
+        if self.device_info is None:
+            return None
+        return self.device_info.ch1_status.value, self.device_info.ch2_status.value
+
+    def channel(self, channel):
+        """Returns the ChannelStatus for the channel, or None if the poller doesn't have it"""
+        if 0 <= channel < len(self.channels):
+            return self.channels[channel]
+        return None
+
+    def state_dict(self, now=None):
+        """The connection state, plus enough for the client to tell how old the data is"""
+        value = connection_state_dict(self.exception)
+        value.update({
+            "snapshot_version": self.version,
+            "snapshot_time": self.timestamp,
+            "snapshot_age": round(self.age(now), 3),
+        })
+        return value
+
+    def channel_event(self, channel):
+        """The snapshot of a single channel, encoded as a server-sent event"""
+        key = ("channel", channel)
+        event = self._events.get(key)
+        if event is None:
+            status = self.channel(channel)
+            data = status.to_primitive() if status is not None and self.exception is None else {}
+            data.update(self.state_dict())
+            event = self._events[key] = _encode_event("channel", self.version, data)
+        return event
+
+    def status_event(self):
+        """The device info along with every channel, encoded as a server-sent event"""
+        key = ("status",)
+        event = self._events.get(key)
+        if event is None:
+            data = {}
+            if self.exception is None:
+                data = self.device_info.to_primitive()
+                data["channels"] = [status.to_primitive() for status in self.channels]
+            data.update(self.state_dict())
+            event = self._events[key] = _encode_event("status", self.version, data)
+        return event
+
+
+def _encode_event(name, version, data):
+    return "id: {0}\nevent: {1}\ndata: {2}\n\n".format(version, name, json.dumps(data))
+
+
+def event_stream(poller, render, keepalive=STREAM_KEEPALIVE):
+    """
+    Generates server-sent events, one for each snapshot published by the poller.
+    :param render: called with each new snapshot, returns the encoded event
+    """
+    version = 0
+    while True:
+        snapshot = poller.wait_for_snapshot(version, keepalive)
+        if snapshot is None or snapshot.version == version:
+            yield ": keepalive\n\n"
+            continue
+
+        version = snapshot.version
+        yield render(snapshot)
+
+
+class TelemetryPoller(object):
+    """
+    Reads the device info and the status of every channel, publishing the results as a TelemetrySnapshot.
+    The charger is therefore read at the same rate regardless of how many clients are asking for /status
+    and /channel.
+
+    That rate is the interval while a channel is running, or has just changed state, and the idle_interval
+    otherwise.  Anything that's about to change the charger's state (starting or stopping an operation, say)
+    should call wake() to have the next poll happen straight away.
+
+    The polling thread is started lazily by ensure_running(), because threads do not survive the fork
+    when gunicorn preloads the app.
+    """
+
+    def __init__(self, comms, lock, interval=DEFAULT_POLL_INTERVAL, breaker=None, idle_interval=None,
+                 history=None, sessions=None):
+        self.comms = comms
+        self.lock = lock
+        self.interval = interval
+        self.idle_interval = idle_interval if idle_interval is not None else interval
+        self.breaker = breaker
+
+        # a TelemetryHistory and SessionStore, given every good snapshot
+        self.history = history
+        self.sessions = sessions
+
+        # the control register as last seen by note_control(), a change wakes the poller
+        self._control = None
+        self._wakeup = threading.Event()
+
+        # polls failed in a row, decides how hard to try to recover the transport
+        self.failures = 0
+
+        self._snapshot = None
+        self._version = 0
+        self._published = threading.Condition()
+        self._stopping = threading.Event()
+        self._start_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    @property
+    def snapshot(self):
+        return self._snapshot
+
+    def wait_for_snapshot(self, after_version, timeout=None):
+        """
+        Waits for a snapshot newer than after_version to be published.
+        :return: the latest snapshot, which is not newer than after_version if the timeout expired
+        """
+        with self._published:
+            if self._snapshot is None or self._snapshot.version <= after_version:
+                self._published.wait(timeout)
+            return self._snapshot
+
+    @property
+    def running(self):
+        return self._thread is not None and self._pid == os.getpid() and self._thread.is_alive()
+
+    def ensure_running(self):
+        """Starts the polling thread, unless it's already running in this process"""
+        if self.running:
+            return
+
+        with self._start_lock:
+            if self.running:
+                return
+
+            self._stopping.clear()
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="telemetry-poller")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self, timeout=None):
+        self._stopping.set()
+        self._wakeup.set()
+        if self.running:
+            self._thread.join(timeout)
+
+    def close(self, timeout=None):
+        """Stops polling and closes the sessions being recorded, for when the process is exiting"""
+        self.stop(timeout)
+        if self.sessions is not None:
+            self.sessions.close()
+
+    def poll(self):
+        """
+        Reads the charger once and publishes the result.  A failure publishes a snapshot containing the
+        exception (and the last good values) rather than raising.
+        :return: the new TelemetrySnapshot
+        """
+        if self.breaker is not None and self.breaker.is_open:
+            # the breaker's probe is looking for the charger, leave the device alone until it's found
+            return self._publish_failure(self.breaker.last_exception)
+
+        try:
+            # take the lock for each read, so that anything waiting to write to the charger can get in between
+            with self.lock.holding(Priority.Background):
+                info = self.comms.get_device_info()
+
+            # the slower changing parts of the channel status are only read now and then, unless a channel
+            # has just started or stopped doing something
+            previous = self._snapshot
+            tiered = previous is not None and previous.status_bits == (info.ch1_status.value, info.ch2_status.value)
+
+            channels = []
+            for channel in range(info.channel_count):
+                with self.lock.holding(Priority.Background):
+                    channels.append(self.comms.get_channel_status(channel, info.device_id, tiered=tiered))
+
+        except Exception, ex:
+            logger.warning("telemetry poll failed: {0}/{1}".format(ex, type(ex)))
+            self.failures += 1
+
+            if self.breaker is not None and self.breaker.record_failure(ex):
+                return self._publish_failure(ex)
+
+            # If the charger isn't plugged in. This could fail.
+            try:
+                with self.lock.holding(Priority.Background):
+                    self.comms.recover(self.failures, ex)
+            except Exception, reset_ex:
+                logger.error("Error resetting comms! Charger not plugged in? {0}".format(reset_ex))
+
+            return self._publish_failure(ex)
+
+        self.failures = 0
+        if self.breaker is not None:
+            self.breaker.record_success()
+
+        snapshot = self._publish(info, channels)
+        if self.history is not None:
+            self.history.record(snapshot)
+        if self.sessions is not None:
+            self.sessions.record(snapshot)
+        return snapshot
+
+    def wake(self):
+        """Polls again now, rather than waiting for the (possibly idle) interval to run out"""
+        self._wakeup.set()
+
+    def note_control(self, control):
+        """Wakes the poller if the control register has changed since it was last seen here"""
+        values = control.to_native() if control is not None else None
+        if values != self._control:
+            self._control = values
+            self.wake()
+
+    def next_interval(self, snapshot, previous=None):
+        """How long to wait, after taking this snapshot, before polling again"""
+        if snapshot.exception is not None or snapshot.active:
+            return self.interval
+
+        if previous is not None and previous.status_bits != snapshot.status_bits:
+            return self.interval
+
+        return self.idle_interval
+
+    def _publish_failure(self, exception):
+        # keep the last known values, alongside the reason they aren't current
+        previous = self._snapshot
+        if previous is not None:
+            return self._publish(previous.device_info, previous.channels, exception, previous.timestamp)
+        return self._publish(None, None, exception)
+
+    def _publish(self, device_info, channels, exception=None, timestamp=None):
+        with self._published:
+            self._version += 1
+            if timestamp is None:
+                timestamp = time.time()
+            snapshot = TelemetrySnapshot(self._version, timestamp, device_info, channels, exception)
+            self._snapshot = snapshot
+            self._published.notify_all()
+        return snapshot
+
+    def _run(self):
+        logger.info("telemetry poller started, interval is {0}s ({1}s when idle)".format(self.interval,
+                                                                                     self.idle_interval))
+        previous = None
+        while not self._stopping.is_set():
+            started = time.time()
+            self._wakeup.clear()
+            snapshot = self.poll()
+
+            interval = self.next_interval(snapshot, previous)
+            previous = snapshot
+            self._wakeup.wait(max(0.0, interval - (time.time() - started)))
+        logger.info("telemetry poller stopped")
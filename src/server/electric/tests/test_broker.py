@@ -0,0 +1,335 @@
+import multiprocessing
+import multiprocessing.util
+import os
+import shutil
+import signal
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+from electric import metrics
+from electric.history import TelemetryHistory
+from electric.icharger.broker import DeviceBroker, BrokerMaster, BrokerMetrics, BrokerTelemetry, BrokerSupervisor, \
+    LocalMaster, start_broker_process, CLOSE_TIMEOUT
+from electric.icharger.comms_layer import ChargerCommsManager, Operation
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.icharger.models import DEVICEID_4010_DUO
+from electric.priority_lock import PriorityLock
+from electric.sessions import SessionStore
+from electric.telemetry import TelemetryPoller
+
+
+def emulated_master():
+    return iChargerMaster(serial=EmulatorSerialFacade())
+
+
+def emulated_telemetry(master):
+    return TelemetryPoller(ChargerCommsManager(master=master), PriorityLock(), 0.01, idle_interval=60)
+
+
+def wait_for_version(telemetry, version):
+    deadline = time.time() + 5
+    snapshot = None
+    while time.time() < deadline:
+        snapshot = telemetry.wait_for_snapshot(version - 1, 0.1)
+        if snapshot is not None and snapshot.version >= version:
+            break
+    return snapshot
+
+
+class TestDeviceBroker(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "charger.sock")
+
+        self.broker = DeviceBroker(self.address, emulated_master())
+        self.broker.listen()
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.comms = ChargerCommsManager(master=BrokerMaster(self.address))
+
+    def tearDown(self):
+        self.broker.stop()
+        self.thread.join(1)
+        shutil.rmtree(self.directory)
+
+    def test_device_info(self):
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
+
+    def test_writes_are_seen_by_other_clients(self):
+        self.comms.set_beep_properties(beep_index=0, enabled=True, volume=2)
+        other = ChargerCommsManager(master=BrokerMaster(self.address))
+        self.assertEqual(2, other.get_system_storage().beep_volume_key)
+
+    def test_preset_changes_reach_the_other_caches(self):
+        generation = multiprocessing.Value('L', 0)
+        first = ChargerCommsManager(master=BrokerMaster(self.address), preset_generation=generation)
+        second = ChargerCommsManager(master=BrokerMaster(self.address), preset_generation=generation)
+        first.get_preset(0)
+
+        preset = second.get_preset(0)
+        preset.name = "Renamed"
+        second.save_preset_to_memory_slot(preset, 0)
+
+        self.assertEqual("Renamed", first.get_preset(0).name)
+
+    def test_device_errors_are_raised_in_the_client(self):
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.comms.charger.modbus_read_registers(0x4000, "H")
+
+        # and the connection is still good afterwards
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
+
+    def test_only_master_methods_are_brokered(self):
+        with self.assertRaises(ValueError):
+            self.comms.charger._call("__init__")
+
+    def test_missing_broker_is_an_io_error(self):
+        master = BrokerMaster(os.path.join(self.directory, "nobody-home.sock"), connect_attempts=1)
+        with self.assertRaises(IOError):
+            master.reset()
+
+    def test_clients_without_the_key_are_refused(self):
+        master = BrokerMaster(self.address, connect_attempts=1, authkey="not the key")
+        with self.assertRaises(IOError):
+            master.reset()
+
+        # ... and the broker carries on serving everyone else
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
+
+    def test_socket_is_private(self):
+        self.assertEqual(0600, stat.S_IMODE(os.stat(self.address).st_mode))
+
+    def test_shared_directory_is_refused(self):
+        os.chmod(self.directory, 0777)
+        try:
+            broker = DeviceBroker(self.address, emulated_master())
+            with self.assertRaises(IOError):
+                broker.listen()
+        finally:
+            os.chmod(self.directory, 0700)
+
+    def test_directory_is_made_private(self):
+        address = os.path.join(self.directory, "broker", "charger.sock")
+        broker = DeviceBroker(address, emulated_master())
+        broker.listen()
+        try:
+            self.assertEqual(0700, stat.S_IMODE(os.stat(os.path.dirname(address)).st_mode))
+        finally:
+            broker.listener.close()
+
+
+class TestBrokerTelemetry(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "charger.sock")
+
+        self.broker = DeviceBroker(self.address, emulated_master())
+        comms = ChargerCommsManager(master=LocalMaster(self.broker))
+        self.broker.telemetry = TelemetryPoller(comms, PriorityLock(), 0.01, idle_interval=60,
+                                                history=TelemetryHistory(100))
+        self.broker.listen()
+        self.thread = threading.Thread(target=self.broker.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.telemetry = BrokerTelemetry(self.address, follow_timeout=0.1)
+
+    def tearDown(self):
+        self.telemetry.stop(1)
+        self.broker.telemetry.stop(1)
+        self.broker.stop()
+        self.thread.join(1)
+        shutil.rmtree(self.directory)
+
+    def test_the_broker_polls_for_the_workers(self):
+        self.telemetry.ensure_running()
+        snapshot = wait_for_version(self.telemetry, 1)
+        self.assertIsNotNone(snapshot)
+        self.assertIsNone(snapshot.exception)
+        self.assertEqual(DEVICEID_4010_DUO, snapshot.device_info.device_id)
+        self.assertEqual(1, snapshot.channel(1).channel)
+        self.assertTrue(self.broker.telemetry.running)
+
+    def test_wake_reaches_the_broker(self):
+        self.telemetry.ensure_running()
+        first = wait_for_version(self.telemetry, 1)
+
+        # idle, so only a wake gets another poll in
+        self.telemetry.wake()
+        self.assertGreater(wait_for_version(self.telemetry, first.version + 1).version, first.version)
+
+    def test_history_is_the_brokers(self):
+        self.telemetry.ensure_running()
+        wait_for_version(self.telemetry, 1)
+        samples = self.telemetry.history.channel(0).query()
+        self.assertGreaterEqual(len(samples["time"]), 1)
+        self.assertIsNone(self.telemetry.history.channel(2))
+
+
+
+class TestBrokerProcess(unittest.TestCase):
+    def test_broker_in_its_own_process(self):
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "charger.sock")
+        process = start_broker_process(address, emulated_master)
+        try:
+            comms = ChargerCommsManager(master=BrokerMaster(address))
+            self.assertEqual(DEVICEID_4010_DUO, comms.get_device_info().device_id)
+            self.assertEqual(1, comms.get_channel_status(1).channel)
+        finally:
+            process.terminate()
+            process.join(1)
+            shutil.rmtree(directory)
+
+    def test_telemetry_from_the_broker_process(self):
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "charger.sock")
+        process = start_broker_process(address, emulated_master, telemetry_factory=emulated_telemetry)
+        telemetry = BrokerTelemetry(address, follow_timeout=0.1)
+        try:
+            telemetry.ensure_running()
+            good = wait_for_version(telemetry, 1)
+            self.assertIsNone(good.exception)
+            self.assertEqual(DEVICEID_4010_DUO, good.device_info.device_id)
+
+            # ... and once the broker has gone, saying so along with the last values seen
+            process.terminate()
+            process.join(1)
+            bad = wait_for_version(telemetry, good.version + 1)
+            self.assertIsInstance(bad.exception, IOError)
+            self.assertIs(good.device_info, bad.device_info)
+            self.assertEqual(good.timestamp, bad.timestamp)
+        finally:
+            telemetry.stop(1)
+            process.terminate()
+            process.join(1)
+            shutil.rmtree(directory)
+
+    def test_metrics_are_the_brokers_and_every_workers(self):
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "charger.sock")
+        # before the broker inherits them
+        metrics.REGISTRY.clear()
+        process = start_broker_process(address, emulated_master)
+        try:
+            comms = ChargerCommsManager(master=BrokerMaster(address))
+            comms.get_device_info()
+            metrics.request_retries.inc(("StatusResource",))
+
+            # a worker that has since exited
+            worker = multiprocessing.Process(target=BrokerMetrics(address).report)
+            worker.start()
+            worker.join(5)
+
+            text = BrokerMetrics(address).render()
+            # counted in the broker, where the transaction happened - not here as well
+            self.assertEqual(0, metrics.modbus_transaction_seconds.count(("4", "device_info")))
+            self.assertIn('electric_modbus_transaction_seconds_count{function_code="4",block="device_info"} 1', text)
+            # this worker's, and the one that exited (which inherited this one's count)
+            self.assertIn('electric_request_retries_total{resource="StatusResource"} 2', text)
+        finally:
+            process.terminate()
+            process.join(1)
+            shutil.rmtree(directory)
+
+    def test_the_app_connects_to_a_broker_started_on_its_own(self):
+        directory = tempfile.mkdtemp()
+        env = dict(os.environ, DEVICE_BROKER=os.path.join(directory, "charger.sock"), DEVICE_BROKER_AUTHKEY="sekrit",
+                   EMULATE_CHARGER="1", PYTHONPATH=os.pathsep.join(path for path in sys.path if path))
+        env.pop("TELEMETRY_POLL_INTERVAL", None)
+        broker = subprocess.Popen([sys.executable, "-m", "electric.icharger.broker"], env=env)
+        try:
+            output = subprocess.check_output([sys.executable, "-c", "\n".join((
+                "import electric.evil_global as evil_global",
+                "print evil_global.broker_supervisor",
+                "print evil_global.comms.get_device_info().device_id"))], env=env)
+            self.assertEqual(["None", str(DEVICEID_4010_DUO)], output.split())
+        finally:
+            broker.terminate()
+            broker.wait()
+            shutil.rmtree(directory)
+
+    def test_the_broker_records_and_closes_the_sessions(self):
+        directory = tempfile.mkdtemp()
+        address = os.path.join(directory, "charger.sock")
+        sessions = os.path.join(directory, "sessions")
+
+        def recording_telemetry(master):
+            telemetry = emulated_telemetry(master)
+            telemetry.sessions = SessionStore(sessions)
+            return telemetry
+
+        process = start_broker_process(address, emulated_master, telemetry_factory=recording_telemetry)
+        try:
+            comms = ChargerCommsManager(master=BrokerMaster(address))
+            comms.run_operation(Operation.Charge, 0, 0)
+            BrokerTelemetry(address).wake()
+
+            # a worker's view of the store
+            store = SessionStore(sessions)
+            deadline = time.time() + 5
+            while not store.session_ids() and time.time() < deadline:
+                time.sleep(0.01)
+            session_id = store.session_ids()[0]
+            self.assertTrue(store.is_running(session_id))
+            self.assertFalse(store.claim())
+
+            process.terminate()
+            process.join(CLOSE_TIMEOUT + 1)
+            self.assertEqual(0, process.exitcode)
+            self.assertFalse(store.is_running(session_id))
+        finally:
+            process.terminate()
+            process.join(1)
+            shutil.rmtree(directory)
+
+
+class TestBrokerSupervisor(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.address = os.path.join(self.directory, "charger.sock")
+        self.supervisor = BrokerSupervisor(self.address, emulated_master)
+        self.supervisor.start()
+        self.comms = ChargerCommsManager(master=BrokerMaster(self.address))
+
+    def tearDown(self):
+        self.supervisor.stop()
+        shutil.rmtree(self.directory)
+
+    def test_a_worker_exiting_leaves_the_broker_alone(self):
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
+
+        pid = os.fork()
+        if pid == 0:
+            # what a gunicorn worker forked from this process does as it exits
+            try:
+                self.supervisor.stop()
+                multiprocessing.util._exit_function()
+            finally:
+                os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertTrue(self.supervisor.process.is_alive())
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
+
+    def test_a_broker_that_died_is_restarted(self):
+        first = self.supervisor.process.pid
+        os.kill(first, signal.SIGKILL)
+
+        deadline = time.time() + 10
+        while self.supervisor.restarts == 0 and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertNotEqual(first, self.supervisor.process.pid)
+        self.assertEqual(DEVICEID_4010_DUO, self.comms.get_device_info().device_id)
@@ -0,0 +1,185 @@
+import json
+import multiprocessing
+import time
+import unittest
+
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.circuit_breaker import BreakerState, ChargerCircuitBreaker, is_device_absent
+from electric.icharger.broker import BrokerUnavailable
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.priority_lock import PriorityLock
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.facade = EmulatorSerialFacade()
+        self.comms = ChargerCommsManager(master=iChargerMaster(serial=self.facade))
+        self.breaker = ChargerCircuitBreaker(self.comms, PriorityLock(), threshold=3, probe_interval=0.01)
+
+    def tearDown(self):
+        testing_control.reset()
+        self.breaker.close()
+
+    def test_failures_are_classified(self):
+        self.assertTrue(is_device_absent(IOError("gone")))
+        self.assertFalse(is_device_absent(ModbusInvalidResponseError("garbled")))
+        self.assertFalse(is_device_absent(BrokerUnavailable("no broker")))
+
+    def test_losing_the_broker_does_not_open_it(self):
+        for attempt in range(10):
+            self.assertFalse(self.breaker.record_failure(BrokerUnavailable("no broker")))
+
+    def test_opens_after_repeated_absent_failures(self):
+        testing_control.usb_device_present = False
+        self.assertFalse(self.breaker.record_failure(IOError("1")))
+        self.assertFalse(self.breaker.record_failure(IOError("2")))
+        self.assertTrue(self.breaker.record_failure(IOError("3")))
+        self.assertEqual("3", str(self.breaker.last_exception))
+
+    def test_bad_responses_do_not_open_it(self):
+        for attempt in range(10):
+            self.assertFalse(self.breaker.record_failure(ModbusInvalidResponseError("garbled")))
+
+    def test_success_resets_the_count(self):
+        self.breaker.record_failure(IOError("1"))
+        self.breaker.record_failure(IOError("2"))
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.record_failure(IOError("3")))
+
+    def test_probe_closes_it_when_the_charger_returns(self):
+        testing_control.usb_device_present = False
+        for attempt in range(3):
+            self.breaker.record_failure(IOError("gone"))
+
+        self.assertFalse(self.breaker.probe())
+        self.assertTrue(self.breaker.is_open)
+
+        testing_control.usb_device_present = True
+        deadline = time.time() + 2
+        while self.breaker.is_open and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(self.breaker.is_open)
+
+
+class _CountingComms(object):
+    """Counts the probes, which always find the charger missing"""
+
+    def __init__(self):
+        self.resets = multiprocessing.Value('i', 0)
+
+    def reset(self):
+        with self.resets.get_lock():
+            self.resets.value += 1
+
+    def get_device_info(self):
+        raise IOError("still gone")
+
+
+def _check_the_breaker(breaker, checks):
+    for attempt in range(checks):
+        breaker.is_open
+        time.sleep(0.01)
+
+
+class TestSharedCircuitBreaker(unittest.TestCase):
+    def setUp(self):
+        self.state = BreakerState()
+        self.comms = _CountingComms()
+        self.breaker = ChargerCircuitBreaker(self.comms, PriorityLock(), threshold=1, probe_interval=0.01,
+                                             state=self.state)
+
+    def tearDown(self):
+        self.breaker.close()
+
+    def test_other_processes_see_it_open(self):
+        self.assertTrue(self.breaker.record_failure(IOError("gone")))
+
+        other = multiprocessing.Value('b', 0)
+
+        def check():
+            breaker = ChargerCircuitBreaker(_CountingComms(), PriorityLock(), state=self.state)
+            other.value = breaker.is_open and "gone" in str(breaker.last_exception)
+
+        process = multiprocessing.Process(target=check)
+        process.start()
+        process.join(5)
+        self.assertTrue(other.value)
+
+    def test_only_one_process_probes(self):
+        self.breaker.record_failure(IOError("gone"))
+
+        theirs = _CountingComms()
+        other = ChargerCircuitBreaker(theirs, PriorityLock(), probe_interval=0.01, state=self.state)
+        process = multiprocessing.Process(target=_check_the_breaker, args=(other, 20))
+        process.start()
+        process.join(5)
+
+        self.assertEqual(0, theirs.resets.value)
+        self.assertGreater(self.comms.resets.value, 0)
+
+    def test_a_probe_left_by_a_process_that_has_gone_is_taken_over(self):
+        # the process that opened it, and was probing, exits
+        process = multiprocessing.Process(target=self.breaker.record_failure, args=(IOError("gone"),))
+        process.start()
+        process.join(5)
+        self.assertEqual(process.pid, self.state.prober_pid.value)
+
+        _check_the_breaker(self.breaker, 20)
+        self.assertGreater(self.comms.resets.value, 0)
+
+
+class TestFailFast(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.client = application.test_client()
+        self.previous = evil_global.breaker
+
+        self.facade = EmulatorSerialFacade()
+        comms = ChargerCommsManager(master=iChargerMaster(serial=self.facade))
+        # never probes during the test
+        evil_global.breaker = ChargerCircuitBreaker(comms, PriorityLock(), probe_interval=60)
+
+        self.previous_comms = evil_global.comms
+        evil_global.comms = comms
+
+    def tearDown(self):
+        evil_global.breaker.close()
+        evil_global.breaker = self.previous
+        evil_global.comms = self.previous_comms
+        testing_control.reset()
+
+    def test_open_breaker_answers_without_the_charger(self):
+        for attempt in range(evil_global.breaker.threshold):
+            evil_global.breaker.record_failure(IOError("switched off"))
+
+        started = time.time()
+        resp = self.client.get("/system")
+        self.assertLess(time.time() - started, 1)
+        self.assertEqual(504, resp.status_code)
+
+        d = json.loads(resp.data)
+        self.assertEqual("disconnected", d["charger_presence"])
+        self.assertEqual("switched off", d["exception"])
+
+    def test_stop_is_tried_while_the_breaker_is_open(self):
+        for attempt in range(evil_global.breaker.threshold):
+            evil_global.breaker.record_failure(IOError("switched off"))
+
+        resp = self.client.put("/stop/0")
+        self.assertEqual(200, resp.status_code)
+        self.assertGreater(self.facade.charger.transactions, 0)
+
+        # ... and, as the charger answered it, the breaker is closed again
+        self.assertFalse(evil_global.breaker.is_open)
+
+    def test_missing_charger_stops_retrying(self):
+        testing_control.usb_device_present = False
+        resp = self.client.get("/system")
+        self.assertEqual(504, resp.status_code)
+        self.assertTrue(evil_global.breaker.is_open)
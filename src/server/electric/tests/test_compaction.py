@@ -0,0 +1,195 @@
+import fcntl
+import glob
+import json
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.compaction import SessionCompactor, RESCAN_INTERVAL
+from electric.icharger.comms_layer import Operation
+from electric.icharger.modbus_usb import testing_control
+from electric.sessions import SessionStore, SessionFile, RollupFile, CHUNK_RECORDS, SESSION_EXTENSION, \
+    INDEX_EXTENSION, ROLLUP_EXTENSION
+from electric.tests.test_telemetry import emulated_poller
+
+
+class TestSessionCompactor(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.store = SessionStore(self.directory)
+        self.poller = emulated_poller()
+        self.poller.sessions = self.store
+
+        # a charge of a few chunks, with a sample every second
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        self.poller.poll()
+        snapshot = self.poller.snapshot
+        started = snapshot.timestamp
+        for n in range(1, CHUNK_RECORDS * 3):
+            snapshot.timestamp = started + n
+            self.store.record(snapshot)
+        snapshot.channels[0].run_status = snapshot.channels[0].control_status = 0
+        snapshot.timestamp = started + CHUNK_RECORDS * 3
+        self.store.record(snapshot)
+
+        self.session = self.store.sessions()[0]
+        self.session_id = self.session.session_id
+        self.ended = time.time()
+        self.compactor = SessionCompactor(self.store, rollup_after=100, raw_retention=1000, bucket=10,
+                                          chunks_per_tick=2)
+
+    def tearDown(self):
+        self.poller.stop(1)
+        self.compactor.stop(1)
+        self.store.close()
+        shutil.rmtree(self.directory)
+        testing_control.reset()
+
+    def compact(self, now):
+        ticks = 0
+        while self.compactor.tick(now):
+            ticks += 1
+        return ticks
+
+    def test_recent_sessions_are_left_alone(self):
+        self.assertEqual(0, self.compact(self.ended + 10))
+        self.assertFalse(os.path.exists(self.store.path(self.session_id, ROLLUP_EXTENSION)))
+
+    def test_roll_up_is_done_a_few_chunks_at_a_time(self):
+        # four chunks (the last has the one sample that ended it), two a tick
+        self.assertEqual(2, self.compact(self.ended + 200))
+
+        rollup = RollupFile(self.store.path(self.session_id, ROLLUP_EXTENSION))
+        self.assertEqual(self.session.count, rollup.count)
+        self.assertEqual(10, rollup.resolution)
+
+        buckets = rollup.query()
+        raw = self.session.query()
+        self.assertTrue(len(raw["time"]) / 10 <= len(buckets["time"]) <= len(raw["time"]) / 10 + 2)
+        self.assertEqual(min(raw["curr_out_volts"]), buckets["curr_out_volts_min"][0])
+        self.assertTrue(buckets["curr_out_volts_min"][0] <= buckets["curr_out_volts"][0] <=
+                        buckets["curr_out_volts_max"][0])
+        self.assertEqual(len(raw["cells"][0]), len(buckets["cells"][0]))
+
+        # the raw samples are still there, and preferred
+        self.assertIsInstance(self.store.session(self.session_id), SessionFile)
+
+    def test_summary(self):
+        self.compact(self.ended + 200)
+        summary = self.store.session(self.session_id).info()["summary"]
+
+        self.assertEqual(self.session.count, summary["samples"])
+        self.assertEqual(self.session.ended, summary["ended"])
+        self.assertTrue(summary["energy_in_wh"] > 0)
+        self.assertEqual(0, summary["energy_out_wh"])
+        self.assertEqual(25.0, summary["peak_temp"])
+        self.assertEqual(2.5, summary["final_cell_ir"][0])
+        self.assertIsNotNone(summary["final_cell_spread"])
+
+    def test_raw_samples_are_deleted_after_retention(self):
+        self.compact(self.ended + 200)
+        self.compactor._next_scan = 0
+        self.compact(self.ended + 2000)
+
+        self.assertFalse(os.path.exists(self.store.path(self.session_id, SESSION_EXTENSION)))
+        self.assertFalse(os.path.exists(self.store.path(self.session_id, INDEX_EXTENSION)))
+
+        session = self.store.session(self.session_id)
+        self.assertIsInstance(session, RollupFile)
+        self.assertEqual([self.session_id], [found.session_id for found in self.store.sessions()])
+        self.assertEqual(self.session.ended, session.info()["ended"])
+
+    def test_nothing_is_done_while_recording(self):
+        self.poller.comms.run_operation(Operation.Charge, 1, 0)
+        self.poller.poll()
+        self.assertTrue(self.store.recording)
+        self.assertFalse(self.compactor.tick(self.ended + 200))
+        self.assertFalse(os.path.exists(self.store.path(self.session_id, ROLLUP_EXTENSION)))
+
+    def test_only_the_recording_process_compacts(self):
+        ticked = multiprocessing.Value('b', -1)
+
+        def tick():
+            # a worker, with the broker recording
+            ticked.value = SessionCompactor(SessionStore(self.directory), rollup_after=100).tick(self.ended + 200)
+
+        worker = multiprocessing.Process(target=tick)
+        worker.start()
+        worker.join(5)
+        self.assertEqual(0, ticked.value)
+        self.assertEqual([], glob.glob(self.store.path(self.session_id, ROLLUP_EXTENSION) + "*"))
+
+    def test_a_locked_session_is_left_alone(self):
+        with open(self.store.path(self.session_id, SESSION_EXTENSION), "rb") as f:
+            # as another process compacting it would
+            fcntl.flock(f, fcntl.LOCK_EX)
+            self.assertEqual(0, self.compact(self.ended + 200))
+
+        self.compactor._next_scan = 0
+        self.assertEqual(2, self.compact(self.ended + 200))
+        self.assertTrue(os.path.exists(self.store.path(self.session_id, ROLLUP_EXTENSION)))
+
+    def test_a_cut_short_roll_up_is_cleaned_up(self):
+        stale = self.store.path(self.session_id, ROLLUP_EXTENSION) + ".12345.tmp"
+        with open(stale, "wb") as f:
+            f.write("half a roll up")
+
+        self.compact(self.ended + 200)
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual([], glob.glob(self.store.path(self.session_id, ROLLUP_EXTENSION) + ".*"))
+
+    def test_a_session_being_read_survives_its_deletion(self):
+        self.compact(self.ended + 200)
+        reading = self.store.session(self.session_id)
+        self.compactor._next_scan = 0
+        self.compact(self.ended + 2000)
+
+        self.assertFalse(os.path.exists(self.store.path(self.session_id, SESSION_EXTENSION)))
+        self.assertEqual(self.session.count, len(reading.query()["time"]))
+
+    def test_store_is_only_rescanned_now_and_then(self):
+        self.assertFalse(self.compactor.tick(self.ended + 10))
+        self.assertFalse(self.compactor.tick(self.ended + 200))
+        self.assertTrue(self.compactor.tick(self.ended + 10 + RESCAN_INTERVAL))
+
+
+class TestCompactedSessionResource(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.client = application.test_client()
+        self.previous = evil_global.telemetry
+
+        self.poller = evil_global.telemetry = emulated_poller(interval=60)
+        self.store = self.poller.sessions = SessionStore(self.directory)
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        self.poller.poll()
+        self.poller.comms.stop_operation(0)
+        self.poller.poll()
+
+        compactor = SessionCompactor(self.store, rollup_after=0, raw_retention=0)
+        while compactor.tick():
+            pass
+
+    def tearDown(self):
+        self.poller.stop(1)
+        self.store.close()
+        evil_global.telemetry = self.previous
+        shutil.rmtree(self.directory)
+        testing_control.reset()
+
+    def test_compacted_session(self):
+        d = json.loads(self.client.get("/session").data)
+        info = d["sessions"][0]
+        self.assertEqual(60, info["resolution"])
+        self.assertEqual(2, info["summary"]["samples"])
+
+        d = json.loads(self.client.get("/session/{0}".format(info["id"])).data)
+        self.assertIn("curr_out_amps_max", d)
+        self.assertEqual(len(d["time"]), len(d["curr_out_amps"]))
@@ -0,0 +1,37 @@
+import unittest
+
+from electric.delta_codec import zigzag, unzigzag, encode_record, decode_records
+
+
+class TestDeltaCodec(unittest.TestCase):
+    def test_zigzag(self):
+        self.assertEqual([0, 1, 2, 3, 4], [zigzag(value) for value in (0, -1, 1, -2, 2)])
+        for value in (0, 1, -1, 63, -64, 1000, -100000, 2 ** 40):
+            self.assertEqual(value, unzigzag(zigzag(value)))
+
+    def test_round_trip(self):
+        records = [[1000, 3800, 3801, 0, 0, 0, -5],
+                   [2000, 3801, 3801, 0, 0, 0, -7],
+                   [3000, 3801, 3790, 0, 1, 0, 100000]]
+
+        data = bytearray()
+        previous = None
+        for record in records:
+            encode_record(record, previous, data)
+            previous = record
+
+        self.assertEqual(records, list(decode_records(data, 7)))
+        self.assertEqual(records, list(decode_records(str(data), 7)))
+
+    def test_unchanged_values_are_a_run(self):
+        record = [5] * 60
+        self.assertEqual(1, len(encode_record(record, record)))
+        self.assertEqual(bytearray([0x03, 0x0a]), encode_record([0, 0, -3], [0, 0, 0]))
+
+    def test_incomplete_record_is_ignored(self):
+        data = encode_record([1, 2, 3]) + encode_record([300, 2, 3], [1, 2, 3])
+        self.assertEqual([[1, 2, 3]], list(decode_records(data[:-2], 3)))
+
+    def test_too_many_values(self):
+        with self.assertRaises(ValueError):
+            list(decode_records(encode_record([0] * 5), 3))
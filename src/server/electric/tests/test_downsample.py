@@ -0,0 +1,82 @@
+import json
+import math
+import unittest
+
+import electric.evil_global as evil_global
+from electric import downsample as downsample_module
+from electric.app import application
+from electric.downsample import lttb_indexes, downsample
+from electric.history import TelemetryHistory
+from electric.icharger.modbus_usb import testing_control
+from electric.tests.test_telemetry import emulated_poller
+
+
+class TestLTTB(unittest.TestCase):
+    def setUp(self):
+        self.x = [float(n) for n in range(1000)]
+        self.y = [math.sin(n / 50.0) for n in range(1000)]
+        # a spike that an every-nth-sample would likely miss
+        self.y[501] = 10.0
+
+    def test_short_series_is_untouched(self):
+        self.assertEqual([0, 1, 2], lttb_indexes([0, 1, 2], [5, 6, 7], 10))
+
+    def test_keeps_the_ends_and_the_extremes(self):
+        indexes = lttb_indexes(self.x, self.y, 100)
+        self.assertEqual(100, len(indexes))
+        self.assertEqual(0, indexes[0])
+        self.assertEqual(999, indexes[-1])
+        self.assertEqual(sorted(indexes), indexes)
+        self.assertIn(501, indexes)
+
+    def test_too_few_points(self):
+        with self.assertRaises(ValueError):
+            lttb_indexes(self.x, self.y, 2)
+
+    @unittest.skipIf(downsample_module.numpy is None, "NumPy isn't installed")
+    def test_numpy_agrees(self):
+        self.assertEqual(lttb_indexes(self.x, self.y, 100, use_numpy=False),
+                         lttb_indexes(self.x, self.y, 100, use_numpy=True))
+
+    def test_columns_keep_the_same_samples(self):
+        samples = {"time": self.x, "curr_out_volts": self.y, "cells": [[n] for n in range(1000)], "channel": 1}
+        result = downsample(samples, 50, "curr_out_volts")
+
+        self.assertEqual(50, len(result["time"]))
+        self.assertEqual([[int(t)] for t in result["time"]], result["cells"])
+        self.assertEqual(1, result["channel"])
+
+        with self.assertRaises(ValueError):
+            downsample(samples, 50, "nonsense")
+
+
+class TestDownsampledHistory(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.client = application.test_client()
+        self.previous = evil_global.telemetry
+
+        self.poller = evil_global.telemetry = emulated_poller(interval=60)
+        self.poller.history = TelemetryHistory(100)
+        for poll in range(10):
+            self.poller.poll()
+
+    def tearDown(self):
+        self.poller.stop(1)
+        evil_global.telemetry = self.previous
+        testing_control.reset()
+
+    def test_max_points(self):
+        d = json.loads(self.client.get("/history/channel/0?max_points=5&by=curr_out_amps").data)
+        self.assertEqual(5, len(d["time"]))
+        self.assertEqual(5, len(d["cells"]))
+        self.assertEqual(0, d["channel"])
+
+    def test_bad_max_points(self):
+        self.assertEqual(400, self.client.get("/history/channel/0?max_points=2").status_code)
+        self.assertEqual(400, self.client.get("/history/channel/0?max_points=5&by=cells").status_code)
+
+    def test_max_points_that_are_not_finite(self):
+        for value in ("inf", "-inf", "nan"):
+            self.assertEqual(400, self.client.get("/history/channel/0?max_points=" + value).status_code)
+        self.assertEqual(400, self.client.get("/history/channel/0?since=nan").status_code)
@@ -0,0 +1,248 @@
+import multiprocessing
+import struct
+import unittest
+
+import modbus_tk.defines as cst
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+from electric.icharger.comms_layer import ChargerCommsManager, Operation, channel_blocks_for
+from electric.icharger.emulator import iChargerEmulator, EmulatorSerialFacade, MODBUS_HID_FRAME_TYPE
+from electric.icharger.modbus_usb import iChargerMaster
+from electric.icharger.models import DEVICEID_308_DUO, DEVICEID_4010_DUO
+from electric.priority_lock import PriorityLock
+from electric.telemetry import TelemetryPoller
+
+
+class TestEmulatorFraming(unittest.TestCase):
+    def setUp(self):
+        self.emulator = iChargerEmulator()
+
+    def test_read_response_is_big_endian_on_the_wire(self):
+        request = struct.pack(">BBBHH", 7, MODBUS_HID_FRAME_TYPE, cst.READ_INPUT_REGISTERS, 0x0000, 1)
+        response = self.emulator.transact(request)
+        self.assertEqual(64, len(response))
+
+        (length, frame_type, func_code, byte_count, device_id) = struct.unpack(">BBBBH", response[0:6])
+        self.assertEqual(6, length)
+        self.assertEqual(MODBUS_HID_FRAME_TYPE, frame_type)
+        self.assertEqual(cst.READ_INPUT_REGISTERS, func_code)
+        self.assertEqual(2, byte_count)
+        self.assertEqual(DEVICEID_4010_DUO, device_id)
+
+    def test_unmapped_address_is_an_error(self):
+        request = struct.pack(">BBBHH", 7, MODBUS_HID_FRAME_TYPE, cst.READ_INPUT_REGISTERS, 0x4000, 1)
+        response = self.emulator.transact(request)
+        (func_code, error) = struct.unpack(">BB", response[2:4])
+        self.assertEqual(cst.READ_INPUT_REGISTERS | 0x80, func_code)
+        self.assertEqual(0x02, error)
+
+    def test_oversized_read_is_an_error(self):
+        request = struct.pack(">BBBHH", 7, MODBUS_HID_FRAME_TYPE, cst.READ_INPUT_REGISTERS, 0x100, 31)
+        response = self.emulator.transact(request)
+        (func_code, error) = struct.unpack(">BB", response[2:4])
+        self.assertEqual(cst.READ_INPUT_REGISTERS | 0x80, func_code)
+        self.assertEqual(0x03, error)
+
+
+class TestEmulatedCharger(unittest.TestCase):
+    def setUp(self):
+        self.facade = EmulatorSerialFacade()
+        self.comms = ChargerCommsManager(master=iChargerMaster(serial=self.facade))
+
+    def test_device_info(self):
+        info = self.comms.get_device_info()
+        self.assertEqual(info.device_id, DEVICEID_4010_DUO)
+        self.assertEqual(info.device_sn, self.facade.charger.serial_number)
+        self.assertEqual(info.channel_count, 2)
+
+    def test_channel_status(self):
+        status = self.comms.get_channel_status(1)
+        self.assertEqual(status.channel, 1)
+        self.assertEqual(status.cell_count_with_voltage_values, 6)
+        self.assertAlmostEqual(status.curr_out_volts, status.cell_total_voltage)
+
+    def test_system_storage_round_trip(self):
+        storage = self.comms.get_system_storage()
+        storage.lcd_contrast = 20
+        self.comms.save_system_storage(storage)
+        self.assertEqual(self.comms.get_system_storage().lcd_contrast, 20)
+
+    def test_add_and_delete_preset(self):
+        preset = self.comms.get_preset(0)
+        preset.name = "Emulated"
+        added = self.comms.add_new_preset(preset)
+        self.assertEqual(added.memory_slot, 1)
+        self.assertEqual(added.name, "Emulated")
+        self.assertEqual(self.comms.get_full_preset_list().number_of_presets, 2)
+
+        self.comms.delete_preset_at_index(1)
+        self.assertEqual(self.comms.get_full_preset_list().number_of_presets, 1)
+
+    def test_charge_and_stop(self):
+        status = self.comms.run_operation(Operation.Charge, 0, 0)
+        self.assertTrue(status.run)
+        self.assertEqual(self.comms.get_channel_status(0).curr_out_amps, 2.0)
+
+        response = self.comms.stop_operation(0)
+        self.assertTrue(response.success)
+        self.assertFalse(self.comms.get_device_info().get_status(0).run)
+
+    def test_reads_are_coalesced(self):
+        emulator = self.facade.charger
+
+        before = emulator.transactions
+        self.comms.get_channel_status(0)
+        self.assertEqual(2, emulator.transactions - before)
+
+        before = emulator.transactions
+        self.comms.get_system_storage()
+        self.assertEqual(2, emulator.transactions - before)
+
+        before = emulator.transactions
+        self.comms.get_full_preset_list()
+        self.assertEqual(2, emulator.transactions - before)
+
+    def test_presets_are_cached(self):
+        emulator = self.facade.charger
+        preset = self.comms.get_preset(0)
+
+        before = emulator.transactions
+        self.assertEqual(preset.to_native(), self.comms.get_preset(0).to_native())
+        self.assertEqual(1, self.comms.get_full_preset_list().number_of_presets)
+        self.assertEqual(0, emulator.transactions - before)
+
+    def test_cached_index_can_be_modified_by_the_caller(self):
+        self.comms.get_full_preset_list().indexes[0] = 7
+        self.assertEqual(0, self.comms.get_full_preset_list().indexes[0])
+
+    def test_saving_a_preset_updates_the_cache(self):
+        preset = self.comms.get_preset(0)
+        preset.name = "Renamed"
+        self.comms.save_preset_to_memory_slot(preset, 0)
+        self.assertEqual("Renamed", self.comms.get_preset(0).name)
+
+    def test_invalidating_the_cache_rereads_the_charger(self):
+        self.comms.get_preset(0)
+
+        # someone else (the charger's own UI) renames the preset
+        other = ChargerCommsManager(master=iChargerMaster(serial=self.facade))
+        preset = other.get_preset(0)
+        preset.name = "Elsewhere"
+        other.save_preset_to_memory_slot(preset, 0)
+
+        self.assertNotEqual("Elsewhere", self.comms.get_preset(0).name)
+        self.comms.invalidate_preset_cache()
+        self.assertEqual("Elsewhere", self.comms.get_preset(0).name)
+
+    def test_recovery_leaves_the_other_caches_alone(self):
+        generation = multiprocessing.Value('L', 0)
+        first = ChargerCommsManager(master=iChargerMaster(serial=self.facade), preset_generation=generation)
+        second = ChargerCommsManager(master=iChargerMaster(serial=self.facade), preset_generation=generation)
+        first.get_preset(0)
+
+        second.recover(1)
+        before = self.facade.charger.transactions
+        first.get_preset(0)
+        self.assertEqual(0, self.facade.charger.transactions - before)
+
+    def test_run_operation_reloads_the_preset(self):
+        self.comms.get_preset(0)
+        before = self.facade.charger.transactions
+        self.comms.run_operation(Operation.Charge, 0, 0)
+        self.assertTrue(self.facade.charger.transactions - before > 4)
+        self.comms.stop_operation(0)
+
+    def test_missing_preset_is_not_found(self):
+        with self.assertRaises(Exception):
+            self.comms.get_preset(10)
+
+    def test_reading_past_the_register_map_fails(self):
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.comms.charger.modbus_read_registers(0x4000, "H")
+
+    def test_chargers_are_independent(self):
+        other = ChargerCommsManager(master=iChargerMaster(
+            serial=EmulatorSerialFacade(iChargerEmulator(device_id=DEVICEID_308_DUO, serial_number="EMU00000002"))))
+
+        self.comms.set_beep_properties(beep_index=0, enabled=True, volume=2)
+        self.assertEqual(self.comms.get_system_storage().beep_volume_key, 2)
+        self.assertEqual(other.get_system_storage().beep_volume_key, 5)
+        self.assertEqual(other.get_device_info().device_id, DEVICEID_308_DUO)
+
+
+class TestChannelTiers(unittest.TestCase):
+    def setUp(self):
+        self.facade = EmulatorSerialFacade()
+        self.emulator = self.facade.charger
+        self.comms = ChargerCommsManager(master=iChargerMaster(serial=self.facade))
+
+    def transactions(self, read):
+        before = self.emulator.transactions
+        result = read()
+        return result, self.emulator.transactions - before
+
+    def test_tiered_read_only_reads_the_live_registers(self):
+        (full, count) = self.transactions(lambda: self.comms.get_channel_status(0))
+        self.assertEqual(2, count)
+
+        (tiered, count) = self.transactions(lambda: self.comms.get_channel_status(0, tiered=True))
+        self.assertEqual(1, count)
+        self.assertEqual(full.cycle_count, tiered.cycle_count)
+        self.assertEqual(full.run_status, tiered.run_status)
+        self.assertEqual([cell.ir for cell in full.cells], [cell.ir for cell in tiered.cells])
+
+    def test_old_tiers_are_read_again(self):
+        self.comms.get_channel_status(1)
+        for (key, (read_at, data)) in self.comms._channel_blocks.items():
+            if key == (1, "cell_balance"):
+                self.comms._channel_blocks[key] = (read_at - 60, data)
+
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(1, tiered=True))
+        self.assertEqual(2, count)
+
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(0, tiered=True))
+        self.assertEqual(2, count)
+
+    def test_orders_invalidate_the_tiers(self):
+        self.comms.get_channel_status(0)
+        self.comms.run_operation(Operation.Charge, 0, 0)
+
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(0, tiered=True))
+        self.assertEqual(2, count)
+        self.assertEqual(1, status.run_status)
+
+    def test_a_finished_operation_is_seen_by_the_poller(self):
+        poller = TelemetryPoller(self.comms, PriorityLock(), 60)
+        self.comms.run_operation(Operation.Charge, 0, 0)
+        poller.poll()
+        self.assertEqual(1, poller.poll().channel(0).run_status)
+
+        # finishing on its own, rather than being told to stop - the status bits in the device info change
+        self.emulator.channels[0].stop()
+        self.emulator._refresh_channel(0)
+        self.assertEqual(0, poller.poll().channel(0).run_status)
+
+    def test_only_the_blocks_asked_for_are_read(self):
+        (full, count) = self.transactions(lambda: self.comms.get_channel_status(0))
+
+        blocks = channel_blocks_for({"curr_out_volts": None, "run_status": None})
+        self.assertEqual(set(["header", "status"]), blocks)
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(0, blocks=blocks))
+        self.assertEqual(2, count)
+        self.assertEqual(full.curr_out_volts, status.curr_out_volts)
+        self.assertEqual(full.run_status, status.run_status)
+        self.assertEqual(0, status.cycle_count)
+
+        blocks = channel_blocks_for({"cells": {"v": None}, "curr_out_amps": None})
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(0, blocks=blocks))
+        self.assertEqual(1, count)
+        self.assertEqual([cell.voltage for cell in full.cells], [cell.voltage for cell in status.cells])
+
+        (status, count) = self.transactions(lambda: self.comms.get_channel_status(0, blocks=set()))
+        self.assertEqual(0, count)
+
+    def test_unknown_fields(self):
+        with self.assertRaises(ValueError):
+            channel_blocks_for({"volts": None})
+        with self.assertRaises(ValueError):
+            channel_blocks_for({"cells": {"volts": None}})
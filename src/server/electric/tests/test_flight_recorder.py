@@ -0,0 +1,94 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+import electric.evil_global as evil_global
+from electric import flight_recorder
+from electric.app import application
+from electric.flight_recorder import FlightRecorder
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+
+
+class TestFlightRecorder(unittest.TestCase):
+    def test_keeps_the_most_recent(self):
+        recorder = FlightRecorder(capacity=3)
+        for n in range(5):
+            recorder.record(float(n), 0.001, 4, n, 1, bytearray([n, 0x30]), bytearray([0x10, 0x30, 4, n]), None)
+
+        entries = recorder.entries()
+        self.assertEqual(3, len(recorder))
+        self.assertEqual([2, 3, 4], [entry["addr"] for entry in entries])
+        self.assertEqual("0430", entries[-1]["request"])
+        self.assertEqual("10300404", entries[-1]["response"])
+
+    def test_long_frames_are_truncated(self):
+        recorder = FlightRecorder(capacity=1)
+        recorder.record(0.0, 0.0, 4, 0, 1, bytearray(100), None, ValueError("bad"))
+
+        (entry,) = recorder.entries()
+        self.assertEqual(flight_recorder.FRAME_LEN * 2, len(entry["request"]))
+        self.assertEqual("", entry["response"])
+        self.assertEqual("ValueError: bad", entry["exception"])
+
+    def test_master_records_its_transactions(self):
+        testing_control.reset()
+        flight_recorder.RECORDER.clear()
+        master = iChargerMaster(serial=EmulatorSerialFacade())
+
+        master.modbus_read_registers(0x0000, "h12sHHHHHH")
+        with self.assertRaises(ModbusInvalidResponseError):
+            master.modbus_read_registers(0x4000, "H")
+
+        (good, bad) = master.recent_transactions()
+        self.assertEqual((4, 0x0000, 13), (good["function_code"], good["addr"], good["quant"]))
+        self.assertEqual("0730040000000d", good["request"])
+        self.assertIsNone(good["exception"])
+        self.assertEqual(0x4000, bad["addr"])
+        self.assertIn("MB_EX_ILLEGAL_DATA_ADDRESS", bad["exception"])
+
+
+class TestTransactionDumps(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        evil_global.breaker.close()
+        flight_recorder.RECORDER.clear()
+        self.client = application.test_client()
+        self.previous = evil_global.comms
+        evil_global.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+
+        self.directory = tempfile.mkdtemp()
+        self.previous_directory = flight_recorder.DUMP_DIRECTORY
+        flight_recorder.DUMP_DIRECTORY = self.directory
+
+    def tearDown(self):
+        flight_recorder.DUMP_DIRECTORY = self.previous_directory
+        evil_global.comms = self.previous
+        testing_control.reset()
+        shutil.rmtree(self.directory)
+
+    def test_transactions_endpoint(self):
+        self.client.get("/control")
+
+        resp = self.client.get("/transactions")
+        self.assertEqual(200, resp.status_code)
+        (entry,) = json.loads(resp.data)["transactions"]
+        self.assertEqual(0x8000, entry["addr"])
+
+    def test_dumped_when_the_retries_run_out(self):
+        self.client.get("/control")
+        testing_control.modbus_read_should_fail = True
+
+        resp = self.client.get("/control")
+        self.assertEqual(504, resp.status_code)
+
+        (name,) = os.listdir(self.directory)
+        with open(os.path.join(self.directory, name)) as f:
+            dump = json.load(f)
+        self.assertIn("ControlRegisterResource", dump["reason"])
+        self.assertEqual(0x8000, dump["transactions"][0]["addr"])
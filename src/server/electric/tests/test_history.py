@@ -0,0 +1,112 @@
+import json
+import sys
+import unittest
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.history import ChannelHistory, TelemetryHistory, capacity_for, MAX_CELLS
+from electric.icharger.modbus_usb import testing_control
+from electric.tests.test_telemetry import emulated_poller
+
+
+class TestChannelHistory(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.poller = emulated_poller()
+        self.status = self.poller.poll().channel(0)
+        self.history = ChannelHistory(5)
+
+    def tearDown(self):
+        self.poller.stop(1)
+        testing_control.reset()
+
+    def test_capacity(self):
+        self.assertEqual(14400, capacity_for(2, 0.5))
+        self.assertEqual(1, capacity_for(0, 0.5))
+
+    def test_record_and_query(self):
+        self.history.record(100.0, self.status)
+        samples = self.history.query()
+
+        self.assertEqual([100.0], samples["time"])
+        self.assertAlmostEqual(self.status.curr_out_volts, samples["curr_out_volts"][0], places=3)
+        self.assertAlmostEqual(self.status.curr_int_temp, samples["curr_int_temp"][0], places=3)
+        self.assertEqual([cell.voltage for cell in self.status.cells], samples["cells"][0])
+
+    def test_oldest_samples_are_overwritten(self):
+        for timestamp in range(8):
+            self.history.record(float(timestamp), self.status)
+        self.assertEqual(5, len(self.history))
+        self.assertEqual([3.0, 4.0, 5.0, 6.0, 7.0], self.history.query()["time"])
+
+    def test_time_range(self):
+        for timestamp in range(8):
+            self.history.record(float(timestamp), self.status)
+        self.assertEqual([4.0, 5.0, 6.0], self.history.query(since=3.5, until=6)["time"])
+        self.assertEqual([6.0, 7.0], self.history.query(since=6)["time"])
+        self.assertEqual([], self.history.query(until=2)["time"])
+
+    def test_step(self):
+        history = ChannelHistory(20)
+        for timestamp in range(10):
+            history.record(timestamp * 0.5, self.status)
+        self.assertEqual([0.0, 1.0, 2.0, 3.0, 4.0], history.query(step=1)["time"])
+        self.assertEqual([1.0, 2.5, 4.0], history.query(since=1, step=1.5)["time"])
+
+    def test_storage_is_columnar(self):
+        # a sample is a few dozen bytes, rather than a model or dict per sample
+        history = ChannelHistory(1000)
+        size = sum(sys.getsizeof(column) for column in history._columns.values())
+        size += sys.getsizeof(history._times) + sys.getsizeof(history._cells) + sys.getsizeof(history._cell_counts)
+        self.assertLess(size, 1000 * (8 + 6 * 4 + 1 + MAX_CELLS * 2) + 1024)
+
+    def test_failed_snapshots_are_not_recorded(self):
+        history = TelemetryHistory(10)
+        self.poller.history = history
+        self.poller.poll()
+        testing_control.usb_device_present = False
+        self.poller.poll()
+
+        self.assertEqual(1, len(history.channel(0)))
+        self.assertEqual(1, len(history.channel(1)))
+
+
+class TestHistoryResource(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.client = application.test_client()
+        self.previous = evil_global.telemetry
+
+        self.poller = evil_global.telemetry = emulated_poller(interval=60)
+        self.poller.history = TelemetryHistory(100)
+        self.poller.poll()
+        self.poller.poll()
+
+    def tearDown(self):
+        self.poller.stop(1)
+        evil_global.telemetry = self.previous
+        testing_control.reset()
+
+    def test_channel_history(self):
+        resp = self.client.get("/history/channel/1")
+        self.assertEqual(200, resp.status_code)
+        d = json.loads(resp.data)
+
+        # the poller's thread may have added one more by now
+        self.assertEqual(1, d["channel"])
+        self.assertGreaterEqual(len(d["time"]), 2)
+        self.assertEqual(len(d["time"]), len(d["curr_out_amps"]))
+        self.assertEqual(len(d["time"]), len(d["cells"]))
+
+    def test_since(self):
+        first = self.poller.history.channel(0).query()["time"][0]
+        d = json.loads(self.client.get("/history/channel/0?since={0}".format(first + 3600)).data)
+        self.assertEqual([], d["time"])
+
+    def test_bad_parameters(self):
+        self.assertEqual(400, self.client.get("/history/channel/0?step=often").status_code)
+        self.assertEqual(403, self.client.get("/history/channel/2").status_code)
+
+    def test_history_requires_the_poller(self):
+        evil_global.telemetry = None
+        self.assertEqual(503, self.client.get("/history/channel/0").status_code)
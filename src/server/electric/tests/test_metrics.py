@@ -0,0 +1,104 @@
+import unittest
+
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+from electric import metrics
+from electric.app import application
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, register_block, testing_control
+from electric.priority_lock import PriorityLock, Priority
+
+
+class TestMetricTypes(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter("test_things_total", "Things", ("kind",))
+        counter.inc(("a",))
+        counter.inc(("a",), 2)
+        counter.inc(("b\"",))
+
+        self.assertEqual(3, counter.value(("a",)))
+        self.assertEqual(["# HELP test_things_total Things",
+                          "# TYPE test_things_total counter",
+                          'test_things_total{kind="a"} 3',
+                          'test_things_total{kind="b\\""} 1'], counter.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Durations", buckets=(0.1, 1.0))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+
+        self.assertEqual(3, histogram.count())
+        self.assertEqual(["# HELP test_seconds Durations",
+                          "# TYPE test_seconds histogram",
+                          'test_seconds_bucket{le="0.1"} 2',
+                          'test_seconds_bucket{le="1.0"} 2',
+                          'test_seconds_bucket{le="+Inf"} 3',
+                          'test_seconds_sum 5.15',
+                          'test_seconds_count 3'], histogram.render())
+
+    def test_snapshots_from_several_processes_add_up(self):
+        registry = metrics.Registry()
+        counter = registry.counter("test_things_total", "Things", ("kind",))
+        histogram = registry.histogram("test_seconds", "Durations", buckets=(0.1, 1.0))
+        counter.inc(("a",))
+        histogram.observe(0.05)
+
+        other = {"test_things_total": {("a",): 2, ("b",): 1}, "test_seconds": {(): ([0, 1, 0], 0.5)}}
+        total = metrics.merge((registry.snapshot(), other))
+        self.assertEqual({("a",): 3, ("b",): 1}, total["test_things_total"])
+        self.assertEqual([1, 1, 0], list(total["test_seconds"][()][0]))
+
+        text = registry.render(total)
+        self.assertIn('test_things_total{kind="a"} 3', text)
+        self.assertIn('test_seconds_count 2', text)
+
+        # and the registry itself is untouched
+        self.assertEqual(1, counter.value(("a",)))
+
+
+class TestInstrumentation(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        metrics.REGISTRY.clear()
+        self.master = iChargerMaster(serial=EmulatorSerialFacade())
+
+    def test_register_blocks(self):
+        self.assertEqual("device_info", register_block(0x0000))
+        self.assertEqual("channel_2", register_block(0x0200 + 57))
+        self.assertEqual("system_storage", register_block(0x8400 + 30))
+        self.assertEqual("preset", register_block(0x8c00 + 82))
+        self.assertEqual("other", register_block(0x4000))
+
+    def test_transactions_are_timed(self):
+        self.master.modbus_read_registers(0x0100, "16H")
+        self.master.modbus_write_registers(0x8000 + 3, (0,))
+
+        self.assertEqual(1, metrics.modbus_transaction_seconds.count(("4", "channel_1")))
+        self.assertEqual(1, metrics.modbus_transaction_seconds.count(("16", "control")))
+
+    def test_failed_transactions_are_counted(self):
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.master.modbus_read_registers(0x4000, "H")
+        self.assertEqual(1, metrics.modbus_errors.value(("4", "other")))
+
+    def test_resets_are_counted(self):
+        self.master.reset()
+        self.assertEqual(1, metrics.transport_resets.value())
+
+    def test_lock_wait_and_hold(self):
+        lock = PriorityLock()
+        with lock.holding(Priority.Write):
+            pass
+        self.assertEqual(1, metrics.lock_wait_seconds.count(("write",)))
+        self.assertEqual(1, metrics.lock_hold_seconds.count(("write",)))
+
+    def test_metrics_endpoint(self):
+        client = application.test_client()
+        client.get("/channel/5")
+
+        resp = client.get("/metrics")
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.content_type.startswith("text/plain"))
+        self.assertIn('electric_request_seconds_count{resource="channelresource",method="GET",status="403"} 1',
+                      resp.data)
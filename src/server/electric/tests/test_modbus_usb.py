@@ -6,8 +6,14 @@ import modbus_tk.defines as cst
 from modbus_tk.exceptions import ModbusInvalidRequestError, ModbusInvalidResponseError
 
 import electric.evil_global as evil_global
+from electric import metrics
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
 from electric.icharger.modbus_usb import TestingControlException
 from electric.icharger.modbus_usb import USBSerialFacade, iChargerQuery, MODBUS_HID_FRAME_TYPE
+from electric.icharger.modbus_usb import iChargerMaster, iChargerRtuMaster
+from electric.icharger.modbus_usb import plan_register_reads, READ_REG_COUNT_MAX, WRITE_REG_COUNT_MAX, \
+    REOPEN_AFTER_FAILURES
 from electric.icharger.modbus_usb import testing_control
 from electric.icharger.models import Control
 
@@ -76,6 +82,14 @@ class TestChargerQuery(unittest.TestCase):
             self.query.parse_response(response)
         self.assertIn("isn't the same as the request func_code", str(context.exception))
 
+    def test_read_response_words_are_byte_swapped(self):
+        pdu = struct.pack(">BHH", cst.READ_INPUT_REGISTERS, 0x100, 2)
+        self.query.build_request(pdu, "abc this doesn't matter")
+        response = struct.pack(">BBBBHH", 8, MODBUS_HID_FRAME_TYPE, cst.READ_INPUT_REGISTERS, 4, 0x1234, 0xabcd)
+        data = self.query.parse_response(response)
+        self.assertEqual(struct.pack("=BB", cst.READ_INPUT_REGISTERS, 4), data[0:2])
+        self.assertEqual((0x1234, 0xabcd), struct.unpack("<HH", data[2:]))
+
     def test_short_response_is_caught(self):
         pdu = struct.pack(">BHH", cst.READ_HOLDING_REGISTERS, 200, 7)
         self.query.build_request(pdu, "abc this doesn't matter")
@@ -86,6 +100,135 @@ class TestChargerQuery(unittest.TestCase):
         self.assertIn("Response length is invalid", str(context.exception))
 
 
+class TestReadPlanner(unittest.TestCase):
+    def test_contiguous_blocks_are_merged(self):
+        plan = plan_register_reads([(0x100, "LlhHHlhh"), (0x100 + 11, "16H")])
+        self.assertEqual([(0x100, 27, [0, 1])], plan)
+
+    def test_channel_input_is_a_single_run(self):
+        plan = plan_register_reads([(0x100, "LlhHHlhh"), (0x100 + 11, "16H"), (0x100 + 27, "16B"),
+                                    (0x100 + 35, "16H"), (0x100 + 51, "7H")])
+        self.assertEqual([(0x100, 58, [0, 1, 2, 3, 4])], plan)
+
+    def test_small_gaps_are_read_through(self):
+        plan = plan_register_reads([(0x8400, "4H"), (0x8400 + 6, "2H")], max_gap=2)
+        self.assertEqual([(0x8400, 8, [0, 1])], plan)
+
+        plan = plan_register_reads([(0x8400, "4H"), (0x8400 + 6, "2H")], max_gap=1)
+        self.assertEqual(2, len(plan))
+
+    def test_gaps_are_not_read_if_it_costs_a_transaction(self):
+        plan = plan_register_reads([(0x100, "{0}H".format(READ_REG_COUNT_MAX)),
+                                    (0x100 + READ_REG_COUNT_MAX + 2, "{0}H".format(READ_REG_COUNT_MAX - 1))], max_gap=4)
+        self.assertEqual(2, len(plan))
+
+    def test_overlapping_and_unordered_requests(self):
+        plan = plan_register_reads([(0x8800 + 16, "32B"), (0x8800, "H"), (0x8800 + 1, "32B")])
+        self.assertEqual([(0x8800, 32, [1, 2, 0])], plan)
+
+
+class TestMaster(unittest.TestCase):
+    def setUp(self):
+        testing_control.usb_device_present = True
+        self.facade = EmulatorSerialFacade()
+        self.master = iChargerMaster(serial=self.facade)
+        self.rtu_master = iChargerRtuMaster(serial=self.facade)
+
+    def test_reads_match_the_rtu_master(self):
+        for (addr, fmt, func_code) in ((0x0000, "h12sHHHHHH", cst.READ_INPUT_REGISTERS),
+                                       (0x0100 + 2, "lhHHlhh", cst.READ_INPUT_REGISTERS),
+                                       (0x8400, "21H", cst.READ_HOLDING_REGISTERS),
+                                       (0x8c00, "H38sLBB7cHB", cst.READ_HOLDING_REGISTERS)):
+            self.assertEqual(self.rtu_master.modbus_read_registers(addr, fmt, function_code=func_code),
+                             self.master.modbus_read_registers(addr, fmt, function_code=func_code))
+
+    def test_write_then_read(self):
+        self.assertEqual((0x84,), self.master.modbus_write_registers(0x8400 + 2, (7, 0xfffe)))
+        self.assertEqual((7, 0xfffe), self.master.modbus_read_registers(0x8400 + 2, "2H", cst.READ_HOLDING_REGISTERS))
+
+    def test_shorter_request_after_a_longer_one(self):
+        self.master.modbus_write_registers(0x8400, range(WRITE_REG_COUNT_MAX))
+        self.assertEqual((0, 1), self.master.modbus_read_registers(0x8400, "2H", cst.READ_HOLDING_REGISTERS))
+        self.assertFalse(any(self.master._report[8:]))
+
+    def test_error_response_raises(self):
+        with self.assertRaises(ModbusInvalidResponseError) as context:
+            self.master.modbus_read_registers(0x4000, "H")
+        self.assertIn("MB_EX_ILLEGAL_DATA_ADDRESS", str(context.exception))
+
+    def test_wrong_function_code_raises(self):
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.master.modbus_read_registers(0x8400, "H", function_code=cst.READ_INPUT_REGISTERS)
+
+    def test_oversized_write_is_refused(self):
+        with self.assertRaises(ModbusInvalidRequestError):
+            self.master.modbus_write_registers(0x8400, range(WRITE_REG_COUNT_MAX + 1))
+
+    def test_read_fails_under_testing_control(self):
+        testing_control.modbus_read_should_fail = True
+        try:
+            with self.assertRaises(TestingControlException):
+                self.master.modbus_read_registers(0x0000, "H")
+        finally:
+            testing_control.modbus_read_should_fail = False
+
+
+class TestTransportRecovery(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        metrics.REGISTRY.clear()
+        self.facade = EmulatorSerialFacade()
+        self.master = iChargerMaster(serial=self.facade)
+        self.master.open()
+
+    def leave_stale_response(self):
+        # as if an earlier read of the device info had timed out, its response arriving late
+        self.facade.write_report(bytearray("\x00\x07\x30\x04\x00\x00\x00\x0d"))
+
+    def test_stale_response_is_skipped(self):
+        self.leave_stale_response()
+        self.master.modbus_write_registers(0x8400 + 2, (7, 8))
+
+        self.assertEqual((7, 8), self.master.modbus_read_registers(0x8400 + 2, "2H", cst.READ_HOLDING_REGISTERS))
+        self.assertEqual(1, metrics.transport_recovery.value(("stale",)))
+        self.assertEqual(0, metrics.transport_recovery.value(("retry",)))
+
+    def test_garbled_response_is_retried(self):
+        self.master.modbus_write_registers(0x8400 + 2, (7, 8))
+        self.facade._responses.append(bytearray(64))
+
+        self.assertEqual((7, 8), self.master.modbus_read_registers(0x8400 + 2, "2H", cst.READ_HOLDING_REGISTERS))
+        self.assertEqual(1, metrics.transport_recovery.value(("retry",)))
+        self.assertEqual(1, metrics.transport_recovery.value(("drain",)))
+
+    def test_garbled_write_response_is_not_retried(self):
+        self.facade._responses.append(bytearray(64))
+
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.master.modbus_write_registers(0x8400 + 2, (7, 8))
+        self.assertEqual(0, metrics.transport_recovery.value(("retry",)))
+
+    def test_error_response_is_not_retried(self):
+        with self.assertRaises(ModbusInvalidResponseError):
+            self.master.modbus_read_registers(0x4000, "H")
+        self.assertEqual(0, metrics.transport_recovery.value(("retry",)))
+
+    def test_recovery_ladder(self):
+        self.leave_stale_response()
+        self.master.recover(1)
+        self.assertEqual(0, len(self.facade._responses))
+        self.assertEqual(0, metrics.transport_resets.value())
+
+        self.master.recover(REOPEN_AFTER_FAILURES)
+        self.assertEqual(1, metrics.transport_resets.value())
+        self.assertEqual(1, metrics.transport_recovery.value(("reopen",)))
+
+    def test_absent_charger_is_reopened(self):
+        comms = ChargerCommsManager(master=self.master)
+        comms.recover(1, IOError("gone"))
+        self.assertEqual(1, metrics.transport_resets.value())
+
+
 class TestSerialFacade(unittest.TestCase):
     def setUp(self):
         testing_control.reset()
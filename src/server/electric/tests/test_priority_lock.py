@@ -0,0 +1,90 @@
+import multiprocessing
+import os
+import threading
+import time
+import unittest
+
+from electric.priority_lock import PriorityLock, Priority
+
+
+def wait_until(condition, timeout=2):
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.001)
+    return condition()
+
+
+class TestPriorityLock(unittest.TestCase):
+    def setUp(self):
+        self.lock = PriorityLock()
+        self.order = []
+
+    def _waiter(self, priority):
+        def run():
+            with self.lock.holding(priority):
+                self.order.append(priority)
+
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        self.assertTrue(wait_until(lambda: self.lock.waiting(priority) == 1))
+        return thread
+
+    def test_highest_priority_goes_first(self):
+        self.lock.acquire(Priority.Interactive)
+        threads = [self._waiter(Priority.Background), self._waiter(Priority.Interactive),
+                   self._waiter(Priority.Emergency), self._waiter(Priority.Write)]
+        self.lock.release()
+
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual([Priority.Emergency, Priority.Write, Priority.Interactive, Priority.Background], self.order)
+
+    def test_yield_lets_a_stop_in(self):
+        with self.lock.holding(Priority.Background):
+            self.assertFalse(self.lock.yield_to_higher(Priority.Background))
+
+            thread = self._waiter(Priority.Emergency)
+            self.assertTrue(self.lock.yield_to_higher(Priority.Background))
+            self.assertEqual([Priority.Emergency], self.order)
+
+        thread.join(2)
+
+    def test_equal_priority_does_not_yield(self):
+        with self.lock.holding(Priority.Write):
+            thread = self._waiter(Priority.Write)
+            self.assertFalse(self.lock.yield_to_higher(Priority.Write))
+        thread.join(2)
+        self.assertEqual([Priority.Write], self.order)
+
+    def test_plain_with_statement(self):
+        with self.lock:
+            self.assertEqual(1, self.lock._held.value)
+        self.assertEqual(0, self.lock._held.value)
+
+    def test_a_waiter_that_died_is_forgotten(self):
+        self.lock.acquire(Priority.Interactive)
+
+        # a worker waiting to stop a charge is killed
+        worker = multiprocessing.Process(target=self.lock.acquire, args=(Priority.Emergency,))
+        worker.start()
+        self.assertTrue(wait_until(lambda: self.lock.waiting(Priority.Emergency) == 1))
+        worker.terminate()
+        worker.join(2)
+
+        self.lock.release()
+        thread = threading.Thread(target=self.lock.acquire, args=(Priority.Background,))
+        thread.daemon = True
+        thread.start()
+        thread.join(2)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual(0, self.lock.waiting(Priority.Emergency))
+
+    def test_a_holder_that_died_is_released(self):
+        worker = multiprocessing.Process(target=self.lock.acquire, args=(Priority.Write,))
+        worker.start()
+        worker.join(2)
+        self.assertEqual(1, self.lock._held.value)
+
+        with self.lock.holding(Priority.Background):
+            self.assertEqual(os.getpid(), self.lock._holder_pid.value)
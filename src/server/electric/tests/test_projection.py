@@ -0,0 +1,85 @@
+import json
+import unittest
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.icharger.models import ChannelStatus, DeviceInfo
+from electric.projection import parse_fields, validate_fields, project
+
+
+class TestProjection(unittest.TestCase):
+    def setUp(self):
+        self.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+
+    def test_parse_fields(self):
+        self.assertIsNone(parse_fields(None))
+        self.assertIsNone(parse_fields(" "))
+        self.assertEqual({"curr_out_volts": None, "cells": {"v": None, "ir": None}},
+                         parse_fields("curr_out_volts, cells.v,cells.ir,"))
+        self.assertEqual({"cells": None}, parse_fields("cells.v,cells"))
+        self.assertEqual({"cells": None}, parse_fields("cells,cells.v"))
+
+    def test_validate_fields(self):
+        validate_fields(ChannelStatus, parse_fields("curr_out_volts,cells.v,battery_plugged_in"))
+        validate_fields(DeviceInfo, parse_fields("device_sn,ch1_status.run"))
+
+        for fields in ("volts", "cells.volts", "curr_out_volts.x"):
+            with self.assertRaises(ValueError):
+                validate_fields(ChannelStatus, parse_fields(fields))
+
+    def test_project_matches_to_primitive(self):
+        status = self.comms.get_channel_status(0)
+        everything = status.to_primitive()
+
+        self.assertEqual(everything, project(status, None))
+        self.assertEqual({"curr_out_volts": everything["curr_out_volts"],
+                          "cells": [{"v": cell["v"]} for cell in everything["cells"]],
+                          "battery_plugged_in": everything["battery_plugged_in"]},
+                         project(status, parse_fields("curr_out_volts,cells.v,battery_plugged_in")))
+        self.assertEqual({"cells": everything["cells"]}, project(status, parse_fields("cells")))
+
+    def test_project_nested_model(self):
+        info = self.comms.get_device_info()
+        self.assertEqual({"ch1_status": {"run": info.ch1_status.run}, "device_sn": info.device_sn},
+                         project(info, parse_fields("device_sn,ch1_status.run")))
+
+
+class TestProjectedResources(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        evil_global.breaker.close()
+        self.client = application.test_client()
+        self.previous = evil_global.comms
+        evil_global.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+
+    def tearDown(self):
+        evil_global.comms = self.previous
+        testing_control.reset()
+
+    def test_channel_fields(self):
+        emulator = evil_global.comms.charger._serial.charger
+        before = emulator.transactions
+
+        resp = self.client.get("/channel/0?fields=curr_out_volts,curr_out_amps,cells.v")
+        self.assertEqual(200, resp.status_code)
+        d = json.loads(resp.data)
+
+        self.assertEqual(1, emulator.transactions - before)
+        self.assertIn("curr_out_volts", d)
+        self.assertIn("charger_presence", d)
+        self.assertNotIn("cycle_count", d)
+        self.assertEqual(["v"], d["cells"][0].keys())
+
+    def test_status_fields(self):
+        resp = self.client.get("/status?fields=device_id,ch2_status.run")
+        d = json.loads(resp.data)
+        self.assertEqual({"run"}, set(d["ch2_status"].keys()))
+        self.assertNotIn("device_sn", d)
+
+    def test_unknown_field(self):
+        resp = self.client.get("/channel/1?fields=volts")
+        self.assertEqual(400, resp.status_code)
+        self.assertIn("volts", json.loads(resp.data)["exception"])
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from modbus_tk.exceptions import ModbusInvalidResponseError
+
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.icharger.replay import CaptureSerialFacade, ReplaySerialFacade, read_capture, TIMING_FAST, \
+    STATUS_OK
+
+
+class TestCaptureAndReplay(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "session.cap")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def capture(self, latency=0):
+        facade = CaptureSerialFacade(EmulatorSerialFacade(latency=latency), self.path)
+        comms = ChargerCommsManager(master=iChargerMaster(serial=facade))
+
+        results = (comms.get_device_info().to_native(),
+                   comms.get_channel_status(0).to_native(),
+                   comms.get_system_storage().to_native())
+        comms.set_beep_properties(beep_index=0, enabled=True, volume=2)
+        with self.assertRaises(ModbusInvalidResponseError):
+            comms.charger.modbus_read_registers(0x4000, "H")
+
+        facade.close()
+        return results
+
+    def replay(self, timing=TIMING_FAST):
+        facade = ReplaySerialFacade(self.path, timing=timing)
+        return facade, ChargerCommsManager(master=iChargerMaster(serial=facade))
+
+    def test_capture_file(self):
+        self.capture()
+        (started, records) = read_capture(self.path)
+
+        self.assertTrue(started <= time.time())
+        (at, duration, status, request, response) = records[0]
+        self.assertEqual(STATUS_OK, status)
+        self.assertEqual("\x07\x30\x04\x00\x00\x00\x0d", request)
+        self.assertEqual("\x30\x04", response[1:3])
+
+    def test_replay_gives_the_captured_answers(self):
+        (info, channel, storage) = self.capture()
+        (facade, comms) = self.replay()
+
+        self.assertEqual(info, comms.get_device_info().to_native())
+        self.assertEqual(channel, comms.get_channel_status(0).to_native())
+        self.assertEqual(storage, comms.get_system_storage().to_native())
+        comms.set_beep_properties(beep_index=0, enabled=True, volume=2)
+        with self.assertRaises(ModbusInvalidResponseError):
+            comms.charger.modbus_read_registers(0x4000, "H")
+
+        self.assertEqual(len(read_capture(self.path)[1]), facade.served)
+        self.assertEqual(0, facade.skipped)
+
+    def test_requests_are_matched_out_of_order(self):
+        (info, channel, storage) = self.capture()
+        (facade, comms) = self.replay()
+
+        self.assertEqual(storage, comms.get_system_storage().to_native())
+        self.assertEqual(info, comms.get_device_info().to_native())
+        self.assertTrue(facade.skipped > 0)
+
+    def test_unknown_request(self):
+        self.capture()
+        (facade, comms) = self.replay()
+        with self.assertRaises(IOError):
+            comms.charger.modbus_read_registers(0x8c00, "H")
+
+    def test_original_timing(self):
+        self.capture(latency=0.01)
+        (facade, comms) = self.replay(timing="original")
+
+        started = time.time()
+        comms.get_device_info()
+        self.assertTrue(time.time() - started >= 0.01)
+
+    def test_not_a_capture(self):
+        with open(self.path, "wb") as f:
+            f.write("x" * 64)
+        with self.assertRaises(ValueError):
+            ReplaySerialFacade(self.path)
@@ -0,0 +1,76 @@
+import re
+import unittest
+
+import electric.evil_global as evil_global
+from electric import request_timing
+from electric.app import application
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.priority_lock import PriorityLock
+
+
+class TestRequestTiming(unittest.TestCase):
+    def tearDown(self):
+        request_timing.finish()
+
+    def test_header(self):
+        timing = request_timing.RequestTiming()
+        timing.started = 100.0
+        timing.record("encode", 0.0015)
+        timing.record("modbus", 0.004)
+        timing.record("modbus", 0.006)
+
+        self.assertEqual('modbus;dur=10.00;desc="2 register transactions", '
+                         'encode;dur=1.50;desc="encoding the response", '
+                         'total;dur=25.00', timing.header(now=100.025))
+
+    def test_nothing_is_recorded_outside_a_request(self):
+        request_timing.record("modbus", 1.0)
+        with request_timing.phase("decode"):
+            pass
+        self.assertIsNone(request_timing.current())
+
+    def test_nested_phases_are_counted_once(self):
+        timing = request_timing.start()
+        with request_timing.phase("decode"):
+            with request_timing.phase("decode"):
+                pass
+        self.assertEqual(1, timing.counts["decode"])
+
+    def test_lock_wait(self):
+        timing = request_timing.start()
+        lock = PriorityLock()
+        with lock:
+            pass
+        self.assertEqual(1, timing.counts["lock"])
+
+
+class TestServerTimingHeader(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        evil_global.breaker.close()
+        self.client = application.test_client()
+        self.previous = evil_global.comms
+        evil_global.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+
+    def tearDown(self):
+        evil_global.comms = self.previous
+        testing_control.reset()
+
+    def test_resources_report_their_phases(self):
+        resp = self.client.get("/control")
+        self.assertEqual(200, resp.status_code)
+
+        header = resp.headers["Server-Timing"]
+        self.assertTrue(header.startswith('lock;dur='))
+        self.assertIsNotNone(re.search(r'modbus;dur=[\d.]+;desc="1 register transactions"', header))
+        self.assertIn('decode;dur=', header)
+        self.assertIn('encode;dur=', header)
+        self.assertIsNotNone(re.search(r'total;dur=[\d.]+$', header))
+
+    def test_requests_that_never_reach_the_charger(self):
+        resp = self.client.get("/channel/5")
+        self.assertEqual(403, resp.status_code)
+        self.assertIn("total;dur=", resp.headers["Server-Timing"])
+        self.assertNotIn("modbus", resp.headers["Server-Timing"])
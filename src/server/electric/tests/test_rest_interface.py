@@ -1,14 +1,22 @@
 import json
 import unittest
 
+from flask_restful import Resource
+
+import electric.evil_global as evil_global
+from electric import metrics
 from electric.app import application
-from electric.icharger.modbus_usb import testing_control
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.rest_interface import exclusive, AfterRelease
 
 
 class TestRestfulAPI(unittest.TestCase):
     def setUp(self):
         self.client = application.test_client()
         testing_control.reset()
+        evil_global.breaker.close()
 
     def test_can_get_with_no_icharger_attached(self):
         testing_control.usb_device_present = False
@@ -128,3 +136,46 @@ class TestRestfulAPI(unittest.TestCase):
         self.assertIn("exception", d)
         self.assertEqual(d["exception"], "Channel number must be 0 or 1")
 
+
+class ProbeResource(Resource):
+    def __init__(self):
+        self.attempts = []
+
+    @exclusive
+    def get(self):
+        self.attempts.append(evil_global.lock._held.value)
+        if len(self.attempts) == 1:
+            raise IOError("garbled")
+        return AfterRelease(lambda: evil_global.lock._held.value)
+
+
+class TestCriticalSection(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        evil_global.breaker.close()
+        metrics.REGISTRY.clear()
+        self.client = application.test_client()
+        self.previous = evil_global.comms
+        evil_global.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+
+    def tearDown(self):
+        evil_global.comms = self.previous
+        evil_global.breaker.close()
+        testing_control.reset()
+
+    def test_response_is_encoded_after_the_lock_is_released(self):
+        probe = ProbeResource()
+        self.assertEqual(0, probe.get())
+        self.assertEqual([1, 1], probe.attempts)
+
+        # once for each attempt, and once for the recovery in between
+        self.assertEqual(3, metrics.resource_lock_hold_seconds.count(("ProbeResource",)))
+        self.assertEqual(1, metrics.request_retries.value(("ProbeResource",)))
+
+    def test_hold_time_is_reported(self):
+        resp = self.client.get("/channel/0")
+        self.assertEqual(200, resp.status_code)
+        self.assertIn("charger_presence", json.loads(resp.data))
+
+        self.assertEqual(1, metrics.resource_lock_hold_seconds.count(("ChannelResource",)))
+        self.assertIn('hold;dur=', resp.headers["Server-Timing"])
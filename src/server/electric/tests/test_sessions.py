@@ -0,0 +1,183 @@
+import json
+import multiprocessing
+import shutil
+import struct
+import tempfile
+import unittest
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.icharger.comms_layer import Operation, CHANNEL_INPUT_BLOCKS
+from electric.icharger.modbus_usb import testing_control
+from electric.sessions import SessionStore, SessionFile, registers_from, columns_from, REGISTER_COUNT, \
+    CHUNK_RECORDS, HEADER
+from electric.tests.test_telemetry import emulated_poller
+
+
+class TestSessionStore(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.store = SessionStore(self.directory)
+        self.poller = emulated_poller()
+        self.poller.sessions = self.store
+
+    def tearDown(self):
+        self.poller.stop(1)
+        self.store.close()
+        shutil.rmtree(self.directory)
+        testing_control.reset()
+
+    def test_registers_round_trip(self):
+        status = self.poller.poll().channel(0)
+        registers = registers_from(status)
+        self.assertEqual(REGISTER_COUNT, len(registers))
+
+        columns = columns_from([(100.0,) + registers])
+        self.assertAlmostEqual(status.curr_out_volts, columns["curr_out_volts"][0])
+        self.assertAlmostEqual(status.curr_int_temp, columns["curr_int_temp"][0])
+        self.assertEqual([cell.voltage for cell in status.cells], columns["cells"][0])
+
+    def test_idle_channels_are_not_recorded(self):
+        self.poller.poll()
+        self.poller.poll()
+        self.assertEqual([], self.store.sessions())
+
+    def test_session_follows_the_operation(self):
+        self.poller.poll()
+        self.poller.comms.run_operation(Operation.Charge, 1, 0)
+        for poll in range(3):
+            self.poller.poll()
+        self.assertTrue(self.store.is_running(self.store.sessions()[0].session_id))
+
+        self.poller.comms.stop_operation(1)
+        self.poller.poll()
+        self.poller.poll()
+
+        sessions = self.store.sessions()
+        self.assertEqual(1, len(sessions))
+        session = sessions[0]
+        self.assertFalse(self.store.is_running(session.session_id))
+        self.assertEqual(1, session.channel)
+
+        # the samples while running, and the one that showed it had stopped
+        self.assertEqual(4, session.count)
+        samples = session.query()
+        self.assertEqual(4, len(samples["time"]))
+        self.assertEqual(session.ended, samples["time"][-1])
+        self.assertTrue(samples["curr_out_amps"][0] > 0)
+        self.assertEqual(0, samples["curr_out_amps"][-1])
+
+    def test_time_range_uses_the_index(self):
+        writer_store = SessionStore(self.directory)
+        status = self.poller.poll().channel(0)
+        status.run_status = 1
+
+        snapshot = self.poller.snapshot
+        for n in range(CHUNK_RECORDS * 3):
+            snapshot.timestamp = 1000.0 + n
+            writer_store.record(snapshot)
+        writer_store.close()
+
+        session = writer_store.sessions()[0]
+        self.assertEqual(CHUNK_RECORDS * 3, session.count)
+        self.assertEqual(1000.0 + CHUNK_RECORDS * 3 - 1, session.ended)
+
+        records = session.records(since=1000.0 + CHUNK_RECORDS + 10, until=1000.0 + CHUNK_RECORDS + 12)
+        self.assertEqual([1000.0 + CHUNK_RECORDS + 10, 1000.0 + CHUNK_RECORDS + 11, 1000.0 + CHUNK_RECORDS + 12],
+                         [record[0] for record in records])
+        self.assertEqual([1000.0, 1010.0], session.query(until=1019, step=10)["time"])
+
+    def test_partly_written_record_is_ignored(self):
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        self.poller.poll()
+        session = self.store.sessions()[0]
+        with open(session.path, "ab") as f:
+            # the start of a varint that carries on
+            f.write("\x80")
+
+        self.assertEqual(1, SessionFile(session.path).count)
+
+    def test_samples_are_compressed(self):
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        for poll in range(CHUNK_RECORDS * 2):
+            self.poller.poll()
+
+        session = self.store.sessions()[0]
+        raw = struct.calcsize("<d" + "".join(data_format for (name, offset, data_format) in CHANNEL_INPUT_BLOCKS))
+        self.assertLess((session.size - HEADER.size) * 5, raw * session.count)
+
+        # and still all there
+        self.assertEqual(CHUNK_RECORDS * 2, len(session.query()["time"]))
+
+    def test_unknown_session(self):
+        self.assertIsNone(self.store.session("0-123"))
+        self.assertIsNone(self.store.session("../../etc/passwd"))
+
+    def test_running_is_seen_by_other_processes(self):
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        self.poller.poll()
+        session_id = self.store.sessions()[0].session_id
+
+        # a worker, reading the store the broker records into
+        reader = SessionStore(self.directory)
+        self.assertTrue(reader.is_running(session_id))
+
+        self.poller.comms.stop_operation(0)
+        self.poller.poll()
+        self.assertFalse(reader.is_running(session_id))
+
+    def test_only_one_process_records(self):
+        self.assertTrue(self.store.claim())
+
+        claimed = multiprocessing.Value('b', -1)
+
+        def claim():
+            claimed.value = SessionStore(self.directory).claim()
+
+        worker = multiprocessing.Process(target=claim)
+        worker.start()
+        worker.join(5)
+        self.assertEqual(0, claimed.value)
+
+
+class TestSessionResources(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.directory = tempfile.mkdtemp()
+        self.client = application.test_client()
+        self.previous = evil_global.telemetry
+
+        self.poller = evil_global.telemetry = emulated_poller(interval=60)
+        self.store = self.poller.sessions = SessionStore(self.directory)
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        self.poller.poll()
+        self.poller.poll()
+
+    def tearDown(self):
+        self.poller.stop(1)
+        self.store.close()
+        evil_global.telemetry = self.previous
+        shutil.rmtree(self.directory)
+        testing_control.reset()
+
+    def test_session_list(self):
+        d = json.loads(self.client.get("/session").data)
+        self.assertEqual(1, len(d["sessions"]))
+        self.assertEqual(0, d["sessions"][0]["channel"])
+        self.assertTrue(d["sessions"][0]["running"])
+
+    def test_session(self):
+        session_id = self.store.sessions()[0].session_id
+        resp = self.client.get("/session/{0}".format(session_id))
+        self.assertEqual(200, resp.status_code)
+        d = json.loads(resp.data)
+        self.assertEqual(session_id, d["session"]["id"])
+        self.assertEqual(len(d["time"]), len(d["cells"]))
+
+    def test_missing_session(self):
+        self.assertEqual(404, self.client.get("/session/0-1").status_code)
+
+    def test_sessions_require_a_directory(self):
+        self.poller.sessions = None
+        self.assertEqual(503, self.client.get("/session").status_code)
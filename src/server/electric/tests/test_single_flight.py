@@ -0,0 +1,143 @@
+import threading
+import time
+import unittest
+
+import electric.evil_global as evil_global
+from electric import metrics
+from electric.app import application
+from electric.circuit_breaker import ChargerCircuitBreaker
+from electric.icharger.comms_layer import ChargerCommsManager
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.priority_lock import PriorityLock
+from electric.single_flight import SingleFlight, freeze
+
+
+class TestSingleFlight(unittest.TestCase):
+    def setUp(self):
+        metrics.REGISTRY.clear()
+        self.calls = 0
+        self.release = threading.Event()
+
+    def slow_read(self, value):
+        self.calls += 1
+        self.release.wait(2)
+        return value
+
+    def run_concurrently(self, flight, count, func, *args):
+        results = []
+
+        def caller():
+            try:
+                results.append(flight.do(("test", args), func, *args))
+            except Exception, e:
+                results.append(e)
+
+        threads = [threading.Thread(target=caller) for n in range(count)]
+        for thread in threads:
+            thread.start()
+
+        # give them all a chance to find the call in flight
+        deadline = time.time() + 2
+        while metrics.coalesced_reads.value(("test",)) < count - 1 and time.time() < deadline:
+            time.sleep(0.001)
+        self.release.set()
+
+        for thread in threads:
+            thread.join(2)
+        return results
+
+    def test_concurrent_calls_share_the_result(self):
+        results = self.run_concurrently(SingleFlight(), 5, self.slow_read, 42)
+        self.assertEqual([42] * 5, results)
+        self.assertEqual(1, self.calls)
+        self.assertEqual(4, metrics.coalesced_reads.value(("test",)))
+
+    def test_failures_are_shared(self):
+        def failing_read():
+            self.calls += 1
+            self.release.wait(2)
+            raise IOError("gone")
+
+        results = self.run_concurrently(SingleFlight(freshness=60), 3, failing_read)
+        self.assertEqual(1, self.calls)
+        self.assertTrue(all(isinstance(result, IOError) for result in results))
+
+        # but aren't kept for anyone coming along later
+        with self.assertRaises(IOError):
+            SingleFlight(freshness=60).do(("test",), failing_read)
+        self.assertEqual(2, self.calls)
+
+    def test_finished_calls_are_not_reused_by_default(self):
+        flight = SingleFlight()
+        self.release.set()
+        flight.do(("test",), self.slow_read, 1)
+        flight.do(("test",), self.slow_read, 1)
+        self.assertEqual(2, self.calls)
+
+    def test_freshness_window(self):
+        flight = SingleFlight(freshness=60)
+        self.release.set()
+        self.assertEqual(1, flight.do(("test",), self.slow_read, 1))
+        self.assertEqual(1, flight.do(("test",), self.slow_read, 2))
+        self.assertEqual(1, self.calls)
+
+        self.assertEqual(3, flight.do(("other",), self.slow_read, 3))
+        self.assertEqual(2, self.calls)
+
+    def test_results_are_forgotten_once_stale(self):
+        flight = SingleFlight(freshness=0.05)
+        self.release.set()
+        for key in range(10):
+            flight.do(("test", key), self.slow_read, key)
+        self.assertEqual(10, len(flight._calls))
+
+        time.sleep(0.06)
+        flight.do(("test", "latest"), self.slow_read, 1)
+        self.assertEqual([("test", "latest")], flight._calls.keys())
+
+    def test_freeze(self):
+        self.assertEqual(freeze({"b": set([1]), "a": [1, {"c": None}]}),
+                         freeze({"a": [1, {"c": None}], "b": set([1])}))
+        hash(freeze({"a": [set([1, 2])]}))
+
+
+class TestCoalescedResources(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        evil_global.breaker.close()
+        self.client = application.test_client()
+        self.previous = (evil_global.comms, evil_global.single_flight)
+        evil_global.comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+        evil_global.single_flight = SingleFlight(freshness=60)
+
+    def tearDown(self):
+        (evil_global.comms, evil_global.single_flight) = self.previous
+        testing_control.reset()
+
+    def test_identical_reads_share_the_charger(self):
+        emulator = evil_global.comms.charger._serial.charger
+        before = emulator.transactions
+
+        first = self.client.get("/channel/0")
+        second = self.client.get("/channel/0")
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(2, emulator.transactions - before)
+
+        self.client.get("/channel/0?fields=curr_out_volts")
+        self.assertEqual(3, emulator.transactions - before)
+
+    def test_error_responses_are_not_reused(self):
+        previous = evil_global.breaker
+        # never probes during the test
+        evil_global.breaker = ChargerCircuitBreaker(evil_global.comms, PriorityLock(), probe_interval=60)
+        try:
+            for attempt in range(evil_global.breaker.threshold):
+                evil_global.breaker.record_failure(IOError("switched off"))
+            self.assertEqual(504, self.client.get("/channel/0").status_code)
+
+            evil_global.breaker.close()
+            self.assertEqual(200, self.client.get("/channel/0").status_code)
+        finally:
+            evil_global.breaker.close()
+            evil_global.breaker = previous
@@ -0,0 +1,240 @@
+import json
+import time
+import unittest
+
+import electric.evil_global as evil_global
+from electric.app import application
+from electric.circuit_breaker import ChargerCircuitBreaker
+from electric.icharger.comms_layer import ChargerCommsManager, Operation
+from electric.icharger.emulator import EmulatorSerialFacade
+from electric.icharger.modbus_usb import iChargerMaster, testing_control
+from electric.priority_lock import PriorityLock
+from electric.telemetry import TelemetryPoller, TelemetrySnapshot, event_stream
+
+
+def emulated_poller(interval=0.01, idle_interval=None):
+    comms = ChargerCommsManager(master=iChargerMaster(serial=EmulatorSerialFacade()))
+    return TelemetryPoller(comms, PriorityLock(), interval, idle_interval=idle_interval)
+
+
+class TestTelemetryPoller(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.poller = emulated_poller()
+
+    def tearDown(self):
+        self.poller.stop(1)
+        testing_control.reset()
+
+    def test_no_snapshot_before_the_first_poll(self):
+        self.assertIsNone(self.poller.snapshot)
+
+    def test_poll_reads_every_channel(self):
+        snapshot = self.poller.poll()
+        self.assertIs(snapshot, self.poller.snapshot)
+        self.assertEqual(1, snapshot.version)
+        self.assertIsNone(snapshot.exception)
+        self.assertEqual(2, len(snapshot.channels))
+        self.assertEqual(1, snapshot.channel(1).channel)
+        self.assertIsNone(snapshot.channel(2))
+
+    def test_versions_increase(self):
+        first = self.poller.poll()
+        second = self.poller.poll()
+        self.assertEqual(first.version + 1, second.version)
+        self.assertIsNot(first, second)
+
+    def test_failure_keeps_the_last_known_state(self):
+        good = self.poller.poll()
+        testing_control.usb_device_present = False
+        bad = self.poller.poll()
+
+        self.assertIsNotNone(bad.exception)
+        self.assertIs(good.device_info, bad.device_info)
+        self.assertEqual("disconnected", bad.state_dict()["charger_presence"])
+
+    def test_failure_keeps_the_time_of_the_last_known_state(self):
+        good = self.poller.poll()
+        time.sleep(0.05)
+        testing_control.usb_device_present = False
+        bad = self.poller.poll()
+
+        self.assertEqual(good.timestamp, bad.timestamp)
+        self.assertGreaterEqual(bad.state_dict()["snapshot_age"], 0.05)
+
+    def test_open_breaker_skips_the_charger(self):
+        self.poller.breaker = ChargerCircuitBreaker(self.poller.comms, self.poller.lock, probe_interval=60)
+        testing_control.usb_device_present = False
+        for attempt in range(self.poller.breaker.threshold):
+            self.poller.poll()
+        self.assertTrue(self.poller.breaker.is_open)
+
+        emulator = self.poller.comms.charger._serial.charger
+        before = emulator.transactions
+        testing_control.usb_device_present = True
+        self.assertIsNotNone(self.poller.poll().exception)
+        self.assertEqual(before, emulator.transactions)
+        self.poller.breaker.close()
+
+    def test_thread_publishes_snapshots(self):
+        self.poller.ensure_running()
+        self.poller.ensure_running()
+
+        deadline = time.time() + 2
+        while time.time() < deadline and (self.poller.snapshot is None or self.poller.snapshot.version < 3):
+            time.sleep(0.01)
+
+        self.assertTrue(self.poller.snapshot.version >= 3)
+
+        self.poller.stop(1)
+        self.assertFalse(self.poller.running)
+
+    def test_snapshot_age(self):
+        snapshot = TelemetrySnapshot(1, 100.0)
+        self.assertEqual(2.5, snapshot.age(102.5))
+        self.assertEqual(2.5, snapshot.state_dict(102.5)["snapshot_age"])
+
+
+class TestAdaptivePolling(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.poller = emulated_poller(interval=0.01, idle_interval=60)
+
+    def tearDown(self):
+        self.poller.stop(1)
+        testing_control.reset()
+
+    def test_idle_charger_is_polled_slowly(self):
+        snapshot = self.poller.poll()
+        self.assertFalse(snapshot.active)
+        self.assertEqual(60, self.poller.next_interval(snapshot, self.poller.poll()))
+
+    def test_running_channel_is_polled_quickly(self):
+        self.poller.comms.run_operation(Operation.Charge, 1, 0)
+        snapshot = self.poller.poll()
+        self.assertTrue(snapshot.active)
+        self.assertEqual(0.01, self.poller.next_interval(snapshot))
+
+    def test_status_change_is_polled_quickly(self):
+        self.poller.comms.run_operation(Operation.Charge, 0, 0)
+        running = self.poller.poll()
+        self.poller.comms.stop_operation(0)
+        stopped = self.poller.poll()
+
+        self.assertFalse(stopped.active)
+        self.assertEqual(0.01, self.poller.next_interval(stopped, running))
+        self.assertEqual(60, self.poller.next_interval(self.poller.poll(), stopped))
+
+    def test_failure_is_polled_quickly(self):
+        testing_control.usb_device_present = False
+        self.assertEqual(0.01, self.poller.next_interval(self.poller.poll()))
+
+    def test_control_change_wakes_the_poller(self):
+        control = self.poller.comms.get_control_register()
+        self.poller.note_control(control)
+        self.assertTrue(self.poller._wakeup.is_set())
+
+        self.poller._wakeup.clear()
+        self.poller.note_control(self.poller.comms.get_control_register())
+        self.assertFalse(self.poller._wakeup.is_set())
+
+    def test_wake_polls_straight_away(self):
+        self.poller.ensure_running()
+        first = self.poller.wait_for_snapshot(0, 2)
+        time.sleep(0.05)
+
+        self.poller.wake()
+        second = self.poller.wait_for_snapshot(first.version, 2)
+        self.assertEqual(first.version + 1, second.version)
+
+
+class TestEventStream(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.poller = emulated_poller()
+
+    def tearDown(self):
+        testing_control.reset()
+
+    def test_events_are_encoded_once_per_snapshot(self):
+        snapshot = self.poller.poll()
+        event = snapshot.channel_event(0)
+        self.assertIs(event, snapshot.channel_event(0))
+        self.assertTrue(event.startswith("id: 1\nevent: channel\ndata: "))
+        self.assertTrue(event.endswith("\n\n"))
+
+        data = json.loads(event.split("data: ", 1)[1])
+        self.assertEqual(0, data["channel"])
+        self.assertEqual("connected", data["charger_presence"])
+
+    def test_status_event_includes_every_channel(self):
+        data = json.loads(self.poller.poll().status_event().split("data: ", 1)[1])
+        self.assertEqual(2, len(data["channels"]))
+        self.assertIn("device_sn", data)
+
+    def test_failed_poll_event(self):
+        testing_control.usb_device_present = False
+        data = json.loads(self.poller.poll().channel_event(1).split("data: ", 1)[1])
+        self.assertEqual("disconnected", data["charger_presence"])
+        self.assertNotIn("channel", data)
+
+    def test_stream_yields_each_new_snapshot(self):
+        stream = event_stream(self.poller, lambda snapshot: snapshot.version, keepalive=0.01)
+        self.assertEqual(": keepalive\n\n", next(stream))
+
+        self.poller.poll()
+        self.assertEqual(1, next(stream))
+        self.assertEqual(": keepalive\n\n", next(stream))
+
+        self.poller.poll()
+        self.poller.poll()
+        self.assertEqual(3, next(stream))
+
+
+class TestTelemetryResources(unittest.TestCase):
+    def setUp(self):
+        testing_control.reset()
+        self.client = application.test_client()
+        self.previous = evil_global.telemetry
+
+        # long enough that the thread won't poll again during the test
+        self.poller = evil_global.telemetry = emulated_poller(interval=60)
+        self.poller.poll()
+
+    def tearDown(self):
+        self.poller.stop(1)
+        evil_global.telemetry = self.previous
+        testing_control.reset()
+
+    def test_status_is_served_from_the_snapshot(self):
+        d = json.loads(self.client.get("/status").data)
+        self.assertEqual("connected", d["charger_presence"])
+        self.assertEqual(evil_global.telemetry.snapshot.device_info.device_sn, d["device_sn"])
+        self.assertIn("snapshot_age", d)
+
+    def test_channel_is_served_from_the_snapshot(self):
+        d = json.loads(self.client.get("/channel/1").data)
+        self.assertEqual(1, d["channel"])
+        self.assertIn("snapshot_version", d)
+
+    def test_failed_poll_is_a_504(self):
+        testing_control.usb_device_present = False
+        evil_global.telemetry.poll()
+
+        resp = self.client.get("/channel/0")
+        self.assertEqual(504, resp.status_code)
+        self.assertEqual("disconnected", json.loads(resp.data)["charger_presence"])
+
+    def test_channel_stream(self):
+        resp = self.client.get("/stream/channel/1", buffered=False)
+        try:
+            self.assertEqual("text/event-stream", resp.mimetype)
+            event = next(iter(resp.response))
+            self.assertTrue(event.startswith("id: "))
+            self.assertEqual(1, json.loads(event.split("data: ", 1)[1])["channel"])
+        finally:
+            resp.close()
+
+    def test_stream_requires_the_poller(self):
+        evil_global.telemetry = None
+        self.assertEqual(503, self.client.get("/stream/status").status_code)
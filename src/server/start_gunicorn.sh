@@ -1,2 +1,6 @@
 #!/usr/bin/env bash
-gunicorn --preload --bind=0.0.0.0:5000 --workers=1 --max-requests=50 --backlog=300 "electric.wsgi:application"
+# The workers talk to the charger through a single broker process (see electric/icharger/broker.py),
+# which is started by the preloaded app - so --preload is required.  Workers are recycled now and then, rarely
+# (and not all at once) as that closes their event streams.
+export DEVICE_BROKER=${DEVICE_BROKER:-/tmp/electric-charger/broker.sock}
+gunicorn --preload --bind=0.0.0.0:5000 --workers=4 --threads=8 --max-requests=5000 --max-requests-jitter=500 --backlog=300 "electric.wsgi:application"